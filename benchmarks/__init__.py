@@ -0,0 +1,104 @@
+from __future__ import print_function
+
+import json
+import platform
+import time
+
+
+BENCHMARKS = [
+    'benchmarks.render',
+    'benchmarks.hashing',
+    'benchmarks.upload',
+    'benchmarks.dedupe',
+    'benchmarks.promotion',
+    'benchmarks.cleanup',
+]
+
+# Units where a bigger value is better, the others are timings
+THROUGHPUT_UNITS = ('MB/s', 'rows/s')
+
+
+def measure(func, repeat=3, setup=None):
+    """ Runs func repeat times and returns the best wall clock time in seconds.
+
+        setup is called before every run and isn't timed.
+    """
+    best = None
+
+    for x in range(repeat):
+        if setup is not None:
+            setup()
+
+        started = time.time()
+        func()
+        elapsed = time.time() - started
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+def get_environment():
+    import django
+    import upthor
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'upthor': upthor.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def get_change(result, baseline):
+    """ Returns how much result improved over baseline in percent (negative for regressions).
+    """
+    if not baseline['value']:
+        return None
+
+    change = (result['value'] - baseline['value']) / float(baseline['value']) * 100
+
+    return change if result['unit'] in THROUGHPUT_UNITS else -change
+
+
+def run_benchmarks(names=None, output=None, compare=None):
+    """ Runs the BENCHMARKS modules (or the ones in names) and prints their results.
+
+    :param output: Path of a JSON file the results are written to.
+    :param compare: Path of a JSON file written by an earlier run, the change to it is printed.
+    """
+    from importlib import import_module
+
+    baseline = {}
+    if compare:
+        with open(compare) as handle:
+            baseline = dict((x['name'], x) for x in json.load(handle)['results'])
+
+    results = []
+
+    for module_name in BENCHMARKS:
+        if names and module_name.split('.')[-1] not in names:
+            continue
+
+        module = import_module(module_name)
+
+        for name, value, unit in module.run():
+            result = {'name': '%s.%s' % (module_name.split('.')[-1], name), 'value': value, 'unit': unit}
+            results.append(result)
+
+            line = '%-50s %12.2f %s' % (result['name'], value, unit)
+
+            if result['name'] in baseline:
+                change = get_change(result, baseline[result['name']])
+                if change is not None:
+                    line = '%-72s %+8.1f%%' % (line, change)
+
+            print(line)
+
+    if output:
+        with open(output, 'w') as handle:
+            json.dump({'environment': get_environment(), 'results': results}, handle, indent=2, sort_keys=True)
+
+    return results
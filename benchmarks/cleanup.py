@@ -0,0 +1,30 @@
+import datetime
+
+from django.utils import timezone
+
+from benchmarks import measure
+from upthor.cleanup import TemporaryFileCleaner
+from upthor.models import TemporaryFileWrapper
+
+
+ROWS = 10 ** 5
+
+
+def create_rows():
+    TemporaryFileWrapper.objects.all().delete()
+    TemporaryFileWrapper.objects.bulk_create([
+        TemporaryFileWrapper(file='benchmark/missing-%d.bin' % idx, md5sum='%032x' % idx) for idx in range(ROWS)
+    ], batch_size=100)
+
+    # Half of them are expired
+    expired = timezone.now() - datetime.timedelta(days=30)
+    TemporaryFileWrapper.objects.filter(pk__in=TemporaryFileWrapper.objects.values('pk')[:ROWS // 2]).update(modified=expired)
+
+
+def run():
+    """ Runs the clean_temporary_files cleaner over ROWS rows, the files don't exist in the storage.
+    """
+    elapsed = measure(lambda: TemporaryFileCleaner().run(), repeat=1, setup=create_rows)
+    yield 'clean_%d_rows' % ROWS, ROWS / elapsed, 'rows/s'
+
+    TemporaryFileWrapper.objects.all().delete()
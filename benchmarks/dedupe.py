@@ -0,0 +1,39 @@
+import os
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from benchmarks import measure
+from upthor.models import TemporaryFileWrapper
+
+
+FILES = 200
+SIZE = 64 * 1024
+
+
+def save_files(files):
+    for uploaded_file in files:
+        TemporaryFileWrapper(file=uploaded_file).save()
+
+
+def run():
+    """ Hashes and saves FILES new files, then the same content again (which reuses the rows).
+    """
+    files = []
+
+    def setup():
+        files[:] = [SimpleUploadedFile('benchmark.bin', os.urandom(SIZE)) for x in range(FILES)]
+
+    elapsed = measure(lambda: save_files(files), setup=setup)
+    yield 'save_new', elapsed * 1e6 / FILES, 'us/file'
+
+    def setup_duplicates():
+        for uploaded_file in files:
+            uploaded_file.seek(0)
+
+    elapsed = measure(lambda: save_files(files), setup=setup_duplicates)
+    yield 'save_duplicate', elapsed * 1e6 / FILES, 'us/file'
+
+    wrappers = list(TemporaryFileWrapper.objects.all()[:FILES])
+
+    elapsed = measure(lambda: [x.get_hash() for x in wrappers])
+    yield 'get_hash', elapsed * 1e6 / len(wrappers), 'us/file'
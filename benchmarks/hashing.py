@@ -0,0 +1,43 @@
+import os
+
+from django.core.files.base import ContentFile
+
+from benchmarks import measure
+from upthor.hashing import hash_file, new_hash
+from upthor.models import TemporaryFileWrapper
+
+
+SIZES = [
+    ('64k', 64 * 1024),
+    ('1m', 1024 * 1024),
+    ('16m', 16 * 1024 * 1024),
+    ('128m', 128 * 1024 * 1024),
+]
+
+
+def hash_chunks(the_file):
+    """ How files were hashed before upthor.hashing.hash_file, with Django's default chunk size.
+    """
+    file_hash = new_hash()
+
+    the_file.open('rb')
+    for chunk in the_file.chunks():
+        file_hash.update(chunk)
+
+    the_file.close()
+    return file_hash.hexdigest()
+
+
+def run():
+    """ Hashes temporary files of several sizes in chunks() and with hash_file, reports MB/s.
+    """
+    for label, size in SIZES:
+        temporary = TemporaryFileWrapper()
+        temporary.file.save('benchmark-%s.bin' % label, ContentFile(os.urandom(size)), save=False)
+
+        try:
+            for name, func in [('chunks', hash_chunks), ('hash_file', hash_file)]:
+                elapsed = measure(lambda: func(temporary.file))
+                yield '%s_%s' % (label, name), size / elapsed / 2 ** 20, 'MB/s'
+        finally:
+            temporary.file.delete(save=False)
@@ -0,0 +1,8 @@
+from django.db import models
+
+from upthor.fields import ThorFileField
+from upthor.widgets import ThorMultiUploadWidget
+
+
+class BenchmarkModel(models.Model):
+    content = ThorFileField(upload_to='benchmark-files', allowed_types=['*'], widget=ThorMultiUploadWidget)
@@ -0,0 +1,37 @@
+import os
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from benchmarks import measure
+from benchmarks.models import BenchmarkModel
+from upthor.linking import batch_links
+from upthor.models import TemporaryFileWrapper
+
+
+FILES = 50
+SIZE = 1024 * 1024
+
+
+def promote(wrappers):
+    field = BenchmarkModel._meta.get_field('content')
+
+    with batch_links():
+        for wrapper in wrappers:
+            the_file = wrapper.file
+            the_file.temporary_wrapper = wrapper
+
+            field.pre_save(BenchmarkModel(content=the_file), True)
+
+
+def run():
+    """ Promotes FILES temporary files with ThorFileField.pre_save, like saving a formset.
+    """
+    wrappers = []
+
+    def setup():
+        wrappers[:] = TemporaryFileWrapper.bulk_save([
+            SimpleUploadedFile('benchmark.bin', os.urandom(SIZE)) for x in range(FILES)
+        ])
+
+    elapsed = measure(lambda: promote(wrappers), setup=setup)
+    yield 'pre_save', elapsed * 1e3 / FILES, 'ms/file'
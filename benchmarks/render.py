@@ -0,0 +1,61 @@
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.forms import modelformset_factory
+from django.http import QueryDict
+
+from benchmarks import measure
+from benchmarks.models import BenchmarkModel
+from upthor import widgets
+from upthor.models import TemporaryFileWrapper
+
+
+FORMS = 500
+
+
+def render_widgets(bound_fields, cached):
+    for bound_field in bound_fields:
+        if not cached:
+            widgets._compiled_templates.clear()
+
+        bound_field.as_widget()
+
+
+def get_formset_data(formset, wrappers):
+    data = QueryDict(mutable=True)
+    data['form-TOTAL_FORMS'] = str(len(formset.forms))
+    data['form-INITIAL_FORMS'] = '0'
+
+    for form, wrapper in zip(formset.forms, wrappers):
+        widget = form.fields['content'].widget
+
+        data['%s_md5sum' % form.add_prefix('content')] = wrapper.md5sum
+        data['%s_FQ' % form.add_prefix('content')] = widget.get_fq()
+
+    return data
+
+
+def read_values(formset, data):
+    for form in formset.forms:
+        form.fields['content'].widget.value_from_datadict(data, {}, form.add_prefix('content'))
+
+
+def run():
+    """ Renders the upthor widgets of a FORMS form formset with and without the compiled template cache,
+        then reads the uploaded files of a submitted one.
+    """
+    formset_class = modelformset_factory(BenchmarkModel, fields=['content'], extra=FORMS)
+    formset = formset_class(queryset=BenchmarkModel.objects.none())
+    bound_fields = [form['content'] for form in formset.forms]
+
+    for cached in (False, True):
+        elapsed = measure(lambda: render_widgets(bound_fields, cached))
+        yield 'formset_%d_%s' % (FORMS, 'cached' if cached else 'uncached'), elapsed * 1e6 / FORMS, 'us/widget'
+
+    wrappers = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('file.txt', str(idx).encode()) for idx in range(FORMS)])
+    data = []
+
+    def setup():
+        # The resolved values are cached on the data
+        data[:] = [get_formset_data(formset, wrappers)]
+
+    elapsed = measure(lambda: read_values(formset, data[0]), setup=setup)
+    yield 'formset_%d_value_from_datadict' % FORMS, elapsed * 1e6 / FORMS, 'us/widget'
@@ -0,0 +1,48 @@
+import os
+from io import BytesIO
+
+from django.core.urlresolvers import reverse
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils.http import urlencode
+
+from benchmarks import measure
+from upthor.models import FqCrypto
+
+
+SIZES = [
+    ('1k', 1024, 50),
+    ('1m', 1024 * 1024, 10),
+    ('16m', 16 * 1024 * 1024, 2),
+]
+
+
+def post_files(client, fq, contents):
+    for content in contents:
+        the_file = BytesIO(content)
+        the_file.name = 'benchmark.bin'
+
+        response = client.post('%s?%s' % (reverse('thor-file-upload'), urlencode({'fq': fq})), {'fq': fq, 'file': the_file})
+        assert response.status_code == 200, response.content
+
+
+def run():
+    """ Posts files of several sizes to FileUploadView, unique ones and duplicates of an earlier upload.
+    """
+    client = Client()
+    fq = FqCrypto.encode('FQ:benchmarks.BenchmarkModel.content')
+
+    with override_settings(THOR_MAX_FILE_SIZE=max(size for label, size, count in SIZES)):
+        for label, size, count in SIZES:
+            contents = []
+
+            def setup():
+                contents[:] = [os.urandom(size) for x in range(count)]
+
+            elapsed = measure(lambda: post_files(client, fq, contents), setup=setup)
+            yield '%s_unique' % label, size * count / elapsed / 2 ** 20, 'MB/s'
+            yield '%s_unique_request' % label, elapsed * 1e3 / count, 'ms/upload'
+
+            # contents were all uploaded by the last run
+            elapsed = measure(lambda: post_files(client, fq, contents))
+            yield '%s_duplicate_request' % label, elapsed * 1e3 / count, 'ms/upload'
@@ -0,0 +1,47 @@
+import argparse
+import shutil
+import tempfile
+
+import django
+from django.conf import settings
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+settings.configure(DEBUG=False,
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    },
+    ROOT_URLCONF='upthor.urls',
+    MEDIA_ROOT=MEDIA_ROOT,
+    ALLOWED_HOSTS=['testserver'],
+
+    INSTALLED_APPS=(
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django.contrib.admin',
+        'upthor',
+        'benchmarks',
+    )
+)
+
+django.setup()
+
+from django.core.management import call_command  # noqa
+from benchmarks import run_benchmarks  # noqa
+
+parser = argparse.ArgumentParser(description='Runs the upthor benchmarks.')
+parser.add_argument('names', nargs='*', help='Benchmark modules to run (e.g. render), defaults to all.')
+parser.add_argument('--output', help='Write the results to this JSON file.')
+parser.add_argument('--compare', help='Print the change to the results in this JSON file.')
+args = parser.parse_args()
+
+try:
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+    run_benchmarks(args.names, output=args.output, compare=args.compare)
+finally:
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
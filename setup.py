@@ -23,7 +23,7 @@ setup(
     author="Thorgate",
     author_email='info@thorgate.eu',
     url='https://github.com/thorgate/django-upthor',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     package_data={'upthor': [
         'static/upthor/css/*',
         'static/upthor/fonts/*',
@@ -1 +1,3 @@
 __version__ = "0.9.1"
+
+default_app_config = 'upthor.apps.UpthorConfig'
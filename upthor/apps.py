@@ -0,0 +1,12 @@
+from django.apps import AppConfig
+
+
+class UpthorConfig(AppConfig):
+    name = 'upthor'
+
+    def ready(self):
+        from django.apps import apps
+        from upthor.registry import registry
+
+        # Also registers the fields models inherit from their parents
+        registry.register_models(apps.get_models())
@@ -0,0 +1,153 @@
+import datetime
+import os
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.encoding import force_text
+
+from upthor.cleanup import raw_delete
+from upthor.models import BlobReference, StoredBlob, get_blob_grace_period, get_blob_upload_path
+from upthor.previews import get_stored_names, is_image_type, promote_previews
+from upthor.promotion import promote_file
+from upthor.registry import registry
+from upthor.storage import delete_stored_files
+
+
+def get_storage_key(storage):
+    """ Identifies the storage, blobs are only shared by fields that use the same storage.
+    """
+    deconstruct = getattr(storage, 'deconstruct', None)
+
+    if callable(deconstruct):
+        path, args, kwargs = deconstruct()
+        return force_text('%s%r%r' % (path, args, sorted(kwargs.items())))[:255]
+
+    return '%s.%s' % (storage.__class__.__module__, storage.__class__.__name__)
+
+
+def blob_name(md5sum, filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return os.path.join(get_blob_upload_path(), md5sum[:2], md5sum[2:4], md5sum + extension)
+
+
+def store_blob(temporary, field_file, filename):
+    """ Points field_file at the blob with the content of the temporary file, the file is only copied
+        when the storage of field_file doesn't have it yet.
+
+        Like upthor.promotion.promote_field_file for fields with content addressed storage.
+    """
+    storage = field_file.storage
+    storage_key = get_storage_key(storage)
+
+    blob = StoredBlob.objects.filter(md5sum=temporary.md5sum, storage_key=storage_key).first()
+
+    if blob is None or not storage.exists(blob.name):
+        name = promote_file(temporary.file, storage, blob_name(temporary.md5sum, filename),
+                            max_length=field_file.field.max_length)
+
+        if is_image_type(temporary.content_type) and getattr(field_file.field, 'has_previews', False):
+            promote_previews(temporary.file, field_file.field.attr_class(None, field_file.field, name))
+
+        if blob is None:
+            config = registry.get_for_model(field_file.instance, field_file.field.name)
+            blob = StoredBlob(md5sum=temporary.md5sum, hash_algorithm=temporary.hash_algorithm, storage_key=storage_key,
+                              content_type=temporary.content_type, field_query='.'.join(config.key))
+
+        blob.name = name
+
+        try:
+            with transaction.atomic():
+                blob.save()
+        except IntegrityError:
+            # Somebody stored the same content at the same time, use theirs
+            storage.delete(name)
+            blob = StoredBlob.objects.get(md5sum=temporary.md5sum, storage_key=storage_key)
+    else:
+        # Keeps gc_blobs from removing the blob before the reference is saved
+        StoredBlob.objects.filter(pk=blob.pk).update(modified=timezone.now())
+
+    field_file.name = blob.name
+    setattr(field_file.instance, field_file.field.name, field_file.name)
+    field_file._committed = True
+
+    return field_file
+
+
+def get_model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def get_reference_label(field):
+    """ References are stored under the concrete model that has the column of field, so saving and deleting
+        through proxies and child models (multi-table inheritance) use the same key.
+    """
+    return get_model_label(field.model._meta.concrete_model)
+
+
+_content_addressed_fields = {}
+
+
+def get_content_addressed_fields(model):
+    if model not in _content_addressed_fields:
+        _content_addressed_fields[model] = [field for field in model._meta.fields if getattr(field, 'content_addressed', False)]
+
+    return _content_addressed_fields[model]
+
+
+def update_references(sender, instance, **kwargs):
+    """ post_save receiver (of all models) for models with content addressed fields.
+    """
+    for field in get_content_addressed_fields(sender):
+        label = get_reference_label(field)
+        the_file = getattr(instance, field.name)
+        blob = None
+
+        if the_file and the_file.name:
+            blob = StoredBlob.objects.filter(name=the_file.name, storage_key=get_storage_key(field.storage)).first()
+
+        if blob is None:
+            BlobReference.objects.filter(model=label, object_id=force_text(instance.pk), field_name=field.name).delete()
+        else:
+            BlobReference.objects.update_or_create(model=label, object_id=force_text(instance.pk), field_name=field.name,
+                                                   defaults={'blob': blob})
+
+
+def delete_references(sender, instance, **kwargs):
+    """ post_delete receiver (of all models) for models with content addressed fields.
+    """
+    for field in get_content_addressed_fields(sender):
+        BlobReference.objects.filter(model=get_reference_label(field), object_id=force_text(instance.pk),
+                                     field_name=field.name).delete()
+
+
+def get_unreferenced_blobs(grace_period=None):
+    grace_period = get_blob_grace_period() if grace_period is None else grace_period
+    stale_delta = timezone.now() - datetime.timedelta(seconds=grace_period)
+
+    return StoredBlob.objects.filter(modified__lte=stale_delta).exclude(pk__in=BlobReference.objects.values('blob'))
+
+
+def collect_blobs(grace_period=None, dry_run=False):
+    """ Removes blobs that have no references and weren't used during the grace period.
+
+    :returns: (list of removed blobs, list of names that couldn't be deleted from the storage)
+    """
+    removed = []
+    failed = []
+
+    for blob in get_unreferenced_blobs(grace_period):
+        if dry_run:
+            removed.append(blob)
+            continue
+
+        # Check again in the delete, a reference might have been added meanwhile
+        if not raw_delete(get_unreferenced_blobs(grace_period).filter(pk=blob.pk)):
+            continue
+
+        removed.append(blob)
+
+        config = registry.get(*blob.field_query.split('.'))
+        if config is not None:
+            failed += delete_stored_files(config.field.storage, get_stored_names(blob.name, blob.content_type))
+
+    return removed, failed
@@ -0,0 +1,128 @@
+import errno
+import os
+import threading
+from collections import OrderedDict
+
+from django.utils import timezone
+
+from upthor.hashing import new_hash
+from upthor.metrics import increment
+from upthor.models import ChunkedUpload, TemporaryFileWrapper, get_chunked_upload_dir
+from upthor.uploadhandler import ThorUploadedFile
+
+
+# Hash objects can't be stored in the database, so the running hash of each upload is kept in
+# memory. If the next chunk is handled by another process the persisted part is hashed again.
+HASH_STATE_CACHE_SIZE = 256
+
+_hash_states = OrderedDict()
+_hash_states_lock = threading.Lock()
+
+
+class ChunkedUploadError(Exception):
+    pass
+
+
+class ChunkedUploadedFile(ThorUploadedFile):
+    """ A finished chunked upload, storages can move it into place instead of copying it.
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def create_upload(field_query, file_name, content_type, size):
+    upload = ChunkedUpload.objects.create(
+        field_query=field_query,
+        file_name=os.path.basename(file_name or '') or 'upload',
+        content_type=content_type or 'application/unknown',
+        size=size,
+    )
+
+    try:
+        os.makedirs(get_chunked_upload_dir())
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    open(upload.partial_path, 'wb').close()
+
+    return upload
+
+
+def get_hash_state(upload):
+    with _hash_states_lock:
+        state = _hash_states.pop(upload.upload_id, None)
+
+    if state is not None and state[0] == upload.offset:
+        return state[1]
+
+    file_hash = new_hash()
+    remaining = upload.offset
+
+    with open(upload.partial_path, 'rb') as partial:
+        while remaining > 0:
+            data = partial.read(min(remaining, 64 * 2 ** 10))
+            if not data:
+                raise ChunkedUploadError('Persisted part of the upload is missing.')
+
+            file_hash.update(data)
+            remaining -= len(data)
+
+    return file_hash
+
+
+def store_hash_state(upload, file_hash):
+    with _hash_states_lock:
+        _hash_states[upload.upload_id] = (upload.offset, file_hash)
+
+        while len(_hash_states) > HASH_STATE_CACHE_SIZE:
+            _hash_states.popitem(last=False)
+
+
+def append_chunk(upload, chunk):
+    """ Appends chunk to the upload at its persisted offset and updates the running hash.
+    """
+    if upload.offset + chunk.size > upload.size:
+        raise ChunkedUploadError('Uploaded bytes exceed file size.')
+
+    file_hash = get_hash_state(upload)
+
+    with open(upload.partial_path, 'r+b') as partial:
+        partial.seek(upload.offset)
+
+        for data in chunk.chunks():
+            file_hash.update(data)
+            partial.write(data)
+
+        # Drop leftovers of an earlier attempt that was never persisted
+        partial.truncate()
+
+    offset = upload.offset + chunk.size
+    updated = ChunkedUpload.objects.filter(pk=upload.pk, offset=upload.offset).update(
+        offset=offset, modified=timezone.now(),
+    )
+
+    if not updated:
+        raise ChunkedUploadError('The upload was changed by another request.')
+
+    upload.offset = offset
+    store_hash_state(upload, file_hash)
+
+    increment('upload.bytes', chunk.size)
+
+
+def get_uploaded_file(upload):
+    """ Returns the finished upload as an uploaded file that TemporaryFileForm can save.
+    """
+    md5sum = get_hash_state(upload).hexdigest()
+
+    return ChunkedUploadedFile(
+        file=open(upload.partial_path, 'rb'),
+        name=upload.file_name,
+        content_type=upload.content_type,
+        size=upload.size,
+        charset=None,
+        md5sum=md5sum,
+        duplicate=TemporaryFileWrapper.objects.filter(md5sum=md5sum).first(),
+    )
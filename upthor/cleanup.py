@@ -0,0 +1,225 @@
+import calendar
+import datetime
+import logging
+import re
+import shutil
+import time
+
+from django.db.models import Q
+from django.db.models.sql import DeleteQuery
+from django.utils import timezone
+
+from upthor.models import (
+    UPLOAD_BUCKET_FORMAT, ChunkedUpload, PromotionTask, TemporaryFileWrapper, get_expiry_time, get_linked_expiry_time,
+    get_upload_bucket_size, get_upload_path,
+)
+from upthor.metrics import increment, timer
+from upthor.previews import get_stored_names
+from upthor.storage import delete_stored_files, get_temporary_storage, list_stored_names, storage_has_path
+
+
+UPLOAD_BUCKET_REGEX = re.compile(r'^(\d{14})-(\d+)$')
+
+
+def get_stale_files():
+    linked_stale_delta = timezone.now() - datetime.timedelta(seconds=get_linked_expiry_time())
+    stale_delta = timezone.now() - datetime.timedelta(seconds=get_expiry_time())
+
+    # Files that are still being copied by deferred promotion are kept
+    pending = PromotionTask.objects.filter(state__in=[PromotionTask.PENDING, PromotionTask.RUNNING]).values('source_name')
+
+    return TemporaryFileWrapper.objects.filter(Q(linked=True, modified__lte=linked_stale_delta) |
+                                               Q(linked=False, modified__lte=stale_delta)).exclude(file__in=pending)
+
+
+def raw_delete(queryset):
+    """ Deletes the rows matching queryset without loading them or sending signals.
+    """
+    if hasattr(queryset, '_raw_delete'):
+        return queryset._raw_delete(queryset.db)
+
+    # Django < 1.9
+    pks = list(queryset.values_list('pk', flat=True))
+    DeleteQuery(queryset.model).delete_batch(pks, queryset.db)
+
+    return len(pks)
+
+
+def parse_upload_bucket(name):
+    """ Returns the (start, end) timestamps of the bucket directory name, or None if it isn't one.
+    """
+    match = UPLOAD_BUCKET_REGEX.match(name)
+    if match is None:
+        return None
+
+    start = calendar.timegm(time.strptime(match.group(1), UPLOAD_BUCKET_FORMAT))
+
+    return start, start + int(match.group(2))
+
+
+def get_expired_buckets(storage):
+    """ Returns the prefixes of the buckets in THOR_UPLOAD_TO whose files were all uploaded before the expiry.
+    """
+    root = get_upload_path()
+
+    try:
+        dirs = storage.listdir(root)[0]
+    except (OSError, NotImplementedError):
+        return []
+
+    deadline = time.time() - min(get_expiry_time(), get_linked_expiry_time())
+    buckets = []
+
+    for name in sorted(dirs):
+        bucket = parse_upload_bucket(name)
+
+        if bucket is not None and bucket[1] <= deadline:
+            buckets.append('%s/%s' % (root, name))
+
+    return buckets
+
+
+def delete_bucket(storage, prefix):
+    """ Deletes everything below prefix, with a single rmtree on local storages or with the storage's
+        `delete_prefix(prefix)` method if it has one (it should return the names it couldn't delete).
+
+    :returns: list of names that couldn't be deleted.
+    """
+    if storage_has_path(storage):
+        failed = []
+
+        def on_error(func, path, exc_info):
+            logging.warning('Failed to delete %s from storage: %s', path, exc_info[1])
+            failed.append(path)
+
+        shutil.rmtree(storage.path(prefix), onerror=on_error)
+        return failed
+
+    delete_prefix = getattr(storage, 'delete_prefix', None)
+    if callable(delete_prefix):
+        return list(delete_prefix(prefix) or [])
+
+    return delete_stored_files(storage, list_stored_names(storage, prefix))
+
+
+class TemporaryFileCleaner(object):
+    """ Deletes expired TemporaryFileWrapper objects in batches, ordered by (modified, id).
+
+        Rows are deleted in bulk without post_delete signals, the names of their files are then
+        passed to the storage deletion stage. Each run is bounded by `max_runtime` (seconds) and
+        can be continued from `cursor` (the (modified, id) of the last handled row).
+
+        With THOR_UPLOAD_BUCKET_SIZE the time buckets where every row has expired are dropped
+        first, with one delete per bucket. Buckets that still have fresh rows are left to the
+        per-row cleanup.
+    """
+
+    def __init__(self, batch_size=1000, max_runtime=None, dry_run=False, cursor=None):
+        self.batch_size = batch_size
+        self.max_runtime = max_runtime
+        self.dry_run = dry_run
+        self.cursor = cursor
+
+        self.deleted = 0
+        self.buckets = 0
+        self.failed = []
+        self.finished = False
+
+    def get_batch(self, queryset):
+        if self.cursor is not None:
+            modified, pk = self.cursor
+            queryset = queryset.filter(Q(modified__gt=modified) | Q(modified=modified, pk__gt=pk))
+
+        return list(queryset.order_by('modified', 'pk').values_list('pk', 'modified', 'file', 'content_type')[:self.batch_size])
+
+    def delete_batch(self, queryset, batch):
+        pks = [row[0] for row in batch]
+
+        with timer('cleanup.delete_rows'):
+            raw_delete(queryset.filter(pk__in=pks))
+
+            # The delete checks the expiry again, so rows that were used after they were selected are kept
+            kept = set(TemporaryFileWrapper.objects.filter(pk__in=pks).values_list('pk', flat=True))
+
+        rows = [row for row in batch if row[0] not in kept]
+        names = [name for pk, modified, file_name, content_type in rows for name in get_stored_names(file_name, content_type)]
+
+        with timer('cleanup.delete_files'):
+            failed = delete_stored_files(get_temporary_storage(), names)
+
+        increment('cleanup.deleted', len(rows))
+        increment('cleanup.failed', len(failed))
+
+        self.deleted += len(rows)
+        self.failed += failed
+
+    def drop_buckets(self, queryset, started):
+        storage = get_temporary_storage()
+
+        for prefix in get_expired_buckets(storage):
+            if self.max_runtime is not None and time.time() - started >= self.max_runtime:
+                break
+
+            rows = TemporaryFileWrapper.objects.filter(file__startswith=prefix + '/')
+            if rows.exclude(pk__in=queryset.values('pk')).exists():
+                # Mixed bucket, the expired rows are handled one by one
+                continue
+
+            if self.dry_run:
+                # The rows are counted by the per-row cleanup
+                self.buckets += 1
+                continue
+
+            with timer('cleanup.delete_rows'):
+                deleted = raw_delete(queryset.filter(file__startswith=prefix + '/'))
+
+            self.deleted += deleted
+            increment('cleanup.deleted', deleted)
+
+            if rows.exists():
+                # A row was used after the check, the files of the deleted rows are left to reconcile_temporary_files
+                continue
+
+            with timer('cleanup.delete_bucket'):
+                failed = delete_bucket(storage, prefix)
+
+            increment('cleanup.buckets')
+            increment('cleanup.failed', len(failed))
+
+            self.buckets += 1
+            self.failed += failed
+
+    def run(self):
+        with timer('cleanup.run'):
+            return self.clean()
+
+    def clean(self):
+        started = time.time()
+        queryset = get_stale_files()
+
+        if get_upload_bucket_size():
+            self.drop_buckets(queryset, started)
+
+        while self.max_runtime is None or time.time() - started < self.max_runtime:
+            batch = self.get_batch(queryset)
+            if not batch:
+                self.finished = True
+                break
+
+            self.cursor = batch[-1][1], batch[-1][0]
+
+            if self.dry_run:
+                self.deleted += len(batch)
+            else:
+                self.delete_batch(queryset, batch)
+
+            logging.debug('clean_temporary_files: Handled %d TemporaryFileWrapper objects.', self.deleted)
+
+        if self.finished and not self.dry_run:
+            # Unfinished chunked uploads expire like unlinked files
+            stale_delta = timezone.now() - datetime.timedelta(seconds=get_expiry_time())
+            ChunkedUpload.objects.filter(modified__lte=stale_delta).delete()
+
+            PromotionTask.objects.filter(state=PromotionTask.DONE, modified__lte=stale_delta).delete()
+
+        return self
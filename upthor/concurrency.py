@@ -0,0 +1,69 @@
+import threading
+import time
+
+from upthor.models import get_max_concurrent_uploads
+
+
+class UploadSlots(object):
+    """ Bounds how many uploads are processed (validated, stored and deduplicated) at once.
+
+        Like a semaphore, but acquire takes a timeout on every python version.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.condition:
+            while self.used >= self.size:
+                if deadline is None:
+                    self.condition.wait()
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                self.condition.wait(remaining)
+
+            self.used += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.used -= 1
+            self.condition.notify()
+
+    def resize(self, size):
+        """ Changes how many slots there are, slots that are in use stay counted and are released to this object.
+        """
+        with self.condition:
+            self.size = size
+            self.condition.notify_all()
+
+
+_upload_slots = None
+_upload_slots_lock = threading.Lock()
+
+
+def get_upload_slots():
+    """ Returns the UploadSlots of this process, or None if THOR_MAX_CONCURRENT_UPLOADS isn't set.
+    """
+    global _upload_slots
+
+    size = get_max_concurrent_uploads()
+    if not size:
+        return None
+
+    with _upload_slots_lock:
+        if _upload_slots is None:
+            _upload_slots = UploadSlots(size)
+        elif _upload_slots.size != size:
+            # Replacing the object would let uploads in flight release slots of the new one
+            _upload_slots.resize(size)
+
+        return _upload_slots
@@ -13,4 +13,4 @@ else:
         code = 'upthor.CleanTemporaryFiles'
 
         def do(self):
-            Command.clean_temporary_files()
+            Command().clean_temporary_files()
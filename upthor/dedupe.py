@@ -0,0 +1,119 @@
+from django.db import IntegrityError, connections, transaction
+from django.db.models import AutoField, signals
+from django.utils import timezone
+
+from upthor.metrics import increment
+from upthor.storage import delete_stored_files
+
+
+def supports_upsert(connection):
+    """ True if the backend supports `INSERT ... ON CONFLICT ... RETURNING` (PostgreSQL 9.5+, SQLite 3.35+).
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 35, 0)
+
+    return False
+
+
+def upsert(instance, using):
+    """ Inserts instance, or marks the row with the same md5sum unlinked (with the content type of instance), in one query.
+
+    :returns: (pk, file name, content type) of the row that holds the content.
+    """
+    model = instance.__class__
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+
+    fields = [x for x in model._meta.local_concrete_fields if not isinstance(x, AutoField)]
+    values = [x.get_db_prep_save(x.pre_save(instance, True), connection) for x in fields]
+
+    sql = 'INSERT INTO %(table)s (%(columns)s) VALUES (%(values)s) ON CONFLICT (%(md5sum)s) ' \
+          'DO UPDATE SET %(linked)s = %%s, %(modified)s = EXCLUDED.%(modified)s, ' \
+          '%(content_type)s = EXCLUDED.%(content_type)s ' \
+          'RETURNING %(pk)s, %(file)s, %(content_type)s' % {
+              'table': quote_name(model._meta.db_table),
+              'columns': ', '.join(quote_name(x.column) for x in fields),
+              'values': ', '.join(['%s'] * len(fields)),
+              'md5sum': quote_name('md5sum'),
+              'linked': quote_name('linked'),
+              'modified': quote_name('modified'),
+              'pk': quote_name(model._meta.pk.column),
+              'file': quote_name('file'),
+              'content_type': quote_name('content_type'),
+          }
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, values + [False])
+        return cursor.fetchone()
+
+
+def insert_or_reuse(instance, using, retries=3):
+    """ Saves a new TemporaryFileWrapper, uploads of content that is already stored reuse the existing row.
+
+        Concurrent uploads of the same content end up with the row of whichever insert won, the files
+        the others stored are removed again. Reused rows get the content type of instance, like saving a
+        duplicate always did.
+
+        pre_save and post_save are sent like Model.save does, `created` is False if a row was reused.
+    """
+    model = instance.__class__
+    connection = connections[using]
+
+    if supports_upsert(connection):
+        signals.pre_save.send(sender=model, instance=instance, raw=False, using=using, update_fields=None)
+
+        pk, name, content_type = upsert(instance, using)
+        instance._state.db = using
+
+        created = name == instance.file.name
+        increment('dedupe.miss' if created else 'dedupe.hit')
+
+        reuse_row(instance, pk, name)
+        signals.post_save.send(sender=model, instance=instance, created=created, update_fields=None, raw=False, using=using)
+
+        return instance
+
+    for attempt in range(retries):
+        try:
+            # Sends pre_save and post_save
+            with transaction.atomic(using=using):
+                instance.save_base(using=using, force_insert=True)
+
+            increment('dedupe.miss')
+            return instance
+
+        except IntegrityError:
+            existing = model.objects.using(using).filter(md5sum=instance.md5sum).values_list('pk', 'file').first()
+            if existing is None:
+                # The other row was removed meanwhile (e.g. cleaned up), try to insert again
+                continue
+
+            model.objects.using(using).filter(pk=existing[0]).update(
+                linked=False, modified=timezone.now(), content_type=instance.content_type,
+            )
+
+            increment('dedupe.hit')
+
+            reuse_row(instance, *existing)
+            signals.post_save.send(sender=model, instance=instance, created=False, update_fields=None, raw=False,
+                                   using=using)
+
+            return instance
+
+    raise IntegrityError('Failed to store TemporaryFileWrapper with md5sum %s.' % instance.md5sum)
+
+
+def reuse_row(instance, pk, name):
+    if instance.file.name and instance.file.name != name:
+        # Our copy of the content is not used by any row
+        delete_stored_files(instance.file.storage, [instance.file.name])
+
+    instance.pk = pk
+    instance._state.adding = False
+    instance.file = name
+    instance.linked = False
+
+    return instance
@@ -0,0 +1,295 @@
+import datetime
+import errno
+import logging
+import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.core.files.base import ContentFile
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.fields.files import FieldFile
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from upthor.models import PromotionTask, TemporaryFileWrapper, get_promotion_attempts, get_promotion_executor, \
+    get_promotion_retry_delay, get_promotion_timeout, get_promotion_workers
+from upthor.previews import is_image_type, promote_previews
+from upthor.promotion import get_local_path, promote_file
+from upthor.registry import registry
+from upthor.storage import storage_has_path
+
+
+def on_commit(func):
+    # Django < 1.9 has no on_commit hooks
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+_reservations = threading.local()
+
+
+def track_reservation(storage, name):
+    """ Remembers a name reserved inside a transaction until it is committed, the PromotionTask that would
+        replace the empty file is gone if the transaction is rolled back instead.
+    """
+    if not connection.in_atomic_block or not hasattr(transaction, 'on_commit'):
+        return
+
+    reservations = _reservations.__dict__.setdefault('names', [])
+    reservation = (storage, name)
+
+    reservations.append(reservation)
+    transaction.on_commit(lambda: reservations.remove(reservation))
+
+
+def discard_rolled_back_reservations():
+    """ Deletes the reserved files of this thread whose transaction ended without being committed.
+    """
+    reservations = getattr(_reservations, 'names', [])
+    if not reservations or connection.in_atomic_block:
+        return
+
+    # Committed reservations were removed by their on_commit hook
+    for storage, name in reservations:
+        logging.info('Removing reserved file %s of a rolled back transaction.', name)
+        storage.delete(name)
+
+    del reservations[:]
+
+
+@receiver(request_finished)
+def discard_after_request(sender, **kwargs):
+    discard_rolled_back_reservations()
+
+
+class SyncExecutor(object):
+    """ Copies the file right away, in the thread that saves the model. Useful in tests.
+    """
+
+    def submit(self, task):
+        run_task(task)
+
+
+class ThreadPoolExecutor(object):
+    """ Copies the files in a pool of THOR_PROMOTION_WORKERS threads once the transaction is committed.
+
+        Failed copies are submitted again after THOR_PROMOTION_RETRY_DELAY seconds, doubled for every
+        attempt, until THOR_PROMOTION_ATTEMPTS is reached.
+    """
+
+    def __init__(self):
+        self.pool = ThreadPool(get_promotion_workers())
+
+    def submit(self, task):
+        on_commit(lambda: self.run_async(task.pk))
+
+    def run_async(self, pk):
+        self.pool.apply_async(self.run, (pk, ))
+
+    def run(self, pk):
+        task = run_pending_task(pk)
+
+        if task is not None and task.state == PromotionTask.PENDING:
+            retry = threading.Timer(get_promotion_retry_delay() * 2 ** (task.attempts - 1), self.run_async, (pk, ))
+            retry.daemon = True
+            retry.start()
+
+
+class DatabaseExecutor(object):
+    """ Leaves the tasks in the database, they are run by the `process_promotions` management command.
+    """
+
+    def submit(self, task):
+        pass
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+
+    path = get_promotion_executor()
+
+    with _executor_lock:
+        if _executor is None or _executor[0] != path:
+            _executor = path, import_string(path)()
+
+        return _executor[1]
+
+
+def defer_field_file(temporary, field_file, filename):
+    """ Points field_file at a reserved name and queues the copy of the temporary file to it.
+
+        Like upthor.promotion.promote_field_file, but the copy is done by the executor of THOR_PROMOTION_EXECUTOR.
+    """
+    discard_rolled_back_reservations()
+
+    name = field_file.field.generate_filename(field_file.instance, filename)
+
+    # An empty file keeps the name taken until the copy replaces it
+    field_file.name = field_file.storage.save(name, ContentFile(b''), max_length=field_file.field.max_length)
+    track_reservation(field_file.storage, field_file.name)
+    setattr(field_file.instance, field_file.field.name, field_file.name)
+    field_file._committed = True
+
+    config = registry.get_for_model(field_file.instance, field_file.field.name)
+
+    task = PromotionTask.objects.create(
+        source_name=temporary.file.name,
+        source_content_type=temporary.content_type,
+        field_query='.'.join(config.key),
+        name=field_file.name,
+    )
+    get_executor().submit(task)
+
+    return field_file
+
+
+def replace_file(source, storage, name, shared=True):
+    """ Replaces the stored file name with the content of source, see promote_file for shared.
+    """
+    source_path = get_local_path(source)
+
+    if source_path is not None and storage_has_path(storage):
+        path = storage.path(name)
+        temp_path = '%s.upthor-%d' % (path, threading.current_thread().ident)
+
+        try:
+            os.remove(temp_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        linked = False
+
+        if shared:
+            try:
+                os.link(source_path, temp_path)
+                linked = True
+            except OSError:
+                # Different device or no hardlink support
+                pass
+
+        if not linked:
+            shutil.copyfile(source_path, temp_path)
+
+        # Renaming over the reserved file is atomic
+        os.rename(temp_path, path)
+        return
+
+    storage.delete(name)
+
+    stored_name = promote_file(source, storage, name, shared=shared)
+    if stored_name != name:
+        storage.delete(stored_name)
+        raise Exception('%s was taken while it was replaced.' % name)
+
+
+def run_task(task):
+    """ Copies the file of task, failed tasks are retried until THOR_PROMOTION_ATTEMPTS is reached.
+    """
+    task.attempts += 1
+
+    try:
+        app_label, model_name, field_name = task.field_query.split('.')
+        field = registry.get(app_label, model_name, field_name).field
+
+        source = FieldFile(None, TemporaryFileWrapper._meta.get_field('file'), task.source_name)
+        replace_file(source, field.storage, task.name, shared=not field.has_post_link)
+
+        if field.has_previews and is_image_type(task.source_content_type):
+            promote_previews(source, FieldFile(None, field, task.name))
+
+    except Exception as e:
+        logging.warning('Failed to promote %s to %s: %s', task.source_name, task.name, e)
+
+        task.state = PromotionTask.PENDING if task.attempts < get_promotion_attempts() else PromotionTask.FAILED
+        task.error = '%s' % e
+    else:
+        task.state = PromotionTask.DONE
+        task.error = ''
+
+    task.save()
+    return task
+
+
+def claim_task(pk):
+    """ Marks the task as running, returns None if another worker got it first.
+    """
+    # modified is set to tell tasks of crashed workers apart (see reclaim_stale_tasks)
+    claimed = PromotionTask.objects.filter(pk=pk, state=PromotionTask.PENDING).update(
+        state=PromotionTask.RUNNING, modified=timezone.now(),
+    )
+    if not claimed:
+        return None
+
+    return PromotionTask.objects.get(pk=pk)
+
+
+def run_pending_task(pk):
+    """ Runs the task if it is still pending, returns it or None if another worker got it first.
+    """
+    try:
+        task = claim_task(pk)
+        if task is not None:
+            run_task(task)
+
+        return task
+    finally:
+        # Pool threads don't go through the request cycle that would close it
+        connection.close()
+
+
+def reclaim_stale_tasks():
+    """ Queues the tasks that were left running for THOR_PROMOTION_TIMEOUT seconds (by a worker that crashed or
+        was restarted) again, the lost run counts as an attempt. Returns how many were reclaimed.
+    """
+    now = timezone.now()
+    stale = PromotionTask.objects.filter(
+        state=PromotionTask.RUNNING, modified__lte=now - datetime.timedelta(seconds=get_promotion_timeout()),
+    )
+
+    failed = stale.filter(attempts__gte=get_promotion_attempts() - 1).update(
+        state=PromotionTask.FAILED, attempts=F('attempts') + 1, error='Timed out.', modified=now,
+    )
+
+    return failed + stale.update(state=PromotionTask.PENDING, attempts=F('attempts') + 1, modified=now)
+
+
+def run_pending_tasks(limit=None):
+    """ Runs the pending tasks in the current thread, returns how many were run.
+
+        Tasks left running by crashed workers are reclaimed first.
+    """
+    discard_rolled_back_reservations()
+    reclaim_stale_tasks()
+
+    pks = PromotionTask.objects.filter(state=PromotionTask.PENDING).order_by('pk').values_list('pk', flat=True)
+    if limit is not None:
+        pks = pks[:limit]
+
+    count = 0
+    for pk in list(pks):
+        task = claim_task(pk)
+
+        if task is not None:
+            run_task(task)
+            count += 1
+
+    return count
+
+
+def is_promoted(field_file):
+    """ Returns False while the copy of field_file's file is still queued.
+    """
+    return not PromotionTask.objects.filter(
+        name=field_file.name, state__in=[PromotionTask.PENDING, PromotionTask.RUNNING],
+    ).exists()
@@ -3,13 +3,19 @@ import six
 import tempfile
 
 from django import forms
-from django.core.files.base import ContentFile
 from django.db import models
-from django.db.models.fields.files import ImageFileDescriptor, ImageFieldFile
+from django.db.models.signals import post_delete, post_save
+from django.db.models.fields.files import FieldFile, ImageFileDescriptor, ImageFieldFile
 from django.utils.translation import ungettext, ugettext_lazy as _
 
 from upthor.forms import allowed_type
-from upthor.models import TemporaryFileWrapper, human_readable_types
+from upthor.linking import link_temporary_file
+from upthor.metrics import increment, timer
+from upthor.models import TemporaryFileWrapper, deferred_promotion, get_temporary_wrapper, human_readable_types, \
+    use_content_addressed_storage
+from upthor.previews import is_image_type, promote_previews
+from upthor.promotion import promote_field_file
+from upthor.registry import registry
 from upthor.widgets import ThorSingleUploadWidget
 
 
@@ -23,8 +29,17 @@ class ThorFormFileField(forms.FileField):
 
     @staticmethod
     def get_content_type(the_file):
+        # Files resolved by the widget carry their wrapper
+        temporary = get_temporary_wrapper(the_file)
+        if temporary is not None:
+            return temporary.content_type
+
+        if isinstance(the_file, FieldFile) and the_file.instance is not None:
+            # File of an existing object, it was checked when it was linked
+            return None
+
         try:
-            temporary = TemporaryFileWrapper.objects.get(file=the_file)
+            temporary = TemporaryFileWrapper.objects.only('content_type').get(file=the_file)
             return temporary.content_type
 
         except TemporaryFileWrapper.DoesNotExist:
@@ -76,10 +91,16 @@ class ThorFormImageField(forms.ImageField):
 class ThorFileField(models.FileField):
     DEFAULT_FILE_TYPES = ['application/pdf', 'application/x-rar-compressed', 'application/zip']
 
+    # Downscaled previews of uploaded images are generated (see THOR_PREVIEW_SIZES)
+    has_previews = False
+
     def __init__(self, post_link=None, allowed_types=None, widget=None, get_upload_image=None,
-                 get_upload_image_url=None, **kwargs):
+                 get_upload_image_url=None, content_addressed=None, **kwargs):
 
         self.widget = widget or self.get_widget_class()
+
+        # Store files by content, defaults to THOR_CONTENT_ADDRESSED
+        self.content_addressed = use_content_addressed_storage() if content_addressed is None else content_addressed
         self.field_query = None
         self.get_upload_image = get_upload_image
         self.get_upload_image_url = get_upload_image_url
@@ -97,10 +118,33 @@ class ThorFileField(models.FileField):
 
         super(ThorFileField, self).contribute_to_class(cls, name)
 
+        # Historical models built by migrations must not replace the real ones
+        if not cls._meta.abstract and cls.__module__ != '__fake__':
+            registry.register(cls, self)
+
+            if self.content_addressed:
+                from upthor.blobs import delete_references, update_references
+
+                # Without a sender, so proxies and child models that inherit the field are handled too
+                post_save.connect(update_references, weak=False, dispatch_uid='upthor_update_references')
+                post_delete.connect(delete_references, weak=False, dispatch_uid='upthor_delete_references')
+
+    @property
+    def has_post_link(self):
+        """ True if post_link was given or overridden, its files are then copied instead of hardlinked (see
+            upthor.promotion.promote_file), so processing them in place doesn't change the temporary file that is
+            still served to deduplicated uploads.
+        """
+        return 'post_link' in self.__dict__ or \
+            six.get_unbound_function(type(self).post_link) is not six.get_unbound_function(ThorFileField.post_link)
+
     def post_link(self, real_instance, temporary_instance, raw_file):
         """ This function is used to provide a way for
             developers to do some needed post processing for files.
 
+            Fields with a custom post_link get a copy of the temporary file instead of a hardlink, so the
+            file can be changed in place.
+
         :param real_instance: An instance of the model that will be saved to the database.
         :param temporary_instance: An instance of TemporaryImageWrapper.
         :param raw_file: The raw file which was uploaded, can be None.
@@ -153,6 +197,10 @@ class ThorFileField(models.FileField):
             return None
 
     def get_field_pointer(self, model_instance):
+        config = registry.get_for_model(model_instance, self.field_query[1])
+        if config is not None:
+            return config.field
+
         for field in model_instance._meta.fields:
             if field.name == self.field_query[1]:
                 if not isinstance(field, (ThorFileField, ThorImageField)):
@@ -162,28 +210,46 @@ class ThorFileField(models.FileField):
 
         return None
 
+    def promote_temporary(self, model_instance, the_file, temporary):
+        """ Moves the file of the TemporaryFileWrapper temporary to its permanent location.
+        """
+        path, filename = os.path.split(the_file.name)
+        new_file = self.attr_class(model_instance, self.get_field_pointer(model_instance), filename)
+
+        if self.content_addressed:
+            # Objects with the same content share one file
+            from upthor.blobs import store_blob
+            return store_blob(temporary, new_file, filename)
+
+        if deferred_promotion():
+            # The copy is done by the executor of THOR_PROMOTION_EXECUTOR
+            from upthor.deferred import defer_field_file
+            return defer_field_file(temporary, new_file, filename)
+
+        real_file = promote_field_file(the_file, new_file, filename)
+
+        if self.has_previews and is_image_type(temporary.content_type):
+            promote_previews(temporary.file, real_file)
+
+        return real_file
+
     def pre_save(self, model_instance, add):
         the_file = super(models.FileField, self).pre_save(model_instance, add)
         real_file = the_file
+        temporary = get_temporary_wrapper(the_file) if the_file else None
 
         # If the file provided is a Temporary One
-        if the_file and hasattr(the_file, 'instance') and isinstance(the_file.instance, TemporaryFileWrapper):
-            path, filename = os.path.split(the_file.name)
-            new_file = self.attr_class(model_instance, self.get_field_pointer(model_instance), filename)
-
-            image_file = ContentFile(the_file.file.read(), the_file.name)
-            new_file.save(filename, image_file, save=False)
+        if temporary is not None:
+            with timer('promotion'):
+                real_file = self.promote_temporary(model_instance, the_file, temporary)
 
-            real_file = new_file
+            increment('promotion.bytes', temporary.size or 0)
 
         elif the_file and tempfile.gettempdir() in the_file.name:
             path, filename = os.path.split(the_file.name)
             new_file = self.attr_class(model_instance, self.get_field_pointer(model_instance), filename)
 
-            image_file = ContentFile(the_file.file.read(), the_file.name)
-            new_file.save(filename, image_file, save=False)
-
-            real_file = new_file
+            real_file = promote_field_file(the_file, new_file, filename)
 
         elif the_file and not the_file._committed:
             # TODO: Unit test the if change, it might not be a stable change.
@@ -193,16 +259,16 @@ class ThorFileField(models.FileField):
             # (e.g. a plain image upload in admin)
             the_file.save(the_file.name, the_file, save=False)
 
-        if self.post_link(model_instance, the_file.instance if the_file else the_file, real_file):
-            if the_file and isinstance(the_file.instance, TemporaryFileWrapper):
-                the_file.instance.linked = True
-                the_file.instance.save()
+        if self.post_link(model_instance, temporary or (the_file.instance if the_file else the_file), real_file):
+            if temporary is not None:
+                link_temporary_file(temporary)
 
         return real_file
 
 
 class ThorImageField(ThorFileField, models.ImageField):
     DEFAULT_FILE_TYPES = ['type:image']
+    has_previews = True
 
     attr_class = ImageFieldFile
     descriptor_class = ImageFileDescriptor
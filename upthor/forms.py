@@ -12,6 +12,26 @@ def allowed_type(file_type, allowed_types):
     return force_text(file_type, 'utf8') in allowed_types
 
 
+def validate_upload(size, content_type, allowed_types):
+    """ Raises ValidationError if a file of this size and type can't be uploaded to the field.
+    """
+    if size > get_max_file_size():
+        raise forms.ValidationError(get_size_error())
+
+    if not allowed_type(content_type, allowed_types):
+        from upthor.fields import ThorFormFileField
+        ThorFormFileField.file_type_error(content_type, allowed_types)
+
+
+def validate_uploaded_file(uploaded_file, allowed_types):
+    """ Like validate_upload, also rejects files that upthor.uploadhandler.ThorUploadHandler didn't keep.
+    """
+    validate_upload(uploaded_file.size, uploaded_file.content_type, allowed_types)
+
+    if getattr(uploaded_file, 'rejected', False):
+        raise forms.ValidationError(force_text(_("Couldn't read uploaded file")))
+
+
 class TemporaryFileForm(forms.ModelForm):
     class Meta:
         model = TemporaryFileWrapper
@@ -21,28 +41,56 @@ class TemporaryFileForm(forms.ModelForm):
     def __init__(self, real_field, *args, **kwargs):
         self.allowed_types = real_field.allowed_types
         self.content_type = 'application/unknown'
+        self.owner = kwargs.pop('owner', '')
 
         super(TemporaryFileForm, self).__init__(*args, **kwargs)
 
     def clean_file(self):
         uploaded_file = self.cleaned_data.get('file', False)
-        if uploaded_file:
-            if uploaded_file._size > get_max_file_size():
-                raise forms.ValidationError(get_size_error())
-        else:
+        if not uploaded_file:
             raise forms.ValidationError(force_text(_("Couldn't read uploaded file")))
 
-        if not allowed_type(uploaded_file.content_type, self.allowed_types):
-            from upthor.fields import ThorFormFileField
-            ThorFormFileField.file_type_error(uploaded_file.content_type, self.allowed_types)
-
-        if uploaded_file:
-            self.content_type = uploaded_file.content_type
+        validate_uploaded_file(uploaded_file, self.allowed_types)
+        self.content_type = uploaded_file.content_type
 
         return uploaded_file
 
     def save(self, commit=True):
-        inst = super(TemporaryFileForm, self).save(commit=False)
+        uploaded_file = self.cleaned_data['file']
+        md5sum = getattr(uploaded_file, 'md5sum', None)
+
+        if md5sum is None:
+            inst = super(TemporaryFileForm, self).save(commit=False)
+            inst.content_type = self.content_type
+            inst.size = uploaded_file.size
+            inst.owner = self.owner
+
+            return super(TemporaryFileForm, self).save(commit=True)
+
+        # The file was already hashed (and possibly stored) by ThorUploadHandler
+        if uploaded_file.duplicate is not None:
+            inst = uploaded_file.duplicate
+            inst.linked = False
+
+        else:
+            inst = super(TemporaryFileForm, self).save(commit=False)
+
+            if uploaded_file.storage_name is not None:
+                # Point at the stored bytes instead of writing them again
+                inst.file = uploaded_file.storage_name
+
+            inst.size = uploaded_file.size
+            inst.owner = self.owner
+
+        inst.md5sum = md5sum
         inst.content_type = self.content_type
+        inst.save(rehash=False)
+
+        self.instance = inst
+        return inst
 
-        return super(TemporaryFileForm, self).save(commit=True)
+    def discard(self):
+        """ Removes uploaded bytes that were stored before the form was validated.
+        """
+        from upthor.uploadhandler import discard_uploaded_files
+        discard_uploaded_files(self.files)
@@ -0,0 +1,119 @@
+import hashlib
+import io
+import mmap
+import os
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from upthor.models import get_hash_algorithm, get_hash_buffer_size
+from upthor.promotion import get_local_path
+
+
+# Name -> callable that returns a new hash object (with update and hexdigest), see THOR_HASH_ALGORITHM
+HASH_ALGORITHMS = {}
+
+
+def register_hash_algorithm(name, factory):
+    """ Makes factory usable as THOR_HASH_ALGORITHM, its hexdigest must not be longer than 64 characters.
+    """
+    HASH_ALGORITHMS[name] = factory
+
+
+register_hash_algorithm('md5', hashlib.md5)
+register_hash_algorithm('sha1', hashlib.sha1)
+register_hash_algorithm('sha256', hashlib.sha256)
+
+if hasattr(hashlib, 'blake2b'):
+    # 128 bit digests take as much space as md5 ones
+    register_hash_algorithm('blake2b', lambda: hashlib.blake2b(digest_size=16))
+
+try:
+    import xxhash
+except ImportError:
+    pass
+else:
+    if hasattr(xxhash, 'xxh128'):
+        register_hash_algorithm('xxh128', xxhash.xxh128)
+
+
+def new_hash(algorithm=None):
+    """ Returns a new hash object of algorithm, defaults to THOR_HASH_ALGORITHM.
+    """
+    algorithm = algorithm or get_hash_algorithm()
+
+    try:
+        factory = HASH_ALGORITHMS[algorithm]
+    except KeyError:
+        raise ImproperlyConfigured('Unknown hash algorithm %r, register it with upthor.hashing.register_hash_algorithm.' %
+                                   algorithm)
+
+    return factory()
+
+
+_buffers = threading.local()
+
+
+def get_buffer(size):
+    """ Returns a bytearray of size that is reused by the later calls of the same thread.
+    """
+    buf = getattr(_buffers, 'buffer', None)
+
+    if buf is None or len(buf) != size:
+        buf = _buffers.buffer = bytearray(size)
+
+    return buf
+
+
+def hash_path(path, file_hash):
+    """ Feeds the file at path to file_hash in big slices, hashlib releases the GIL while it hashes them.
+
+        Files of at least THOR_HASH_BUFFER_SIZE bytes are memory mapped and hashed in one call, smaller
+        files (and hashes that don't accept buffers) are read into a reused buffer.
+    """
+    buffer_size = get_hash_buffer_size()
+
+    with io.open(path, 'rb') as source:
+        if os.fstat(source.fileno()).st_size >= buffer_size:
+            try:
+                mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                mapped = None
+
+            if mapped is not None:
+                try:
+                    file_hash.update(mapped)
+                    return file_hash
+                except TypeError:
+                    pass
+                finally:
+                    mapped.close()
+
+        buf = get_buffer(buffer_size)
+        view = memoryview(buf)
+
+        while True:
+            size = source.readinto(buf)
+            if not size:
+                break
+
+            file_hash.update(view[:size])
+
+    return file_hash
+
+
+def hash_file(the_file, algorithm=None):
+    """ Returns the hex digest of the_file, files on the local filesystem are hashed with hash_path.
+
+        Files of other storages are streamed with their chunks().
+    """
+    file_hash = new_hash(algorithm)
+    path = get_local_path(the_file)
+
+    if path is not None:
+        return hash_path(path, file_hash).hexdigest()
+
+    for chunk in the_file.chunks():
+        file_hash.update(chunk)
+
+    return file_hash.hexdigest()
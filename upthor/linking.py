@@ -0,0 +1,45 @@
+import threading
+from contextlib import contextmanager
+
+from upthor.models import TemporaryFileWrapper
+
+_state = threading.local()
+
+
+def link_temporary_file(temporary):
+    """ Marks temporary linked, right away or when the surrounding `batch_links` block ends.
+    """
+    pending = getattr(_state, 'pending', None)
+
+    if pending is None:
+        temporary.mark_linked()
+    else:
+        pending.append(temporary)
+
+
+@contextmanager
+def batch_links():
+    """ Collects the temporary files linked by ThorFileField.pre_save and marks them linked with one query.
+
+        Usage:
+
+            with batch_links():
+                formset.save()
+
+        Nothing is marked linked if the block raises.
+    """
+    if getattr(_state, 'pending', None) is not None:
+        # Already collected by an outer block
+        yield
+        return
+
+    _state.pending = []
+
+    try:
+        yield
+        pending, _state.pending = _state.pending, None
+
+        if pending:
+            TemporaryFileWrapper.mark_all_linked(pending)
+    finally:
+        _state.pending = None
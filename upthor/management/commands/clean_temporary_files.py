@@ -1,31 +1,65 @@
-import datetime
 import logging
 
-from django.core.management.base import NoArgsCommand
-from django.db.models import Q
-from django.utils import timezone
-from django.utils.encoding import force_text
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
 
-from upthor.models import TemporaryFileWrapper, get_linked_expiry_time, get_expiry_time
+from upthor.cleanup import TemporaryFileCleaner
 
 
-class Command(NoArgsCommand):
+class Command(BaseCommand):
     help = 'Cleans up TemporaryFileWrapper objects by deleting the ' \
            'ones that are older than the timedelta defined in THOR_EXPIRE_TIME.'
 
-    def clean_temporary_files(self):
-        linked_stale_delta = timezone.now() - datetime.timedelta(seconds=get_linked_expiry_time())
-        stale_delta = timezone.now() - datetime.timedelta(seconds=get_expiry_time())
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many rows to delete at once.')
+        parser.add_argument('--max-runtime', type=float, default=None,
+                            help='Stop starting new batches after this many seconds.')
+        parser.add_argument('--cursor', default=None,
+                            help='Continue after "<modified>,<id>" printed by a previous run.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report how many rows would be deleted.')
 
-        files = TemporaryFileWrapper.objects.filter(Q(linked=True, modified__lte=linked_stale_delta) |
-                                                    Q(linked=False, modified__lte=stale_delta))
+    @staticmethod
+    def parse_cursor(cursor):
+        if cursor is None:
+            return None
 
-        logging.info('clean_temporary_files: Removing %d TemporaryFileWrapper objects from DB.', files.count())
-        self.stdout.write('clean_temporary_files: Removing %d TemporaryFileWrapper objects from DB.' % files.count())
-        logging.debug('clean_temporary_files: Removing TemporaryFileWrapper objects [%s].',
-                      ', '.join([force_text(x) for x in files.values_list('id', flat=True)]))
+        modified, _, pk = cursor.rpartition(',')
+        modified = parse_datetime(modified)
 
-        files.delete()
+        if modified is None or not pk.isdigit():
+            raise CommandError('Cursor should be in the format "<modified>,<id>".')
+
+        return modified, int(pk)
+
+    def clean_temporary_files(self, batch_size=1000, max_runtime=None, cursor=None, dry_run=False):
+        cleaner = TemporaryFileCleaner(batch_size=batch_size, max_runtime=max_runtime, dry_run=dry_run,
+                                       cursor=cursor).run()
+
+        action = 'Would remove' if dry_run else 'Removed'
+        logging.info('clean_temporary_files: %s %d TemporaryFileWrapper objects from DB.', action, cleaner.deleted)
+        self.stdout.write('clean_temporary_files: %s %d TemporaryFileWrapper objects from DB.' % (action, cleaner.deleted))
+
+        if cleaner.buckets:
+            logging.info('clean_temporary_files: %s %d expired upload buckets.', action, cleaner.buckets)
+            self.stdout.write('clean_temporary_files: %s %d expired upload buckets.' % (action, cleaner.buckets))
+
+        if cleaner.failed:
+            logging.warning('clean_temporary_files: Failed to delete %d files from storage.', len(cleaner.failed))
+            self.stdout.write('clean_temporary_files: Failed to delete %d files from storage.' % len(cleaner.failed))
+
+        if not cleaner.finished and cleaner.cursor is not None:
+            self.stdout.write('clean_temporary_files: Stopped early, continue with --cursor="%s,%d".' % (
+                cleaner.cursor[0].isoformat(), cleaner.cursor[1],
+            ))
+
+        return cleaner
 
     def handle(self, *args, **options):
-        self.clean_temporary_files()
+        self.clean_temporary_files(
+            batch_size=options['batch_size'],
+            max_runtime=options['max_runtime'],
+            cursor=self.parse_cursor(options['cursor']),
+            dry_run=options['dry_run'],
+        )
@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from upthor.blobs import collect_blobs
+
+
+class Command(BaseCommand):
+    help = 'Removes content addressed files (THOR_CONTENT_ADDRESSED) that are not used by any object ' \
+           'and were not used during THOR_BLOB_GRACE_PERIOD.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-period', type=int, default=None,
+                            help='Keep unused files that were used during this many seconds.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report how many files would be removed.')
+
+    def handle(self, *args, **options):
+        removed, failed = collect_blobs(grace_period=options['grace_period'], dry_run=options['dry_run'])
+
+        action = 'Would remove' if options['dry_run'] else 'Removed'
+        logging.info('gc_blobs: %s %d unused files.', action, len(removed))
+        self.stdout.write('gc_blobs: %s %d unused files.' % (action, len(removed)))
+
+        if failed:
+            logging.warning('gc_blobs: Failed to delete %d files from storage.', len(failed))
+            self.stdout.write('gc_blobs: Failed to delete %d files from storage.' % len(failed))
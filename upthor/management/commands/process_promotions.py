@@ -0,0 +1,27 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from upthor.deferred import run_pending_tasks
+from upthor.models import PromotionTask
+
+
+class Command(BaseCommand):
+    help = 'Copies the temporary files queued by deferred promotion (THOR_DEFERRED_PROMOTION) to their ' \
+           'permanent location.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=None,
+                            help='How many files to copy at most.')
+        parser.add_argument('--retry-failed', action='store_true', default=False,
+                            help='Queue the files that failed THOR_PROMOTION_ATTEMPTS times again.')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            PromotionTask.objects.filter(state=PromotionTask.FAILED).update(state=PromotionTask.PENDING, attempts=0)
+
+        count = run_pending_tasks(limit=options['limit'])
+        failed = PromotionTask.objects.filter(state=PromotionTask.FAILED).count()
+
+        logging.info('process_promotions: Handled %d queued files, %d failed for good.', count, failed)
+        self.stdout.write('process_promotions: Handled %d queued files, %d failed for good.' % (count, failed))
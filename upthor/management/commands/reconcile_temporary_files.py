@@ -0,0 +1,52 @@
+import logging
+
+from django.core.management.base import BaseCommand
+
+from upthor.reconcile import OrphanReconciler
+
+
+class Command(BaseCommand):
+    help = 'Removes files in THOR_UPLOAD_TO that don\'t belong to any TemporaryFileWrapper, ' \
+           'e.g. because deleting them failed or their rows were deleted with raw SQL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='How many prefix directories to handle at once, 0 handles them in this thread.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='How many names to check against the database at once.')
+        parser.add_argument('--grace-period', type=int, default=None,
+                            help='Keep files that were changed during this many seconds, defaults to THOR_EXPIRE_TIME.')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File that remembers the handled prefix directories, so runs continue where the last one stopped.')
+        parser.add_argument('--max-runtime', type=float, default=None,
+                            help='Stop starting new prefix directories after this many seconds.')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report the orphaned files.')
+
+    def handle(self, *args, **options):
+        reconciler = OrphanReconciler(
+            workers=options['workers'],
+            batch_size=options['batch_size'],
+            grace_period=options['grace_period'],
+            dry_run=options['dry_run'],
+            checkpoint=options['checkpoint'],
+            max_runtime=options['max_runtime'],
+        ).run()
+
+        if options['verbosity'] > 1:
+            for name in reconciler.orphans:
+                self.stdout.write(name)
+
+        action = 'Would remove' if options['dry_run'] else 'Removed'
+        logging.info('reconcile_temporary_files: Checked %d files, %s %d orphans.', reconciler.checked, action.lower(),
+                     len(reconciler.orphans))
+        self.stdout.write('reconcile_temporary_files: Checked %d files, %s %d orphans and %d empty directories.' % (
+            reconciler.checked, action.lower(), len(reconciler.orphans), reconciler.pruned,
+        ))
+
+        if reconciler.failed:
+            logging.warning('reconcile_temporary_files: Failed to delete %d files from storage.', len(reconciler.failed))
+            self.stdout.write('reconcile_temporary_files: Failed to delete %d files from storage.' % len(reconciler.failed))
+
+        if not reconciler.finished:
+            self.stdout.write('reconcile_temporary_files: Stopped early, run again with the same --checkpoint to continue.')
@@ -0,0 +1,88 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+
+from upthor.models import StoredBlob, TemporaryFileWrapper, get_file_hash, get_hash_algorithm
+from upthor.registry import registry
+
+
+class Command(BaseCommand):
+    help = 'Hashes TemporaryFileWrapper and StoredBlob objects that were hashed with another algorithm ' \
+           'than THOR_HASH_ALGORITHM again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='How many rows to load at once.')
+
+    @staticmethod
+    def get_batches(queryset, batch_size):
+        last_pk = 0
+
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not batch:
+                return
+
+            last_pk = batch[-1].pk
+            yield batch
+
+    def rehash_temporary_files(self, batch_size):
+        algorithm = get_hash_algorithm()
+        rehashed = merged = failed = 0
+
+        for batch in self.get_batches(TemporaryFileWrapper.objects.exclude(hash_algorithm=algorithm), batch_size):
+            for instance in batch:
+                try:
+                    file_hash = get_file_hash(instance.file)
+                except (IOError, OSError) as e:
+                    logging.warning('rehash_files: Failed to read %s: %s', instance.file.name, e)
+                    failed += 1
+                    continue
+                finally:
+                    instance.file.close()
+
+                try:
+                    with transaction.atomic():
+                        TemporaryFileWrapper.objects.filter(pk=instance.pk).update(md5sum=file_hash, hash_algorithm=algorithm)
+                except IntegrityError:
+                    # The same content was uploaded again after the algorithm was changed
+                    instance.delete()
+                    merged += 1
+                else:
+                    rehashed += 1
+
+        return rehashed, merged, failed
+
+    def rehash_blobs(self, batch_size):
+        algorithm = get_hash_algorithm()
+        rehashed = failed = 0
+
+        for batch in self.get_batches(StoredBlob.objects.exclude(hash_algorithm=algorithm), batch_size):
+            for blob in batch:
+                config = registry.get(*blob.field_query.split('.'))
+
+                try:
+                    the_file = config.field.attr_class(None, config.field, blob.name)
+                    file_hash = get_file_hash(the_file)
+                    the_file.close()
+
+                    with transaction.atomic():
+                        StoredBlob.objects.filter(pk=blob.pk).update(md5sum=file_hash, hash_algorithm=algorithm)
+                except (AttributeError, IOError, OSError, IntegrityError) as e:
+                    # Blobs that can't be hashed again are just not reused for new uploads
+                    logging.warning('rehash_files: Failed to rehash %s: %s', blob.name, e)
+                    failed += 1
+                else:
+                    rehashed += 1
+
+        return rehashed, failed
+
+    def handle(self, *args, **options):
+        rehashed, merged, failed = self.rehash_temporary_files(options['batch_size'])
+        self.stdout.write('rehash_files: Rehashed %d TemporaryFileWrapper objects, removed %d duplicates, %d failed.' % (
+            rehashed, merged, failed,
+        ))
+
+        rehashed, failed = self.rehash_blobs(options['batch_size'])
+        self.stdout.write('rehash_files: Rehashed %d StoredBlob objects, %d failed.' % (rehashed, failed))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from upthor.usage import get_owner_stats, get_storage_stats
+
+
+class Command(BaseCommand):
+    help = 'Shows how many temporary files there are and how many bytes they take.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owners', type=int, default=10,
+                            help='How many of the owners with the most unlinked bytes to list.')
+
+    def handle(self, *args, **options):
+        stats = get_storage_stats()
+
+        self.stdout.write('Total: %d files, %d bytes' % (stats['files'], stats['bytes']))
+        self.stdout.write('Linked: %d files, %d bytes' % (stats['linked_files'], stats['linked_bytes']))
+        self.stdout.write('Unlinked: %d files, %d bytes' % (stats['unlinked_files'], stats['unlinked_bytes']))
+
+        if stats['unknown_size']:
+            self.stdout.write('Unknown size: %d files' % stats['unknown_size'])
+
+        if options['owners']:
+            for owner, files, size in get_owner_stats(limit=options['owners']):
+                self.stdout.write('Owner %s: %d files, %d bytes' % (owner, files, size))
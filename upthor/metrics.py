@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.utils.module_loading import import_string
+
+from upthor.models import get_metrics_backend
+
+
+class NullMetrics(object):
+    """ Discards everything, the default THOR_METRICS.
+
+        Other sinks implement the same two methods, e.g. to forward the values to statsd or Prometheus.
+    """
+
+    def timing(self, name, seconds):
+        pass
+
+    def increment(self, name, value=1):
+        pass
+
+
+class LoggingMetrics(NullMetrics):
+    """ Writes every value to the `upthor.metrics` logger.
+    """
+    logger = logging.getLogger('upthor.metrics')
+
+    def timing(self, name, seconds):
+        self.logger.info('%s %.3fms', name, seconds * 1000)
+
+    def increment(self, name, value=1):
+        self.logger.info('%s +%d', name, value)
+
+
+class MemoryMetrics(NullMetrics):
+    """ Keeps the values in memory, useful in tests.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = defaultdict(list)
+        self.counters = defaultdict(int)
+
+    def timing(self, name, seconds):
+        with self.lock:
+            self.timings[name].append(seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    global _metrics
+
+    path = get_metrics_backend()
+
+    with _metrics_lock:
+        if _metrics is None or _metrics[0] != path:
+            _metrics = path, import_string(path)()
+
+        return _metrics[1]
+
+
+def increment(name, value=1):
+    get_metrics().increment('upthor.%s' % name, value)
+
+
+@contextmanager
+def timer(name):
+    """ Reports how long the block took as the timing `upthor.<name>`, also when it raises.
+    """
+    metrics = get_metrics()
+    started = time.time()
+
+    try:
+        yield
+    finally:
+        metrics.timing('upthor.%s' % name, time.time() - started)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 13:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import upthor.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upthor', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkedUpload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.CharField(default=upthor.models.new_upload_id, max_length=32, unique=True)),
+                ('field_query', models.CharField(max_length=255)),
+                ('file_name', models.CharField(max_length=255)),
+                ('content_type', models.CharField(default='application/unknown', max_length=128, verbose_name='content_type')),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
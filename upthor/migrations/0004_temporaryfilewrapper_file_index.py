@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 13:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import upthor.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upthor', '0003_temporaryfilewrapper_modified_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='temporaryfilewrapper',
+            name='file',
+            field=models.FileField(db_index=True, upload_to=upthor.models.thor_upload_file_name),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 13:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upthor', '0004_temporaryfilewrapper_file_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromotionTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_name', models.CharField(db_index=True, max_length=255)),
+                ('source_content_type', models.CharField(default='application/unknown', max_length=128)),
+                ('field_query', models.CharField(max_length=255)),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('state', models.CharField(choices=[
+                    ('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'),
+                ], db_index=True, default='pending', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 13:35
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upthor', '0005_promotiontask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlobReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=128)),
+                ('object_id', models.CharField(max_length=64)),
+                ('field_name', models.CharField(max_length=64)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('md5sum', models.CharField(max_length=36)),
+                ('storage_key', models.CharField(max_length=255)),
+                ('name', models.CharField(db_index=True, max_length=255)),
+                ('content_type', models.CharField(default='application/unknown', max_length=128, verbose_name='content_type')),
+                ('field_query', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('modified', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='storedblob',
+            unique_together=set([('md5sum', 'storage_key')]),
+        ),
+        migrations.AddField(
+            model_name='blobreference',
+            name='blob',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='references', to='upthor.StoredBlob'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='blobreference',
+            unique_together=set([('model', 'object_id', 'field_name')]),
+        ),
+    ]
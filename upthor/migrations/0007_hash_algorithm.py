@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 13:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import upthor.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upthor', '0006_storedblob'),
+    ]
+
+    operations = [
+        # Existing rows were hashed with md5, whatever THOR_HASH_ALGORITHM is now
+        migrations.AddField(
+            model_name='storedblob',
+            name='hash_algorithm',
+            field=models.CharField(default='md5', max_length=16),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='temporaryfilewrapper',
+            name='hash_algorithm',
+            field=models.CharField(default='md5', max_length=16),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='storedblob',
+            name='hash_algorithm',
+            field=models.CharField(default=upthor.models.get_hash_algorithm, max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='temporaryfilewrapper',
+            name='hash_algorithm',
+            field=models.CharField(default=upthor.models.get_hash_algorithm, max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='storedblob',
+            name='md5sum',
+            field=models.CharField(max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='temporaryfilewrapper',
+            name='md5sum',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
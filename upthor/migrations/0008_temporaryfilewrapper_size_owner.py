@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 13:46
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upthor', '0007_hash_algorithm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='temporaryfilewrapper',
+            name='owner',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=128),
+        ),
+        migrations.AddField(
+            model_name='temporaryfilewrapper',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,13 +1,16 @@
 import base64
-import hashlib
 import os
+import tempfile
+import time
 import uuid
 
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.core.signals import setting_changed
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from django.template.defaultfilters import filesizeformat
+from django.utils import timezone
 from django.utils.encoding import force_text, force_bytes
 from django.utils.translation import ugettext_lazy as _
 
@@ -36,10 +39,129 @@ def show_in_admin():
     return getattr(settings, 'THOR_ENABLE_ADMIN', True)
 
 
+def get_max_chunk_size():
+    return getattr(settings, 'THOR_MAX_CHUNK_SIZE', None)
+
+
+def get_chunked_upload_dir():
+    return getattr(settings, 'THOR_CHUNKED_UPLOAD_DIR',
+                   os.path.join(settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(), 'upthor-chunks'))
+
+
+def get_promotion_strategies():
+    return getattr(settings, 'THOR_PROMOTION_STRATEGIES', (
+        'upthor.promotion.link_file',
+        'upthor.promotion.storage_copy',
+        'upthor.promotion.stream_copy',
+    ))
+
+
+def get_storage_delete_workers():
+    return getattr(settings, 'THOR_STORAGE_DELETE_WORKERS', 8)
+
+
+def get_storage_delete_retries():
+    return getattr(settings, 'THOR_STORAGE_DELETE_RETRIES', 2)
+
+
+def get_max_concurrent_uploads():
+    return getattr(settings, 'THOR_MAX_CONCURRENT_UPLOADS', None)
+
+
+def get_upload_slot_timeout():
+    return getattr(settings, 'THOR_UPLOAD_SLOT_TIMEOUT', 10)
+
+
+def check_content_magic():
+    return getattr(settings, 'THOR_CHECK_CONTENT_MAGIC', False)
+
+
+def get_preview_sizes():
+    return getattr(settings, 'THOR_PREVIEW_SIZES', ((400, 400), ))
+
+
+def get_preview_workers():
+    return getattr(settings, 'THOR_PREVIEW_WORKERS', 2)
+
+
+def deferred_promotion():
+    return getattr(settings, 'THOR_DEFERRED_PROMOTION', False)
+
+
+def get_promotion_executor():
+    return getattr(settings, 'THOR_PROMOTION_EXECUTOR', 'upthor.deferred.ThreadPoolExecutor')
+
+
+def get_promotion_workers():
+    return getattr(settings, 'THOR_PROMOTION_WORKERS', 4)
+
+
+def get_promotion_attempts():
+    return getattr(settings, 'THOR_PROMOTION_ATTEMPTS', 3)
+
+
+def get_promotion_retry_delay():
+    return getattr(settings, 'THOR_PROMOTION_RETRY_DELAY', 5)
+
+
+def get_promotion_timeout():
+    return getattr(settings, 'THOR_PROMOTION_TIMEOUT', 60 * 10)
+
+
+def use_content_addressed_storage():
+    return getattr(settings, 'THOR_CONTENT_ADDRESSED', False)
+
+
+def get_blob_upload_path():
+    return getattr(settings, 'THOR_BLOB_UPLOAD_TO', 'thor-blobs')
+
+
+def get_blob_grace_period():
+    return getattr(settings, 'THOR_BLOB_GRACE_PERIOD', 60*60*24)
+
+
+def get_hash_algorithm():
+    return getattr(settings, 'THOR_HASH_ALGORITHM', 'md5')
+
+
+def get_hash_buffer_size():
+    return getattr(settings, 'THOR_HASH_BUFFER_SIZE', 1024*1024)
+
+
+def get_owner_max_bytes():
+    return getattr(settings, 'THOR_OWNER_MAX_BYTES', None)
+
+
+def get_owner_max_files():
+    return getattr(settings, 'THOR_OWNER_MAX_FILES', None)
+
+
+def get_metrics_backend():
+    return getattr(settings, 'THOR_METRICS', 'upthor.metrics.NullMetrics')
+
+
 def get_size_error():
     return force_text(_("Uploaded file too large ( > %s )") % filesizeformat(get_max_file_size()))
 
 
+def get_upload_bucket_size():
+    return getattr(settings, 'THOR_UPLOAD_BUCKET_SIZE', None)
+
+
+# Start (UTC) and length in seconds of a time bucket, e.g. 20161018130000-3600
+UPLOAD_BUCKET_FORMAT = '%Y%m%d%H%M%S'
+
+
+def get_upload_bucket(timestamp=None):
+    """ Returns the name of the THOR_UPLOAD_BUCKET_SIZE long time bucket timestamp falls in.
+    """
+    size = int(get_upload_bucket_size())
+    timestamp = time.time() if timestamp is None else timestamp
+
+    start = int(timestamp) // size * size
+    return '%s-%d' % (time.strftime(UPLOAD_BUCKET_FORMAT, time.gmtime(start)), size)
+
+
 def thor_upload_file_name(instance, filename):
     if len(filename) > 40:
         filename = filename[-40:]
@@ -47,9 +169,20 @@ def thor_upload_file_name(instance, filename):
     uuid_hex = uuid.uuid4().hex
     # This removes "False" from the filename, which helps us to distinct between empty values in widgets. :)
     filename = filename.replace('False', uuid_hex[3:8])
+
+    if get_upload_bucket_size():
+        # Whole buckets are removed once all of their files expired (see upthor.cleanup.TemporaryFileCleaner.drop_buckets)
+        return os.path.join(get_upload_path(), get_upload_bucket(), uuid_hex, filename)
+
     return os.path.join(get_upload_path(), uuid_hex[:3], uuid_hex[3:], filename)
 
 
+def get_file_hash(the_file):
+    from upthor.hashing import hash_file
+
+    return hash_file(the_file)
+
+
 def human_readable_types(types):
     ret = ['.%s' % (x.split('/')[-1] if "/" in x else x) for x in types]
     return ', '.join(ret)
@@ -58,14 +191,21 @@ def human_readable_types(types):
 class TemporaryFileWrapper(models.Model):
     """ Holds an arbitrary file and notes when it was last accessed
     """
-    file = models.FileField(upload_to=thor_upload_file_name)
+    file = models.FileField(upload_to=thor_upload_file_name, db_index=True)
 
-    modified = models.DateTimeField(auto_now=True)
-    md5sum = models.CharField(max_length=36, unique=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+    # Holds the digest of hash_algorithm (see THOR_HASH_ALGORITHM), the name is kept for compatibility
+    md5sum = models.CharField(max_length=64, unique=True)
+    hash_algorithm = models.CharField(max_length=16, default=get_hash_algorithm)
 
     content_type = models.CharField('content_type', max_length=128, default='application/unknown')
     linked = models.BooleanField(default=False)
 
+    # Unknown for files uploaded before sizes were recorded
+    size = models.BigIntegerField(null=True, blank=True)
+    # Who uploaded the file (see FileUploadView.get_owner), used for THOR_OWNER_MAX_BYTES and THOR_OWNER_MAX_FILES
+    owner = models.CharField(max_length=128, blank=True, default='', db_index=True)
+
     def __str__(self):
         return '%s%s' % (
             '[LINKED] ' if self.linked else '',
@@ -73,25 +213,121 @@ class TemporaryFileWrapper(models.Model):
         )
 
     def get_hash(self):
-        md5 = hashlib.md5()
-        for chunk in self.file.chunks():
-            md5.update(chunk)
+        return get_file_hash(self.file)
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None, rehash=True):
+        """ Saves the wrapper, reusing the row of an existing wrapper with the same content.
 
-        return md5.hexdigest()
+            New wrappers are inserted with a single query where the database supports it (see
+            upthor.dedupe), concurrent uploads of the same content share one row.
 
-    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
-        self.md5sum = self.get_hash()
+        :param rehash: If False, md5sum must already be set (e.g. computed by ThorUploadHandler).
+        """
+        from upthor.dedupe import insert_or_reuse
+        from upthor.metrics import timer
 
-        if not self.pk or TemporaryFileWrapper.objects.exclude(id=self.pk).filter(md5sum=self.md5sum).exists():
+        if rehash or not self.md5sum:
+            with timer('save.hash'):
+                self.md5sum = self.get_hash()
+                self.hash_algorithm = get_hash_algorithm()
+
+        using = using or router.db_for_write(self.__class__, instance=self)
+
+        if self.pk is None and not force_update and update_fields is None:
+            if self.size is None and self.file:
+                self.size = self.file.size
+
+            with timer('save.dedupe'):
+                insert_or_reuse(self, using)
+            return
+
+        if TemporaryFileWrapper.objects.using(using).exclude(id=self.pk).filter(md5sum=self.md5sum).exists():
             try:
                 # If replacing pk, we mark the file as unlinked.
                 self.linked = False
-                self.pk = TemporaryFileWrapper.objects.exclude(id=self.pk).get(md5sum=self.md5sum).pk
+                self.pk = TemporaryFileWrapper.objects.using(using).exclude(id=self.pk).get(md5sum=self.md5sum).pk
             except TemporaryFileWrapper.DoesNotExist:
                 pass
 
         return super(TemporaryFileWrapper, self).save(force_insert, force_update, using, update_fields)
 
+    def mark_linked(self):
+        """ Marks the wrapper linked with a single UPDATE, the file is not read or hashed again.
+        """
+        TemporaryFileWrapper.mark_all_linked([self])
+
+    @classmethod
+    def mark_all_linked(cls, wrappers):
+        """ Marks wrappers linked with one UPDATE, e.g. for the files of a formset (see upthor.linking).
+        """
+        pks = set(x.pk for x in wrappers if x.pk is not None)
+        if pks:
+            cls.objects.filter(pk__in=pks).update(linked=True, modified=timezone.now())
+
+        for instance in wrappers:
+            instance.linked = True
+
+    @classmethod
+    def bulk_save(cls, uploaded_files, owner=''):
+        """ Stores several uploaded files with a constant number of queries.
+
+        :param uploaded_files: Validated uploaded files, their `md5sum` is used if they have one (see ThorUploadHandler).
+        :param owner: Recorded as the owner of the files that are new.
+        :returns: list of TemporaryFileWrapper objects in the same order, duplicates share the same wrapper.
+        """
+        from upthor.metrics import increment
+
+        md5sums = [getattr(x, 'md5sum', None) or get_file_hash(x) for x in uploaded_files]
+
+        existing = dict((x.md5sum, x) for x in cls.objects.filter(md5sum__in=set(md5sums)))
+        new = {}
+
+        for uploaded_file, md5sum in zip(uploaded_files, md5sums):
+            if md5sum in existing or md5sum in new:
+                if getattr(uploaded_file, 'storage_name', None) is not None:
+                    # Stored while it was received, but the same content is already in this batch
+                    uploaded_file.discard()
+                continue
+
+            instance = cls(md5sum=md5sum, content_type=uploaded_file.content_type, size=uploaded_file.size, owner=owner)
+            instance.file = getattr(uploaded_file, 'storage_name', None) or uploaded_file
+            new[md5sum] = instance
+
+        if existing:
+            # Same as saving the duplicates one by one, they are marked unlinked and get the content type of the upload
+            content_types = dict((md5sum, x.content_type) for x, md5sum in zip(uploaded_files, md5sums) if md5sum in existing)
+
+            for content_type in set(content_types.values()):
+                pks = [existing[md5sum].pk for md5sum, x in content_types.items() if x == content_type]
+                cls.objects.filter(pk__in=pks).update(linked=False, modified=timezone.now(), content_type=content_type)
+
+            for md5sum, instance in existing.items():
+                instance.linked = False
+                instance.content_type = content_types[md5sum]
+
+        increment('dedupe.hit', len(md5sums) - len(new))
+
+        if new:
+            try:
+                with transaction.atomic():
+                    cls.objects.bulk_create(new.values())
+
+                increment('dedupe.miss', len(new))
+
+            except IntegrityError:
+                # Some of the files were uploaded at the same time by someone else
+                for instance in new.values():
+                    instance.pk = None
+                    instance.save(rehash=False)
+
+            missing_pk = [md5sum for md5sum, instance in new.items() if instance.pk is None]
+            if missing_pk:
+                # Only some backends return primary keys from bulk_create
+                for md5sum, pk in cls.objects.filter(md5sum__in=missing_pk).values_list('md5sum', 'pk'):
+                    new[md5sum].pk = pk
+
+        return [existing.get(md5sum) or new[md5sum] for md5sum in md5sums]
+
     @staticmethod
     def get_image_from_id(img_id, field_query):
         try:
@@ -109,20 +345,154 @@ class TemporaryFileWrapper(models.Model):
                 return getattr(instance, field_query[1])
 
 
+def get_temporary_wrapper(the_file):
+    """ Returns the TemporaryFileWrapper the_file belongs to or None.
+
+        Since Django 1.10 FileDescriptor re-binds FieldFiles to the model instance they are
+        assigned to, so the wrapper is also remembered on the file itself (see `temporary_wrapper`).
+    """
+    instance = getattr(the_file, 'instance', None)
+    if isinstance(instance, TemporaryFileWrapper):
+        return instance
+
+    return getattr(the_file, 'temporary_wrapper', None)
+
+
 @receiver(post_delete, sender=TemporaryFileWrapper)
 def cleanup_temporary_files(sender, instance, **kwargs):
     instance.file.close()
-    storage, path = instance.file.storage, instance.file.path
+
+    if instance.file.name:
+        from upthor.previews import get_stored_names
+        from upthor.storage import delete_stored_files
+        delete_stored_files(instance.file.storage, get_stored_names(instance.file.name, instance.content_type))
+
+
+def new_upload_id():
+    return uuid.uuid4().hex
+
+
+class ChunkedUpload(models.Model):
+    """ An unfinished upload that is sent in parts (see ChunkedFileUploadView).
+
+        The received bytes are appended to `partial_path` and `offset` holds how many of them are persisted.
+    """
+    upload_id = models.CharField(max_length=32, unique=True, default=new_upload_id)
+    field_query = models.CharField(max_length=255)
+
+    file_name = models.CharField(max_length=255)
+    content_type = models.CharField('content_type', max_length=128, default='application/unknown')
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s (%d/%d)' % (self.file_name, self.offset, self.size)
+
+    @property
+    def partial_path(self):
+        return os.path.join(get_chunked_upload_dir(), self.upload_id)
+
+    @property
+    def is_complete(self):
+        return self.offset >= self.size
+
+
+@receiver(post_delete, sender=ChunkedUpload)
+def cleanup_chunked_uploads(sender, instance, **kwargs):
     try:
-        storage.delete(path)
-    except IOError:
+        os.remove(instance.partial_path)
+    except (IOError, OSError):
         pass
 
 
+class PromotionTask(models.Model):
+    """ A temporary file that is copied to its permanent location after the model was saved.
+
+        The model already points at `name`, which is reserved with an empty file until the copy
+        is done (see THOR_DEFERRED_PROMOTION and upthor.deferred).
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    source_name = models.CharField(max_length=255, db_index=True)
+    source_content_type = models.CharField(max_length=128, default='application/unknown')
+    field_query = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
+
+    state = models.CharField(max_length=16, choices=STATES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '%s -> %s (%s)' % (self.source_name, self.name, self.state)
+
+
+class StoredBlob(models.Model):
+    """ A permanent file shared by every object that has the same content (see THOR_CONTENT_ADDRESSED).
+
+        Objects that use it are recorded as BlobReferences, blobs without references are removed by
+        the `gc_blobs` management command.
+    """
+    md5sum = models.CharField(max_length=64)
+    hash_algorithm = models.CharField(max_length=16, default=get_hash_algorithm)
+    storage_key = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
+
+    content_type = models.CharField('content_type', max_length=128, default='application/unknown')
+    field_query = models.CharField(max_length=255)
+
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        unique_together = ('md5sum', 'storage_key')
+
+    def __str__(self):
+        return self.name
+
+
+class BlobReference(models.Model):
+    """ A field of an object that points at a StoredBlob.
+    """
+    blob = models.ForeignKey(StoredBlob, related_name='references', on_delete=models.PROTECT)
+
+    model = models.CharField(max_length=128)
+    object_id = models.CharField(max_length=64)
+    field_name = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ('model', 'object_id', 'field_name')
+
+    def __str__(self):
+        return '%s(%s).%s -> %s' % (self.model, self.object_id, self.field_name, self.blob_id)
+
+
 class FqCrypto(object):
     BLOCK_SIZE = 32
     PADDING = '{'
 
+    # FQ values are constant per field, so the cipher and the results are cached. The cache is
+    # cleared when SECRET_KEY or THOR_DISABLE_FQ_ENCRYPT change (see clear_fq_cache).
+    CACHE_SIZE = 1024
+
+    _cipher_obj = None
+    _encoded = {}
+    _decoded = {}
+
     @classmethod
     def _pad(cls, s):
         return s + (cls.BLOCK_SIZE - len(s) % cls.BLOCK_SIZE) * cls.PADDING
@@ -140,26 +510,72 @@ class FqCrypto(object):
 
     @classmethod
     def _cipher(cls):
-        secret = settings.SECRET_KEY
+        # ECB mode keeps no state between calls, so a single cipher object can be shared
+        if cls._cipher_obj is None:
+            secret = settings.SECRET_KEY
 
-        if len(secret) < cls.BLOCK_SIZE:
-            secret = cls._pad(secret)
-        else:
-            secret = secret[:cls.BLOCK_SIZE]
+            if len(secret) < cls.BLOCK_SIZE:
+                secret = cls._pad(secret)
+            else:
+                secret = secret[:cls.BLOCK_SIZE]
+
+            from Crypto.Cipher import AES
+            cls._cipher_obj = AES.new(secret)
+
+        return cls._cipher_obj
 
-        from Crypto.Cipher import AES
-        return AES.new(secret)
+    @classmethod
+    def _remember(cls, value, encoded):
+        if len(cls._encoded) >= cls.CACHE_SIZE or len(cls._decoded) >= cls.CACHE_SIZE:
+            cls._encoded.clear()
+            cls._decoded.clear()
+
+        cls._encoded[value] = encoded
+        cls._decoded[encoded] = value
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cipher_obj = None
+        cls._encoded.clear()
+        cls._decoded.clear()
 
     @classmethod
     def decode(cls, value):
         if fq_encrypt_disabled():
             return force_text(value)
 
-        return force_text(cls._decode_aes(cls._cipher(), value))
+        value = force_text(value)
+
+        try:
+            return cls._decoded[value]
+        except KeyError:
+            pass
+
+        decoded = force_text(cls._decode_aes(cls._cipher(), value))
+
+        # Values come from the client, only valid FQ values are worth keeping
+        if decoded.startswith('FQ:'):
+            cls._remember(decoded, value)
+
+        return decoded
 
     @classmethod
     def encode(cls, value):
         if fq_encrypt_disabled():
             return value
 
-        return force_text(cls._encode_aes(cls._cipher(), value))
+        try:
+            return cls._encoded[value]
+        except KeyError:
+            pass
+
+        encoded = force_text(cls._encode_aes(cls._cipher(), value))
+        cls._remember(value, encoded)
+
+        return encoded
+
+
+@receiver(setting_changed)
+def clear_fq_cache(sender, setting, **kwargs):
+    if setting in ('SECRET_KEY', 'THOR_DISABLE_FQ_ENCRYPT'):
+        FqCrypto.clear_cache()
@@ -0,0 +1,206 @@
+import logging
+import os
+import re
+import threading
+import time
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+
+from upthor.models import get_preview_sizes, get_preview_workers
+from upthor.promotion import promote_file
+
+
+# Pillow formats previews are saved in, other images get PNG previews
+PREVIEW_FORMATS = ('JPEG', 'PNG', 'GIF')
+
+# Previews are kept in their own directory next to the file, uploaded file names can't contain a directory
+PREVIEW_DIR = '.previews'
+PREVIEW_SIZE_REGEX = re.compile(r'^\d+x\d+$')
+
+# Names whose previews are known to be ready (True) or missing until a timestamp, so rendering doesn't ask the
+# storage every time. Previews generated by other processes are noticed once PREVIEW_MISSING_TIMEOUT passed.
+PREVIEW_CACHE_SIZE = 10000
+PREVIEW_MISSING_TIMEOUT = 60
+
+_pool = None
+_pending = set()
+_known = {}
+_lock = threading.Lock()
+
+
+def is_image_type(content_type):
+    return (content_type or '').startswith('image/')
+
+
+def preview_name(name, size):
+    """ Previews are kept next to the file, e.g. `dir/.previews/400x400/image.png` for `dir/image.png`.
+    """
+    path, filename = os.path.split(name)
+    return os.path.join(path, PREVIEW_DIR, '%dx%d' % (size[0], size[1]), filename)
+
+
+def preview_source(name):
+    """ Returns the name of the file a preview was generated for, or None if name is not a preview.
+    """
+    path, filename = os.path.split(name)
+    path, size = os.path.split(path)
+    path, preview_dir = os.path.split(path)
+
+    if preview_dir != PREVIEW_DIR or not PREVIEW_SIZE_REGEX.match(size):
+        return None
+
+    return os.path.join(path, filename)
+
+
+def get_preview_names(name):
+    return [preview_name(name, size) for size in get_preview_sizes()]
+
+
+def get_stored_names(name, content_type):
+    """ Returns the names of the file and the previews that may have been generated for it.
+    """
+    if is_image_type(content_type):
+        return [name] + get_preview_names(name)
+
+    return [name]
+
+
+def generate_previews(storage, name):
+    """ Stores a downscaled copy of the image for each of THOR_PREVIEW_SIZES that doesn't exist yet.
+    """
+    from PIL import Image
+
+    missing = [size for size in get_preview_sizes() if not storage.exists(preview_name(name, size))]
+    if not missing:
+        return
+
+    with storage.open(name, 'rb') as source:
+        image = Image.open(source)
+        image.load()
+
+    image_format = image.format if image.format in PREVIEW_FORMATS else 'PNG'
+
+    for size in missing:
+        preview = image.copy()
+        preview.thumbnail(size, Image.LANCZOS)
+
+        if image_format == 'JPEG' and preview.mode not in ('RGB', 'L'):
+            preview = preview.convert('RGB')
+
+        content = BytesIO()
+        preview.save(content, image_format)
+
+        storage.save(preview_name(name, size), ContentFile(content.getvalue()))
+
+
+def remember_previews(name, ready):
+    with _lock:
+        if len(_known) >= PREVIEW_CACHE_SIZE:
+            _known.clear()
+
+        _known[name] = True if ready else time.time() + PREVIEW_MISSING_TIMEOUT
+
+
+def _generate_previews(storage, name):
+    try:
+        generate_previews(storage, name)
+    except Exception as e:
+        logging.warning('Failed to generate previews of %s: %s', name, e)
+    else:
+        remember_previews(name, True)
+    finally:
+        with _lock:
+            _pending.discard(name)
+
+
+def schedule_previews(storage, name):
+    """ Generates the previews of name in a pool of THOR_PREVIEW_WORKERS threads (or right away if it is 0).
+    """
+    if not get_preview_sizes():
+        return
+
+    workers = get_preview_workers()
+
+    with _lock:
+        if name in _pending:
+            return
+
+        _pending.add(name)
+        _known.pop(name, None)
+
+        if workers:
+            global _pool
+            if _pool is None:
+                _pool = ThreadPool(workers)
+
+            _pool.apply_async(_generate_previews, (storage, name))
+            return
+
+    _generate_previews(storage, name)
+
+
+def is_preview_ready(storage, name, size, probe=True):
+    """ Returns True if the preview of name exists, the storage is only asked if this process doesn't know it yet
+        (and with probe).
+    """
+    with _lock:
+        if name in _pending:
+            return False
+
+        state = _known.get(name)
+
+    if state is True:
+        return True
+
+    if not probe or (state is not None and state > time.time()):
+        return False
+
+    ready = storage.exists(preview_name(name, size))
+    remember_previews(name, ready)
+
+    return ready
+
+
+def get_preview_url(the_file, size=None, probe=True):
+    """ Returns the url of the preview of the_file, or of the_file itself while the preview isn't ready.
+    """
+    sizes = get_preview_sizes()
+    if not sizes:
+        return the_file.url
+
+    size = size or sizes[0]
+    if is_preview_ready(the_file.storage, the_file.name, size, probe=probe):
+        return the_file.storage.url(preview_name(the_file.name, size))
+
+    return the_file.url
+
+
+def promote_previews(the_file, field_file):
+    """ Copies the previews of the temporary the_file next to the promoted field_file.
+
+        Previews that weren't ready yet are generated for field_file instead.
+    """
+    missing = False
+
+    for size in get_preview_sizes():
+        source = FieldFile(None, the_file.field, preview_name(the_file.name, size))
+
+        if not source.storage.exists(source.name):
+            missing = True
+            continue
+
+        name = preview_name(field_file.name, size)
+        stored_name = promote_file(source, field_file.storage, name)
+
+        if stored_name != name:
+            # Existing files are never replaced, the one in the way is left over from a file that had the same name
+            logging.warning('Preview %s already exists, the preview of %s is not copied.', name, field_file.name)
+            field_file.storage.delete(stored_name)
+
+    if missing:
+        schedule_previews(field_file.storage, field_file.name)
+    else:
+        remember_previews(field_file.name, True)
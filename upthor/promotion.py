@@ -0,0 +1,134 @@
+import errno
+import os
+
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import File
+from django.db.models.fields.files import FieldFile
+from django.utils.module_loading import import_string
+
+from upthor.models import get_promotion_strategies
+from upthor.storage import storage_has_path
+
+
+def get_local_path(the_file):
+    """ Returns the local filesystem path of the_file or None if it doesn't have one.
+    """
+    if isinstance(the_file, FieldFile):
+        inner = getattr(the_file, '_file', None)
+    else:
+        inner = getattr(the_file, 'file', None)
+
+    for candidate in (the_file, inner):
+        if hasattr(candidate, 'temporary_file_path'):
+            return candidate.temporary_file_path()
+
+    if isinstance(the_file, FieldFile) and the_file._committed:
+        try:
+            return the_file.path
+        except (NotImplementedError, SuspiciousFileOperation):
+            pass
+
+    name = getattr(the_file, 'name', None)
+    if name and os.path.isabs(name) and os.path.isfile(name):
+        return name
+
+    return None
+
+
+def link_file(the_file, storage, name, max_length=None):
+    """ Hardlinks the file when both the source and the storage are on the same local filesystem.
+
+        Temporary files are still used for deduplication, so they are linked instead of renamed.
+    """
+    source_path = get_local_path(the_file)
+    if source_path is None or not storage_has_path(storage):
+        return None
+
+    while True:
+        name = storage.get_available_name(name, max_length=max_length)
+        path = storage.path(name)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        try:
+            os.link(source_path, path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                # Somebody took the name after we picked it, try again
+                continue
+
+            # Different device or no hardlink support, let the next strategy handle it
+            return None
+
+        return name
+
+
+# The permanent file shares its content with the temporary one, see promote_file(shared=False)
+link_file.shares_content = True
+
+
+def storage_copy(the_file, storage, name, max_length=None):
+    """ Uses a server-side copy when the storage provides `copy(name, new_name)`.
+    """
+    copy = getattr(storage, 'copy', None)
+    if not callable(copy) or not isinstance(the_file, FieldFile) or the_file.storage is not storage:
+        return None
+
+    name = storage.get_available_name(name, max_length=max_length)
+    return copy(the_file.name, name) or name
+
+
+def stream_copy(the_file, storage, name, max_length=None):
+    """ Streams the file to the storage in chunks, this works with every storage.
+    """
+    if not isinstance(the_file, FieldFile):
+        source = getattr(the_file, 'file', None) or the_file
+
+        # Wrapping the source in a plain File stops storages from moving temporary uploads
+        return storage.save(name, File(source, name), max_length=max_length)
+
+    the_file.open('rb')
+    try:
+        return storage.save(name, File(the_file.file, name), max_length=max_length)
+    finally:
+        the_file.close()
+
+
+def promote_file(the_file, storage, name, max_length=None, shared=True):
+    """ Copies the_file into storage as name using the cheapest strategy from THOR_PROMOTION_STRATEGIES.
+
+    :param shared: If False the strategies whose result shares its content with the_file (`shares_content`,
+        e.g. hardlinks) are skipped, so changing the permanent file doesn't change the temporary one.
+    :returns: The name the file was stored under.
+    """
+    for strategy in get_promotion_strategies():
+        if not callable(strategy):
+            strategy = import_string(strategy)
+
+        if not shared and getattr(strategy, 'shares_content', False):
+            continue
+
+        new_name = strategy(the_file, storage, name, max_length=max_length)
+        if new_name is not None:
+            return new_name
+
+    raise Exception('None of THOR_PROMOTION_STRATEGIES could promote %s.' % name)
+
+
+def promote_field_file(the_file, field_file, filename):
+    """ Promotes the_file into field_file, like FieldFile.save(filename, content, save=False) would.
+
+        Fields that process their files in post_link get a copy that doesn't share its content with the_file.
+    """
+    name = field_file.field.generate_filename(field_file.instance, filename)
+    shared = not getattr(field_file.field, 'has_post_link', False)
+
+    field_file.name = promote_file(the_file, field_file.storage, name, max_length=field_file.field.max_length, shared=shared)
+    setattr(field_file.instance, field_file.field.name, field_file.name)
+    field_file._committed = True
+
+    return field_file
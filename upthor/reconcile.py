@@ -0,0 +1,271 @@
+import calendar
+import errno
+import json
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.db import connection
+from django.utils import timezone
+
+from upthor.models import TemporaryFileWrapper, get_expiry_time, get_storage_delete_retries, get_upload_path
+from upthor.previews import preview_source
+from upthor.storage import delete_stored_file, get_temporary_storage, list_stored_names, storage_has_path
+
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    scandir = None
+
+
+def get_modified_time(storage, name):
+    get_modified = getattr(storage, 'get_modified_time', None) or storage.modified_time
+    modified = get_modified(name)
+
+    if timezone.is_aware(modified):
+        return calendar.timegm(modified.utctimetuple())
+
+    return time.mktime(modified.timetuple())
+
+
+def walk_local(path):
+    """ Yields (path, mtime) of the files below path and (path, None) of the directories, children first.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                for item in walk_local(entry.path):
+                    yield item
+
+                yield entry.path, None
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.stat(follow_symlinks=False).st_mtime
+
+        return
+
+    for name in os.listdir(path):
+        full_path = os.path.join(path, name)
+
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            for item in walk_local(full_path):
+                yield item
+
+            yield full_path, None
+        elif os.path.isfile(full_path):
+            yield full_path, os.path.getmtime(full_path)
+
+
+def walk_storage(storage, prefix):
+    """ Like walk_local for storages without paths, yields (name, mtime) of the files below prefix.
+    """
+    for name in list_stored_names(storage, prefix):
+        try:
+            yield name, get_modified_time(storage, name)
+        except (NotImplementedError, AttributeError):
+            # Without modification times orphans can't be told apart from uploads in progress
+            yield name, time.time()
+
+
+class Checkpoint(object):
+    """ Remembers the prefix directories that were reconciled in a JSON file, so runs can continue where the
+        previous one stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self.lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path) as handle:
+                self.done = set(json.load(handle)['done'])
+
+    def add(self, prefix):
+        with self.lock:
+            self.done.add(prefix)
+
+            if self.path:
+                with open(self.path + '.tmp', 'w') as handle:
+                    json.dump({'done': sorted(self.done)}, handle)
+
+                os.rename(self.path + '.tmp', self.path)
+
+    def clear(self):
+        self.done = set()
+
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class OrphanReconciler(object):
+    """ Finds files in the temporary storage (below THOR_UPLOAD_TO) that don't belong to any TemporaryFileWrapper.
+
+        The prefix directories (e.g. the 4096 `<3 hex>` directories) are handled in parallel by `workers` threads,
+        the names of each one are checked against the table in batches of `batch_size`. Orphans older than
+        `grace_period` seconds are deleted (or only reported with `dry_run`) and the empty directories left behind
+        are removed. Finished prefixes are stored in `checkpoint`, runs are bounded by `max_runtime` seconds.
+
+        With `workers=0` the prefixes are handled one by one in the calling thread.
+    """
+
+    def __init__(self, workers=8, batch_size=500, grace_period=None, dry_run=False, checkpoint=None, max_runtime=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.grace_period = get_expiry_time() if grace_period is None else grace_period
+        self.dry_run = dry_run
+        self.checkpoint = Checkpoint(checkpoint)
+        self.max_runtime = max_runtime
+
+        self.storage = get_temporary_storage()
+        self.local = storage_has_path(self.storage)
+
+        self.lock = threading.Lock()
+        self.orphans = []
+        self.failed = []
+        self.pruned = 0
+        self.checked = 0
+        self.finished = False
+        self.started = None
+
+    def get_prefixes(self):
+        root = get_upload_path()
+
+        if self.local:
+            path = self.storage.path(root)
+            if not os.path.isdir(path):
+                return []
+
+            prefixes = [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+        else:
+            try:
+                prefixes = self.storage.listdir(root)[0]
+            except (OSError, NotImplementedError):
+                return []
+
+        return ['%s/%s' % (root, name) for name in sorted(prefixes)]
+
+    def list_prefix(self, prefix):
+        """ Returns the files below prefix as (name, mtime) and the local directories that may be pruned.
+        """
+        if not self.local:
+            return list(walk_storage(self.storage, prefix)), []
+
+        location = self.storage.path('')
+        files = []
+        dirs = []
+
+        for path, mtime in walk_local(self.storage.path(prefix)):
+            if mtime is None:
+                dirs.append(path)
+            else:
+                files.append((os.path.relpath(path, location).replace(os.sep, '/'), mtime))
+
+        return files, dirs
+
+    def get_known_names(self, names):
+        known = set()
+        names = list(names)
+
+        for idx in range(0, len(names), self.batch_size):
+            known.update(TemporaryFileWrapper.objects.filter(
+                file__in=names[idx:idx + self.batch_size],
+            ).values_list('file', flat=True))
+
+        return known
+
+    def find_orphans(self, files):
+        deadline = time.time() - self.grace_period
+        candidates = dict((name, preview_source(name)) for name, mtime in files if mtime <= deadline)
+
+        # An upload can be named like a preview, so its own name counts too
+        known = self.get_known_names(set(candidates) | set(x for x in candidates.values() if x is not None))
+
+        return sorted(name for name, source in candidates.items() if name not in known and source not in known)
+
+    def prune(self, dirs, emptied):
+        """ Removes the empty directories of dirs that weren't changed during the grace period or that only
+            held orphans we deleted (emptied).
+        """
+        deadline = time.time() - self.grace_period
+        emptied = set(emptied)
+        pruned = 0
+
+        # Children come before their parents, so emptied parents are removed too
+        for path in dirs:
+            try:
+                if path not in emptied and os.path.getmtime(path) > deadline:
+                    # An upload might be about to write into it
+                    continue
+
+                os.rmdir(path)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    logging.warning('Failed to remove directory %s: %s', path, e)
+            else:
+                emptied.add(os.path.dirname(path))
+                pruned += 1
+
+        return pruned
+
+    def reconcile_prefix(self, prefix):
+        """ Returns False if the prefix was skipped because the run is out of time.
+        """
+        if self.max_runtime is not None and time.time() - self.started > self.max_runtime:
+            return False
+
+        files, dirs = self.list_prefix(prefix)
+        orphans = self.find_orphans(files)
+
+        failed = []
+        pruned = 0
+
+        if not self.dry_run:
+            retries = get_storage_delete_retries()
+            failed = [name for name in orphans if not delete_stored_file(self.storage, name, retries)]
+
+            if self.local:
+                pruned = self.prune(dirs, [os.path.dirname(self.storage.path(name)) for name in orphans if name not in failed])
+
+        with self.lock:
+            self.checked += len(files)
+            self.orphans += orphans
+            self.failed += failed
+            self.pruned += pruned
+
+        if not self.dry_run:
+            self.checkpoint.add(prefix)
+
+        return True
+
+    def reconcile_prefix_in_thread(self, prefix):
+        try:
+            return self.reconcile_prefix(prefix)
+        finally:
+            # Each thread uses its own database connection
+            connection.close()
+
+    def run(self):
+        self.started = time.time()
+        prefixes = [x for x in self.get_prefixes() if x not in self.checkpoint.done]
+
+        if self.workers:
+            pool = ThreadPool(self.workers)
+
+            try:
+                results = pool.map(self.reconcile_prefix_in_thread, prefixes)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self.reconcile_prefix(prefix) for prefix in prefixes]
+
+        # Prefixes skipped for max_runtime are handled by the next run
+        self.finished = all(results)
+
+        if self.finished and not self.dry_run:
+            self.checkpoint.clear()
+
+        return self
@@ -0,0 +1,78 @@
+from django.utils.encoding import force_text
+
+
+DEFAULT_UPLOAD_ICON = '<i class="fa fa-file"></i>'
+
+
+class ThorFieldConfig(object):
+    """ Everything upthor needs to know about a ThorFileField, computed once.
+    """
+
+    def __init__(self, model, field):
+        self.model = model
+        self.field = field
+
+        self.key = (model._meta.app_label, model._meta.model_name, field.name)
+        self.fq = 'FQ:%s' % '.'.join([
+            force_text(model._meta.app_label),
+            force_text(model._meta.object_name),
+            field.name,
+        ])
+
+        get_upload_image = getattr(field, 'get_upload_image', None)
+        get_upload_image_url = getattr(field, 'get_upload_image_url', None)
+
+        self.upload_icon_func = get_upload_image if callable(get_upload_image) else None
+        self.upload_icon = force_text(get_upload_image) if get_upload_image is not None else DEFAULT_UPLOAD_ICON
+
+        self.upload_url_func = get_upload_image_url if callable(get_upload_image_url) else None
+        self.upload_url = force_text(get_upload_image_url) if get_upload_image_url is not None else None
+
+    def get_upload_icon(self, file_path):
+        if self.upload_icon_func is not None:
+            return self.upload_icon_func(file_path)
+
+        return self.upload_icon
+
+    def get_upload_url(self, file_url):
+        if self.upload_url_func is not None:
+            return self.upload_url_func(file_url)
+
+        if self.upload_url is not None:
+            return self.upload_url
+
+        return file_url
+
+
+class ThorFieldRegistry(object):
+    """ Maps FQ components (app_label, model name, field name) to ThorFieldConfig objects.
+
+        Fields register themselves in ThorFileField.contribute_to_class, fields inherited by
+        other models are added when the app registry is ready (see UpthorConfig).
+    """
+
+    def __init__(self):
+        self.configs = {}
+
+    def register(self, model, field):
+        config = ThorFieldConfig(model, field)
+        self.configs[config.key] = config
+
+        return config
+
+    def register_models(self, models):
+        from upthor.fields import ThorFileField
+
+        for model in models:
+            for field in model._meta.fields:
+                if isinstance(field, ThorFileField):
+                    self.register(model, field)
+
+    def get(self, app_label, model_name, field_name):
+        return self.configs.get((app_label, model_name.lower(), field_name), None)
+
+    def get_for_model(self, model, field_name):
+        return self.configs.get((model._meta.app_label, model._meta.model_name, field_name), None)
+
+
+registry = ThorFieldRegistry()
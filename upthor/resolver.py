@@ -0,0 +1,107 @@
+import six
+
+from upthor.models import TemporaryFileWrapper
+
+
+MD5SUM_SUFFIX = '_md5sum'
+
+
+class UploadResolver(object):
+    """ Resolves the md5sum and `id:` values of every upthor widget in the submitted data.
+
+        The values are collected up front, so a formset costs one `md5sum__in` query and one
+        `id__in` query per model instead of one query per widget.
+    """
+
+    def __init__(self, data):
+        self.md5sums = set()
+        self.ids = set()
+
+        for key in data:
+            if not key.endswith(MD5SUM_SUFFIX):
+                continue
+
+            value = data.get(key)
+            if not isinstance(value, six.string_types) or not value:
+                continue
+
+            if value[:3] == 'id:':
+                try:
+                    self.ids.add(int(value[3:]))
+                except ValueError:
+                    pass
+            else:
+                self.md5sums.add(value)
+
+        self.wrappers = None
+        self.instances = {}
+
+    def get_wrapper(self, md5sum):
+        if self.wrappers is None:
+            self.md5sums.add(md5sum)
+            self.wrappers = dict((wrapper.md5sum, wrapper) for wrapper in TemporaryFileWrapper.objects.filter(md5sum__in=self.md5sums))
+
+        elif md5sum not in self.md5sums:
+            # Sent under a key that wasn't collected (e.g. a widget with its own md5sum_field_name)
+            self.md5sums.add(md5sum)
+            self.wrappers.update((wrapper.md5sum, wrapper) for wrapper in TemporaryFileWrapper.objects.filter(md5sum=md5sum))
+
+        return self.wrappers.get(md5sum, None)
+
+    def get_temporary_file(self, md5sum):
+        """ Returns a new FieldFile of the wrapper of md5sum, or None if there is no such wrapper.
+
+            FieldFiles are re-bound to the model instance they are assigned to, so widgets that
+            were sent the same file must not share one.
+        """
+        wrapper = self.get_wrapper(md5sum)
+        if wrapper is None:
+            return None
+
+        field = wrapper.file.field
+        the_file = field.attr_class(wrapper, field, wrapper.file.name)
+        the_file.temporary_wrapper = wrapper
+
+        return the_file
+
+    def get_instance(self, model, pk):
+        if model not in self.instances:
+            self.ids.add(pk)
+            self.instances[model] = model.objects.in_bulk(self.ids)
+
+        elif pk not in self.ids:
+            self.ids.add(pk)
+            self.instances[model].update(model.objects.in_bulk([pk]))
+
+        return self.instances[model].get(pk, None)
+
+    def get_image_from_id(self, img_id, field_query):
+        """ Same as TemporaryFileWrapper.get_image_from_id, served from the resolved instances.
+        """
+        try:
+            img_id = int(img_id)
+        except (ValueError, TypeError):
+            return None
+
+        instance = self.get_instance(field_query[0], img_id)
+        if instance is None:
+            return None
+
+        return getattr(instance, field_query[1])
+
+
+def get_resolver(data):
+    """ Returns the UploadResolver of data, the same data object is shared by every form of a formset.
+    """
+    resolver = getattr(data, '_upthor_resolver', None)
+
+    if resolver is None:
+        resolver = UploadResolver(data)
+
+        try:
+            data._upthor_resolver = resolver
+        except AttributeError:
+            # Plain dicts don't take attributes, these are not cached
+            pass
+
+    return resolver
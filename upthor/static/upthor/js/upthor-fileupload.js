@@ -18,6 +18,9 @@
             $el.data('uploader-initialized', true);
 
             var max_size = $el.data('max-size');
+            var max_chunk_size = parseInt($el.data('max-chunk-size'), 10) || 0;
+            var chunk_upload_url = $el.data('chunk-upload-url');
+            var batch_upload_url = $el.data('batch-upload-url');
             var $fileInput = $el.find('input[type="file"]');
             var useBackground = !!$el.data('use-background');
 
@@ -47,6 +50,147 @@
             var getNextFileInput = function ($startFrom, idx) {
                 return $el;
             };
+            var uploadFailed = function (resp) {
+                $el.removeClass('has-image').removeClass('is-file').removeClass('with-progress');
+
+                if (resp && resp.errors) {
+                    addError(resp.errors);
+                } else {
+                    addError('Oops, file upload failed, please try again');
+                }
+                toggleAddButton();
+            };
+            var uploadDone = function (result) {
+                setProgress($progressBar, reversed, 1);
+                $controls.find('.upload-field-error').html('');
+                $controls.removeClass('has-error');
+
+                $el.removeClass('with-preview').removeClass('with-progress').addClass('has-image');
+                $md5sum.val(result.file.md5sum);
+                $deleteInput.prop('checked', false);
+
+                $el.toggleClass('is-file', result.file.instance_type === 'file');
+
+                if (result.file.instance_type === 'image') {
+                    var imageUrl = result.file.preview_url || result.file.url;
+
+                    if (useBackground) {
+                        $imagePreview.css('background-image', 'url("' + imageUrl + '")');
+                    } else {
+                        $imagePreview.attr('src', imageUrl);
+                    }
+                }
+
+                var nameParts = result.file.file_name.split('/');
+                $el.find('[data-file-name]').text(nameParts[nameParts.length - 1]);
+
+                var $dispArea = $el.find('.file-display');
+                $dispArea.find('*:not([data-file-name="1"])').remove();
+                $dispArea.prepend($(result.file.upload_icon));
+
+                $dropContainer.trigger('thor_file_changed', [$el, $fileInput, nameParts[nameParts.length - 1]]);
+
+                toggleAddButton();
+            };
+            var submitUpload = function (data) {
+                var file = data.files[0];
+
+                if (!max_chunk_size || !chunk_upload_url || !file.size || file.size <= max_chunk_size) {
+                    data.submit();
+                    return;
+                }
+
+                // Open a chunked upload, so that a failed upload can be resumed instead of sent again
+                $.post(chunk_upload_url, {
+                    'fq': $fqField.val(),
+                    'file_name': file.name,
+                    'size': file.size,
+                    'content_type': file.type
+                }, null, 'json').done(function (result) {
+                    file.upthorRetries = 0;
+
+                    data.url = chunk_upload_url;
+                    data.formData = {
+                        'fq': $fqField.val(),
+                        'upload_id': result.upload_id
+                    };
+                    data.uploadedBytes = result.offset;
+                    data.submit();
+                }).fail(function (jqXHR) {
+                    uploadFailed(jqXHR.responseJSON);
+                });
+            };
+            var sendBatch = function (batch) {
+                if (batch.length === 0) {
+                    return;
+                }
+
+                if (batch.length === 1) {
+                    batch[0].submit();
+                    return;
+                }
+
+                // Upload all the dropped files in one request
+                var formData = new window.FormData();
+                formData.append('fq', $fqField.val());
+
+                $.each(batch, function (i, item) {
+                    formData.append('file', item.file);
+                });
+
+                $.ajax({
+                    url: batch_upload_url,
+                    type: 'POST',
+                    data: formData,
+                    processData: false,
+                    contentType: false,
+                    dataType: 'json',
+                    xhr: function () {
+                        var xhr = $.ajaxSettings.xhr();
+
+                        if (xhr.upload) {
+                            xhr.upload.addEventListener('progress', function (e) {
+                                if (e.lengthComputable) {
+                                    $.each(batch, function (i, item) {
+                                        item.progress(e.loaded / e.total);
+                                    });
+                                }
+                            });
+                        }
+
+                        return xhr;
+                    }
+                }).done(function (result) {
+                    $.each(batch, function (i, item) {
+                        var fileResult = result.files && result.files[i];
+
+                        if (fileResult && fileResult.success) {
+                            item.done(fileResult);
+                        } else {
+                            item.fail(fileResult);
+                        }
+                    });
+                }).fail(function (jqXHR) {
+                    $.each(batch, function (i, item) {
+                        item.fail(jqXHR.responseJSON);
+                    });
+                });
+            };
+            var resumeUpload = function (data) {
+                var file = data.files[0];
+                file.upthorRetries += 1;
+
+                window.setTimeout(function () {
+                    // Ask the server how much of the file it has and continue from there
+                    $.getJSON(chunk_upload_url, {'upload_id': data.formData.upload_id}).done(function (result) {
+                        data.uploadedBytes = result.offset;
+                        data.data = null;
+                        data.submit();
+                    }).fail(function (jqXHR) {
+                        uploadFailed(jqXHR.responseJSON);
+                    });
+                }, file.upthorRetries * 1000);
+            };
 
             if (is_multi) {
                 var field_name = $fileInput.attr('name').replace(/(-?[\d]+-)[\w\-_]+$/, '');
@@ -170,9 +314,17 @@
                     var fileWidgetObj = $next.find('input[type=file]').data( "blueimp-fileupload");
 
                     fileWidgetObj._getDroppedFiles(dataTransfer).always(function (files) {
+                        var batch = null;
+
+                        if (batch_upload_url && window.FormData) {
+                            // Filled by the add callbacks of the widgets the files are assigned to
+                            batch = [];
+                        }
+
                         for (var i = 0; i < files.length; i += 1) {
                             var data = {
-                                files: [files[i]]
+                                files: [files[i]],
+                                upthorBatch: batch
                             };
                             var clEvent = new window.Event('drop');
 
@@ -181,6 +333,10 @@
                                 $nowObj._onAdd(clEvent, data);
                             }
                         }
+
+                        if (batch) {
+                            sendBatch(batch);
+                        }
                     });
                 }
 
@@ -197,6 +353,8 @@
                     'fq': $fqField.val()
                 },
 
+                maxChunkSize: max_chunk_size || undefined,
+
                 add: function(e, data) {
                     var is_image = false;
                     if (data.files.length > 0) {
@@ -229,7 +387,22 @@
                     } else {
                         setProgress($progressBar, reversed, 0.01);
                         $el.removeClass('has-image').addClass('with-progress');
-                        data.submit();
+
+                        if (data.upthorBatch && (!max_chunk_size || data.files[0].size <= max_chunk_size)) {
+                            data.upthorBatch.push({
+                                file: data.files[0],
+                                submit: function () {
+                                    submitUpload(data);
+                                },
+                                progress: function (amount) {
+                                    setProgress($progressBar, reversed, amount);
+                                },
+                                done: uploadDone,
+                                fail: uploadFailed
+                            });
+                        } else {
+                            submitUpload(data);
+                        }
                     }
                 },
 
@@ -237,48 +410,22 @@
                     setProgress($progressBar, reversed, data.loaded / data.total);
                 },
 
-                error: function(e, data) {
-                    $el.removeClass('has-image').removeClass('is-file').removeClass('with-progress');
+                fail: function(e, data) {
+                    var resp = data.jqXHR && data.jqXHR.responseJSON;
 
-                    var resp = e.responseJSON;
-                    if (resp && resp.errors) {
-                        addError(resp.errors);
-                    } else {
-                        addError('Oops, file upload failed, please try again');
+                    // Retry failed chunked uploads (but not the ones the server rejected)
+                    if (data.formData && data.formData.upload_id && !resp && data.errorThrown !== 'abort' &&
+                            data.files[0].upthorRetries < 3) {
+                        resumeUpload(data);
+                        return;
                     }
-                    toggleAddButton();
+
+                    uploadFailed(resp);
                 },
 
                 done: function(e, data) {
                     if (data.result && data.result.success) {
-                        setProgress($progressBar, reversed, 1);
-                        $controls.find('.upload-field-error').html('');
-                        $controls.removeClass('has-error');
-
-                        $el.removeClass('with-preview').removeClass('with-progress').addClass('has-image');
-                        $md5sum.val(data.result.file.md5sum);
-                        $deleteInput.prop('checked', false);
-
-                        $el.toggleClass('is-file', data.result.file.instance_type === 'file');
-
-                        if (data.result.file.instance_type === 'image') {
-                            if (useBackground) {
-                                $imagePreview.css('background-image', 'url("' + data.result.file.url + '")');
-                            } else {
-                                $imagePreview.attr('src', data.result.file.url);
-                            }
-                        }
-
-                        var nameParts = data.result.file.file_name.split('/');
-                        $el.find('[data-file-name]').text(nameParts[nameParts.length - 1]);
-
-                        var $dispArea = $el.find('.file-display');
-                        $dispArea.find('*:not([data-file-name="1"])').remove();
-                        $dispArea.prepend($(data.result.file.upload_icon));
-
-                        $dropContainer.trigger('thor_file_changed', [$el, $fileInput, nameParts[nameParts.length - 1]]);
-
-                        toggleAddButton();
+                        uploadDone(data.result);
                     }
                 }
             });
@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from upthor.models import TemporaryFileWrapper, get_storage_delete_retries, get_storage_delete_workers
+
+
+# Fewer names than this (e.g. a row's file and its previews) are deleted one by one
+PARALLEL_DELETE_THRESHOLD = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_delete_pool(workers):
+    """ Returns a thread pool of `workers` threads that is shared by all deletes of this process.
+
+        Pools are created again in forked processes (e.g. gunicorn workers of a preloading master), the threads
+        of the parent don't exist there.
+    """
+    key = os.getpid(), workers
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ThreadPool(workers)
+
+        return _pools[key]
+
+
+def get_temporary_storage():
+    return TemporaryFileWrapper._meta.get_field('file').storage
+
+
+def storage_has_path(storage):
+    try:
+        storage.path('')
+    except NotImplementedError:
+        return False
+
+    return True
+
+
+def list_stored_names(storage, prefix):
+    """ Yields the names of all files below prefix, for storages without paths.
+    """
+    dirs, files = storage.listdir(prefix)
+
+    for name in dirs:
+        for item in list_stored_names(storage, '%s/%s' % (prefix, name)):
+            yield item
+
+    for name in files:
+        yield '%s/%s' % (prefix, name)
+
+
+def delete_stored_file(storage, name, retries):
+    for attempt in range(retries + 1):
+        try:
+            storage.delete(name)
+        except Exception as e:
+            if attempt == retries:
+                logging.warning('Failed to delete %s from storage: %s', name, e)
+                return False
+
+            time.sleep(0.1 * (attempt + 1))
+        else:
+            return True
+
+
+def delete_stored_files(storage, names, workers=None, retries=None):
+    """ Deletes the files from storage by name.
+
+        Uses the storage's `bulk_delete(names)` method if it has one (it should return the names
+        it couldn't delete), otherwise the files are deleted in a shared pool of THOR_STORAGE_DELETE_WORKERS
+        threads (a few names one by one) and each failed delete is retried THOR_STORAGE_DELETE_RETRIES times.
+
+    :returns: list of names that couldn't be deleted.
+    """
+    names = list(names)
+    if not names:
+        return []
+
+    bulk_delete = getattr(storage, 'bulk_delete', None)
+    if callable(bulk_delete):
+        return list(bulk_delete(names) or [])
+
+    workers = get_storage_delete_workers() if workers is None else workers
+    retries = get_storage_delete_retries() if retries is None else retries
+
+    if workers <= 1 or len(names) < PARALLEL_DELETE_THRESHOLD:
+        results = [delete_stored_file(storage, name, retries) for name in names]
+    else:
+        results = get_delete_pool(workers).map(lambda name: delete_stored_file(storage, name, retries), names)
+
+    return [name for name, deleted in zip(names, results) if not deleted]
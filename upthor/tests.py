@@ -1,9 +1,156 @@
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.files.storage import Storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db import models
+from django.db.migrations.state import ModelState, StateApps
+from django.db.models.signals import post_delete, post_save
 from django.db.models.fields.files import ImageFieldFile, ImageFileDescriptor, FileDescriptor, FieldFile
-from django.test import TestCase
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.http import QueryDict
+from django.utils import timezone
+from django.utils.encoding import force_text
+from django.utils.six import StringIO
+
+from upthor.cleanup import TemporaryFileCleaner, get_stale_files, parse_upload_bucket
+from upthor import dedupe
+from upthor.blobs import collect_blobs
+from upthor.concurrency import get_upload_slots
+from upthor.deferred import ThreadPoolExecutor, discard_rolled_back_reservations, is_promoted
+from upthor.fields import ThorFileField, ThorFormFileField, ThorImageField
+from upthor.forms import TemporaryFileForm
+from upthor.hashing import hash_file, new_hash
+from upthor.linking import batch_links
+from upthor.metrics import get_metrics
+from upthor.models import BlobReference, ChunkedUpload, FqCrypto, PromotionTask, StoredBlob, TemporaryFileWrapper, \
+    get_upload_bucket, get_upload_path, get_expiry_time, get_linked_expiry_time, fq_encrypt_disabled, get_max_file_size, \
+    get_size_error, show_in_admin
+from upthor.previews import get_preview_url, preview_name, preview_source
+from upthor.promotion import promote_file
+from upthor.reconcile import Checkpoint, OrphanReconciler
+from upthor.registry import registry
+from upthor.views import BatchFileUploadView, FileUploadView
+from upthor.widgets import ThorMultiUploadWidget, ThorSingleUploadWidget
+from upthor.storage import delete_stored_files, get_delete_pool, get_temporary_storage
+from upthor.uploadhandler import ThorUploadHandler, ThorUploadedFile
+from upthor.usage import get_owner_stats, get_storage_stats
+
+
+class ExampleModel(models.Model):
+    content = ThorFileField(upload_to='example-files', allowed_types=['*'])
+
+    class Meta:
+        app_label = 'upthor'
+        managed = False
+
+
+class ExampleImageModel(models.Model):
+    image = ThorImageField(upload_to='example-images')
+
+    class Meta:
+        app_label = 'upthor'
+        managed = False
+
+
+class ExampleBlobModel(models.Model):
+    content = ThorFileField(upload_to='example-files', allowed_types=['*'], content_addressed=True)
+
+    class Meta:
+        app_label = 'upthor'
+        managed = False
+
+
+class ExampleBlobProxy(ExampleBlobModel):
+
+    class Meta:
+        app_label = 'upthor'
+        proxy = True
+
+
+class ExampleBlobChild(ExampleBlobModel):
+
+    class Meta:
+        app_label = 'upthor'
+        managed = False
+
+
+# Added by UpthorConfig for models that exist when the app registry is ready
+registry.register_models([ExampleBlobProxy, ExampleBlobChild])
+
+
+class MemoryStorage(Storage):
+    """ A fake object store, keeps the files in memory and has no local paths.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name], name)
+
+    def _save(self, name, content):
+        self.files[name] = b''.join(content.chunks())
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
 
-from upthor.fields import ThorFileField, ThorImageField
-from upthor.models import FqCrypto, get_upload_path, get_expiry_time, get_linked_expiry_time, fq_encrypt_disabled, \
-    get_max_file_size, show_in_admin
+    def size(self, name):
+        return len(self.files[name])
+
+    def url(self, name):
+        return '/memory/%s' % name
+
+
+class FlakyMemoryStorage(MemoryStorage):
+    """ Fails to delete each file `failures` times before it succeeds.
+    """
+
+    def __init__(self, failures):
+        super(FlakyMemoryStorage, self).__init__()
+        self.failures = failures
+        self.attempts = {}
+
+    def delete(self, name):
+        self.attempts[name] = self.attempts.get(name, 0) + 1
+        if self.attempts[name] <= self.failures:
+            raise IOError('Storage is not available.')
+
+        super(FlakyMemoryStorage, self).delete(name)
+
+
+class MediaRootMixin(object):
+
+    def setUp(self):
+        super(MediaRootMixin, self).setUp()
+
+        self.media_root = tempfile.mkdtemp()
+        self.media_settings = self.settings(MEDIA_ROOT=self.media_root)
+        self.media_settings.enable()
+
+    def tearDown(self):
+        self.media_settings.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+        super(MediaRootMixin, self).tearDown()
 
 
 class TestThorUpload(TestCase):
@@ -32,6 +179,29 @@ class TestThorUpload(TestCase):
             self.assertEquals(encoded, self.FQ_ENC_LONG)
             self.assertEquals(FqCrypto.decode(encoded), self.FQ_VAL)
 
+    def test_fq_encrypt_cache(self):
+        with self.settings(SECRET_KEY='F00BA4', THOR_DISABLE_FQ_ENCRYPT=False):
+            encoded = FqCrypto.encode(self.FQ_VAL)
+
+            def fail(*args):
+                raise AssertionError('AES should not be used for cached values')
+
+            original = FqCrypto._encode_aes, FqCrypto._decode_aes
+            FqCrypto._encode_aes = FqCrypto._decode_aes = classmethod(fail)
+
+            try:
+                self.assertEquals(FqCrypto.encode(self.FQ_VAL), encoded)
+                self.assertEquals(FqCrypto.decode(encoded), self.FQ_VAL)
+            finally:
+                FqCrypto._encode_aes, FqCrypto._decode_aes = [classmethod(func.__func__) for func in original]
+
+        # Changing the key clears the cache
+        with self.settings(SECRET_KEY='F00BA5', THOR_DISABLE_FQ_ENCRYPT=False):
+            self.assertNotEquals(FqCrypto.encode(self.FQ_VAL), encoded)
+
+        with self.settings(SECRET_KEY='F00BA4', THOR_DISABLE_FQ_ENCRYPT=False):
+            self.assertEquals(FqCrypto.encode(self.FQ_VAL), self.FQ_ENC)
+
     def test_settings_overwrite(self):
         with self.settings(THOR_UPLOAD_TO='other-path'):
             self.assertEquals(get_upload_path(), 'other-path')
@@ -61,3 +231,1261 @@ class TestFieldAttrs(TestCase):
     def test_upthor_imagefield_attrs(self):
         self.assertEquals(ThorImageField.attr_class, ImageFieldFile)
         self.assertEquals(ThorImageField.descriptor_class, ImageFileDescriptor)
+
+
+class FakeThorField(object):
+    allowed_types = ['*']
+
+
+class TestUploadHandler(MediaRootMixin, TestCase):
+
+    def upload(self, content, name='test.txt', chunk_size=None, **kwargs):
+        the_file = BytesIO(content)
+        the_file.name = name
+
+        request = RequestFactory().post('/', {'file': the_file})
+        request.upload_handlers = [ThorUploadHandler(request, **kwargs)]
+
+        if chunk_size is not None:
+            request.upload_handlers[0].chunk_size = chunk_size
+
+        return request
+
+    def test_hash_while_streaming(self):
+        content = b'x' * 1024
+
+        with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100):
+            request = self.upload(content)
+            uploaded = request.FILES['file']
+
+        self.assertIsInstance(uploaded, ThorUploadedFile)
+        self.assertEquals(uploaded.md5sum, hashlib.md5(content).hexdigest())
+        self.assertIsNone(uploaded.duplicate)
+
+        # Big files are written straight to the temporary storage
+        storage = get_temporary_storage()
+        self.assertTrue(uploaded.storage_name.startswith(get_upload_path()))
+        with storage.open(uploaded.storage_name) as stored:
+            self.assertEquals(stored.read(), content)
+
+        form = TemporaryFileForm(FakeThorField(), request.POST, request.FILES)
+        self.assertTrue(form.is_valid())
+        instance = form.save()
+
+        self.assertEquals(instance.file.name, uploaded.storage_name)
+        self.assertEquals(instance.md5sum, uploaded.md5sum)
+
+    def test_later_handlers_are_skipped(self):
+        class RecordingHandler(TemporaryFileUploadHandler):
+            files = []
+
+            def new_file(self, *args, **kwargs):
+                self.files.append(args)
+                super(RecordingHandler, self).new_file(*args, **kwargs)
+
+        with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100):
+            request = self.upload(b'x' * 1024)
+            request.upload_handlers.append(RecordingHandler(request))
+
+            self.assertIsInstance(request.FILES['file'], ThorUploadedFile)
+
+        self.assertEquals(RecordingHandler.files, [])
+
+    def test_small_files_are_kept_in_memory(self):
+        request = self.upload(b'small')
+        uploaded = request.FILES['file']
+
+        self.assertIsNone(uploaded.storage_name)
+
+        form = TemporaryFileForm(FakeThorField(), request.POST, request.FILES)
+        self.assertTrue(form.is_valid())
+        instance = form.save()
+
+        instance.file.open('rb')
+        self.assertEquals(instance.file.read(), b'small')
+        instance.file.close()
+
+    def test_duplicates_are_not_written(self):
+        content = b'y' * 1024
+
+        with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100):
+            request = self.upload(content)
+            first = TemporaryFileForm(FakeThorField(), request.POST, request.FILES)
+            self.assertTrue(first.is_valid())
+            original = first.save()
+
+            request = self.upload(content, name='other.txt')
+            uploaded = request.FILES['file']
+
+        self.assertEquals(uploaded.duplicate, original)
+        self.assertIsNone(uploaded.storage_name)
+
+        form = TemporaryFileForm(FakeThorField(), request.POST, request.FILES)
+        self.assertTrue(form.is_valid())
+        instance = form.save()
+
+        self.assertEquals(instance.pk, original.pk)
+        self.assertEquals(instance.file.name, original.file.name)
+        self.assertEquals(TemporaryFileWrapper.objects.count(), 1)
+
+    def save_concurrent_uploads(self, content):
+        with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=100):
+            # Both uploads are received before either of them is saved
+            forms = [TemporaryFileForm(FakeThorField(), request.POST, request.FILES)
+                     for request in [self.upload(content), self.upload(content, name='other.html')]]
+
+        for form in forms:
+            self.assertTrue(form.is_valid())
+
+        saved = []
+
+        def on_save(sender, instance, created=None, **kwargs):
+            saved.append(created)
+
+        names = [form.cleaned_data['file'].storage_name for form in forms]
+
+        post_save.connect(on_save, sender=TemporaryFileWrapper)
+        try:
+            first, second = [form.save() for form in forms]
+        finally:
+            post_save.disconnect(on_save, sender=TemporaryFileWrapper)
+
+        self.assertEquals(first.pk, second.pk)
+        self.assertEquals(first.file.name, second.file.name)
+        self.assertEquals(TemporaryFileWrapper.objects.count(), 1)
+        self.assertEquals([get_temporary_storage().exists(name) for name in names], [True, False])
+
+        # Like saving a duplicate found by the upload handler, the row gets the type of the last upload
+        self.assertEquals(saved, [True, False])
+        self.assertEquals(TemporaryFileWrapper.objects.get().content_type, 'text/html')
+
+    def test_concurrent_duplicates_share_a_row(self):
+        self.save_concurrent_uploads(b'z' * 1024)
+
+    def test_concurrent_duplicates_without_upsert(self):
+        supports_upsert = dedupe.supports_upsert
+        dedupe.supports_upsert = lambda connection: False
+
+        try:
+            self.save_concurrent_uploads(b'z' * 1024)
+        finally:
+            dedupe.supports_upsert = supports_upsert
+
+    def test_big_files_are_rejected_while_streaming(self):
+        with self.settings(FILE_UPLOAD_MAX_MEMORY_SIZE=150, THOR_MAX_FILE_SIZE=500):
+            request = self.upload(b'z' * 1000, chunk_size=100)
+            uploaded = request.FILES['file']
+
+            self.assertTrue(uploaded.rejected)
+            self.assertEquals(uploaded.size, 1000)
+
+            # The part written before the limit was reached was removed
+            self.assertEquals([name for path, dirs, names in os.walk(self.media_root) for name in names], [])
+
+            form = TemporaryFileForm(FakeThorField(), request.POST, request.FILES)
+            self.assertFalse(form.is_valid())
+            self.assertEquals(form.errors['file'], [get_size_error()])
+
+    def test_content_type_is_checked_while_streaming(self):
+        png = b'\x89PNG\r\n\x1a\n' + b'0' * 100
+
+        request = self.upload(png, name='image.bin', allowed_types=['image/png'], check_magic=True)
+        self.assertFalse(request.FILES['file'].rejected)
+        self.assertEquals(request.FILES['file'].content_type, 'image/png')
+
+        request = self.upload(b'%PDF-1.4', name='image.png', allowed_types=['image/png'], check_magic=True)
+        self.assertTrue(request.FILES['file'].rejected)
+        self.assertEquals(request.FILES['file'].content_type, 'application/pdf')
+
+        request = self.upload(b'text', name='text.txt', allowed_types=['image/png'])
+        self.assertTrue(request.FILES['file'].rejected)
+
+    def test_content_length_is_checked_before_reading(self):
+        the_file = BytesIO(b'x' * (FileUploadView.MULTIPART_OVERHEAD + 100))
+        the_file.name = 'big.txt'
+
+        with self.settings(THOR_MAX_FILE_SIZE=10):
+            response = self.client.post(reverse('thor-file-upload'), {'fq': 'FQ:upthor.ExampleModel.content', 'file': the_file})
+
+            self.assertEquals(response.status_code, 403)
+            self.assertEquals(json.loads(force_text(response.content))['errors'], get_size_error())
+
+
+class TestPromotion(MediaRootMixin, TestCase):
+
+    def create_temporary(self, content=b'promoted'):
+        instance = TemporaryFileWrapper()
+        instance.file.save('promoted.txt', ContentFile(content))
+
+        return instance
+
+    def test_link_on_same_filesystem(self):
+        temporary = self.create_temporary()
+        storage = get_temporary_storage()
+
+        name = promote_file(temporary.file, storage, 'example-files/promoted.txt')
+
+        self.assertEquals(name, 'example-files/promoted.txt')
+        self.assertEquals(os.stat(storage.path(name)).st_ino, os.stat(temporary.file.path).st_ino)
+
+    def test_fields_with_post_link_get_copies(self):
+        class ProcessingField(ThorFileField):
+            def post_link(self, real_instance, temporary_instance, raw_file):
+                return True
+
+        self.assertFalse(ThorFileField().has_post_link)
+        self.assertTrue(ThorFileField(post_link=lambda *args: True).has_post_link)
+        self.assertTrue(ProcessingField().has_post_link)
+
+        temporary = self.create_temporary()
+        storage = get_temporary_storage()
+
+        name = promote_file(temporary.file, storage, 'example-files/promoted.txt', shared=False)
+        self.assertNotEquals(os.stat(storage.path(name)).st_ino, os.stat(temporary.file.path).st_ino)
+
+    def test_storage_copy(self):
+        temporary = self.create_temporary()
+        storage = get_temporary_storage()
+        copies = []
+
+        def copy(name, new_name):
+            copies.append((name, new_name))
+            return new_name
+
+        storage.copy = copy
+        try:
+            with self.settings(THOR_PROMOTION_STRATEGIES=('upthor.promotion.storage_copy', )):
+                name = promote_file(temporary.file, storage, 'example-files/promoted.txt')
+        finally:
+            del storage.copy
+
+        self.assertEquals(copies, [(temporary.file.name, name)])
+
+    def test_stream_copy_without_local_path(self):
+        temporary = self.create_temporary()
+        storage = MemoryStorage()
+
+        name = promote_file(temporary.file, storage, 'example-files/promoted.txt')
+
+        self.assertEquals(storage.files[name], b'promoted')
+        self.assertTrue(temporary.file.closed)
+
+    def test_pre_save_promotes_temporary_file(self):
+        temporary = self.create_temporary()
+
+        temporary.file.temporary_wrapper = temporary
+
+        instance = ExampleModel(content=temporary.file)
+        field = ExampleModel._meta.get_field('content')
+        promoted = field.pre_save(instance, True)
+
+        self.assertTrue(promoted.name.startswith('example-files/'))
+        self.assertEquals(instance.content.name, promoted.name)
+
+        promoted.open('rb')
+        self.assertEquals(promoted.read(), b'promoted')
+        promoted.close()
+
+        self.assertTrue(TemporaryFileWrapper.objects.get(pk=temporary.pk).linked)
+
+    def test_linking_does_not_read_files(self):
+        temporaries = [self.create_temporary(content) for content in [b'first', b'second']]
+        field = ExampleModel._meta.get_field('content')
+
+        def get_hash():
+            raise AssertionError('Linked files should not be hashed again')
+
+        for temporary in temporaries:
+            temporary.file.temporary_wrapper = temporary
+            temporary.get_hash = get_hash
+
+        with CaptureQueriesContext(connection) as queries:
+            with batch_links():
+                for temporary in temporaries:
+                    field.pre_save(ExampleModel(content=temporary.file), True)
+
+                self.assertFalse(TemporaryFileWrapper.objects.filter(linked=True).exists())
+
+        # The check above and one UPDATE for both files
+        self.assertEquals(len(queries), 2)
+        self.assertEquals(TemporaryFileWrapper.objects.filter(linked=True).count(), 2)
+
+
+class TestChunkedUpload(MediaRootMixin, TestCase):
+    FQ_VAL = 'FQ:upthor.ExampleModel.content'
+
+    def setUp(self):
+        super(TestChunkedUpload, self).setUp()
+
+        self.chunk_settings = self.settings(THOR_CHUNKED_UPLOAD_DIR=os.path.join(self.media_root, 'chunks'))
+        self.chunk_settings.enable()
+        self.url = reverse('thor-chunked-upload')
+
+    def tearDown(self):
+        self.chunk_settings.disable()
+
+        super(TestChunkedUpload, self).tearDown()
+
+    def open_upload(self, size):
+        response = self.client.post(self.url, {
+            'fq': self.FQ_VAL,
+            'file_name': 'big.txt',
+            'size': size,
+            'content_type': 'text/plain',
+        })
+        self.assertEquals(response.status_code, 200)
+
+        return json.loads(force_text(response.content))['upload_id']
+
+    def send_chunk(self, upload_id, content, start, size):
+        chunk = BytesIO(content)
+        chunk.name = 'blob'
+
+        response = self.client.post(self.url, {'upload_id': upload_id, 'file': chunk},
+                                    HTTP_CONTENT_RANGE='bytes %d-%d/%d' % (start, start + len(content) - 1, size))
+
+        return response.status_code, json.loads(force_text(response.content))
+
+    def test_chunked_upload(self):
+        content = b'0123456789' * 10
+        upload_id = self.open_upload(len(content))
+
+        status, result = self.send_chunk(upload_id, content[:60], 0, len(content))
+        self.assertEquals((status, result['offset']), (200, 60))
+
+        # The client can ask where to resume from
+        response = self.client.get(self.url, {'upload_id': upload_id})
+        self.assertEquals(json.loads(force_text(response.content))['offset'], 60)
+        self.assertEquals(response['Range'], 'bytes=0-59')
+
+        # Parts that are already persisted are not appended again
+        status, result = self.send_chunk(upload_id, content[:60], 0, len(content))
+        self.assertEquals((status, result['offset']), (200, 60))
+
+        status, result = self.send_chunk(upload_id, content[60:], 60, len(content))
+        self.assertEquals(status, 200)
+        self.assertTrue(result['success'])
+        self.assertEquals(result['file']['md5sum'], hashlib.md5(content).hexdigest())
+
+        instance = TemporaryFileWrapper.objects.get(md5sum=result['file']['md5sum'])
+        instance.file.open('rb')
+        self.assertEquals(instance.file.read(), content)
+        instance.file.close()
+
+        self.assertFalse(ChunkedUpload.objects.filter(upload_id=upload_id).exists())
+
+    def test_chunk_with_wrong_offset(self):
+        upload_id = self.open_upload(100)
+
+        status, result = self.send_chunk(upload_id, b'x' * 10, 50, 100)
+        self.assertEquals(status, 403)
+        self.assertFalse(result['success'])
+
+    def test_too_big_upload_is_rejected_when_opened(self):
+        with self.settings(THOR_MAX_FILE_SIZE=10):
+            response = self.client.post(self.url, {
+                'fq': self.FQ_VAL,
+                'file_name': 'big.txt',
+                'size': 100,
+            })
+
+        self.assertEquals(response.status_code, 403)
+        self.assertFalse(ChunkedUpload.objects.exists())
+
+
+class TestBatchUpload(MediaRootMixin, TestCase):
+    FQ_VAL = 'FQ:upthor.ExampleModel.content'
+
+    def upload(self, *contents):
+        files = []
+        for idx, content in enumerate(contents):
+            the_file = BytesIO(content)
+            the_file.name = 'file-%d.txt' % idx
+            files.append(the_file)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('thor-batch-upload'), {'fq': self.FQ_VAL, 'file': files})
+
+        self.assertEquals(response.status_code, 200)
+        return json.loads(force_text(response.content))['files'], len(queries)
+
+    def test_batch_upload(self):
+        TemporaryFileWrapper.bulk_save([SimpleUploadedFile('existing.txt', b'existing')])
+
+        # Files are written to the storage while they are received
+        with self.settings(THOR_MAX_FILE_SIZE=10, FILE_UPLOAD_MAX_MEMORY_SIZE=1):
+            results, num_queries = self.upload(b'first', b'existing', b'first', b'too big for the field')
+
+        self.assertEquals([x['success'] for x in results], [True, True, True, False])
+        self.assertEquals(results[0]['file'], results[2]['file'])
+        self.assertEquals(results[0]['file']['md5sum'], hashlib.md5(b'first').hexdigest())
+        self.assertEquals(results[1]['file']['md5sum'], hashlib.md5(b'existing').hexdigest())
+        self.assertEquals(TemporaryFileWrapper.objects.count(), 2)
+
+        # Duplicates and rejected files were removed again
+        stored = [name for path, dirs, names in os.walk(self.media_root) for name in names]
+        self.assertEquals(len(stored), 2)
+
+    def test_query_count_does_not_grow_with_files(self):
+        results, few_queries = self.upload(b'1', b'2')
+        results, many_queries = self.upload(b'3', b'4', b'5', b'6', b'7')
+
+        self.assertEquals(len(results), 5)
+        self.assertEquals(few_queries, many_queries)
+
+
+class TestCleanup(MediaRootMixin, TestCase):
+
+    def create_files(self, count, age, linked=False):
+        instances = TemporaryFileWrapper.bulk_save([
+            SimpleUploadedFile('file.txt', ('%d-%s-%s' % (idx, age, linked)).encode()) for idx in range(count)
+        ])
+
+        TemporaryFileWrapper.objects.filter(pk__in=[x.pk for x in instances]).update(
+            linked=linked, modified=timezone.now() - datetime.timedelta(seconds=age),
+        )
+
+        return instances
+
+    def test_cleanup_in_batches(self):
+        stale = self.create_files(5, 60 * 60 * 25)
+        stale_linked = self.create_files(2, 60 * 60 * 7, linked=True)
+        fresh = self.create_files(2, 60)
+
+        cleaner = TemporaryFileCleaner(batch_size=2).run()
+
+        self.assertTrue(cleaner.finished)
+        self.assertEquals(cleaner.deleted, 7)
+        self.assertEquals(cleaner.failed, [])
+        self.assertEquals(set(TemporaryFileWrapper.objects.values_list('pk', flat=True)), set(x.pk for x in fresh))
+
+        storage = get_temporary_storage()
+        self.assertFalse(any(storage.exists(x.file.name) for x in stale + stale_linked))
+        self.assertTrue(all(storage.exists(x.file.name) for x in fresh))
+
+    def test_dry_run(self):
+        self.create_files(3, 60 * 60 * 25)
+
+        out = StringIO()
+        call_command('clean_temporary_files', dry_run=True, batch_size=2, stdout=out)
+
+        self.assertIn('Would remove 3', out.getvalue())
+        self.assertEquals(TemporaryFileWrapper.objects.count(), 3)
+
+    def test_max_runtime_and_cursor(self):
+        instances = self.create_files(3, 60 * 60 * 25)
+
+        cleaner = TemporaryFileCleaner(max_runtime=0).run()
+        self.assertFalse(cleaner.finished)
+        self.assertEquals(cleaner.deleted, 0)
+
+        # Stopped before the first batch, there is no cursor to continue from
+        out = StringIO()
+        call_command('clean_temporary_files', max_runtime=0, stdout=out)
+        self.assertIn('Removed 0', out.getvalue())
+        self.assertNotIn('--cursor', out.getvalue())
+
+        first = TemporaryFileWrapper.objects.order_by('modified', 'pk').first()
+        cleaner = TemporaryFileCleaner(cursor=(first.modified, first.pk)).run()
+
+        self.assertEquals(cleaner.deleted, 2)
+        self.assertEquals(list(TemporaryFileWrapper.objects.values_list('pk', flat=True)), [first.pk])
+        self.assertIn(first.pk, [x.pk for x in instances])
+
+
+@override_settings(THOR_UPLOAD_BUCKET_SIZE=3600)
+class TestUploadBuckets(MediaRootMixin, TestCase):
+
+    def create_file(self, bucket, content, age):
+        storage = get_temporary_storage()
+        digest = hashlib.md5(content).hexdigest()
+
+        name = storage.save('temp-files/%s/%s/file.txt' % (get_upload_bucket(bucket), digest), ContentFile(content))
+        instance = TemporaryFileWrapper.objects.create(file=name, md5sum=digest, size=len(content))
+
+        TemporaryFileWrapper.objects.filter(pk=instance.pk).update(modified=timezone.now() - datetime.timedelta(seconds=age))
+
+        return name
+
+    def test_upload_names(self):
+        instance, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('file.txt', b'bucket')])
+        root, bucket, uuid_hex, file_name = instance.file.name.split('/')
+
+        start, end = parse_upload_bucket(bucket)
+        self.assertTrue(start <= time.time() < end)
+        self.assertEquals(end - start, 3600)
+
+        self.assertEquals(get_upload_bucket(0), '19700101000000-3600')
+        self.assertEquals(parse_upload_bucket('abc'), None)
+
+    def test_expired_buckets_are_dropped(self):
+        old = time.time() - 60 * 60 * 48
+        expired = [self.create_file(old, ('expired-%d' % idx).encode(), 60 * 60 * 25) for idx in range(2)]
+        mixed_stale = self.create_file(old - 3600, b'mixed-stale', 60 * 60 * 25)
+        mixed_fresh = self.create_file(old - 3600, b'mixed-fresh', 60)
+        fresh = self.create_file(time.time(), b'fresh', 60)
+
+        storage = get_temporary_storage()
+
+        out = StringIO()
+        call_command('clean_temporary_files', dry_run=True, stdout=out)
+        self.assertIn('Would remove 3', out.getvalue())
+        self.assertIn('Would remove 1 expired upload buckets', out.getvalue())
+        self.assertTrue(all(storage.exists(name) for name in expired))
+
+        cleaner = TemporaryFileCleaner().run()
+
+        self.assertEquals(cleaner.buckets, 1)
+        self.assertEquals(cleaner.deleted, 3)
+        self.assertEquals(set(TemporaryFileWrapper.objects.values_list('file', flat=True)), {mixed_fresh, fresh})
+
+        # The whole bucket is gone, mixed buckets are cleaned up per row
+        self.assertFalse(os.path.exists(storage.path('temp-files/%s' % get_upload_bucket(old))))
+        self.assertFalse(storage.exists(mixed_stale))
+        self.assertTrue(storage.exists(mixed_fresh))
+        self.assertTrue(storage.exists(fresh))
+
+
+class TestStorageDelete(MediaRootMixin, TestCase):
+
+    def fill(self, storage, count):
+        return [storage.save('file-%d.txt' % idx, ContentFile(b'data')) for idx in range(count)]
+
+    def test_delete_from_filesystem(self):
+        storage = get_temporary_storage()
+        names = self.fill(storage, 20)
+
+        self.assertEquals(delete_stored_files(storage, names), [])
+        self.assertFalse(any(storage.exists(name) for name in names))
+
+    def test_pool_is_reused(self):
+        storage = get_temporary_storage()
+        delete_stored_files(storage, self.fill(storage, 20), workers=4)
+
+        pool = get_delete_pool(4)
+        delete_stored_files(storage, self.fill(storage, 20), workers=4)
+        self.assertIs(get_delete_pool(4), pool)
+
+        # A forked process gets its own pool
+        getpid = os.getpid
+        os.getpid = lambda: getpid() + 1
+        try:
+            forked = get_delete_pool(4)
+        finally:
+            os.getpid = getpid
+
+        forked.close()
+        self.assertIsNot(forked, pool)
+
+    def test_failed_deletes_are_retried(self):
+        storage = FlakyMemoryStorage(failures=1)
+        names = self.fill(storage, 20)
+
+        self.assertEquals(delete_stored_files(storage, names, retries=1), [])
+        self.assertEquals(storage.files, {})
+
+    def test_failures_are_reported(self):
+        storage = FlakyMemoryStorage(failures=3)
+        names = self.fill(storage, 5)
+
+        self.assertEquals(sorted(delete_stored_files(storage, names, retries=1)), sorted(names))
+        self.assertEquals(set(storage.attempts.values()), {2})
+
+    def test_bulk_delete(self):
+        storage = MemoryStorage()
+        names = self.fill(storage, 5)
+        calls = []
+
+        def bulk_delete(names):
+            calls.append(names)
+            for name in names:
+                storage.delete(name)
+
+        storage.bulk_delete = bulk_delete
+
+        self.assertEquals(delete_stored_files(storage, names), [])
+        self.assertEquals(calls, [names])
+        self.assertEquals(storage.files, {})
+
+
+class TestFieldRegistry(TestCase):
+
+    def test_fields_are_registered(self):
+        field = ExampleModel._meta.get_field('content')
+        config = registry.get('upthor', 'ExampleModel', 'content')
+
+        self.assertIs(config.field, field)
+        self.assertIs(registry.get_for_model(ExampleModel(), 'content'), config)
+        self.assertEquals(config.fq, 'FQ:upthor.ExampleModel.content')
+        self.assertIsNone(registry.get('upthor', 'ExampleModel', 'missing'))
+
+    def test_historical_models_are_not_registered(self):
+        field = ExampleModel._meta.get_field('content')
+
+        # Like the models migrations build from their state
+        state = ModelState.from_model(ExampleModel)
+        state.render(StateApps([], {}))
+
+        self.assertIs(registry.get('upthor', 'ExampleModel', 'content').field, field)
+
+    def test_lookups_use_registry(self):
+        field = ExampleModel._meta.get_field('content')
+
+        self.assertEquals(FileUploadView.validate_fq(('upthor', 'ExampleModel', 'content')), (True, field, []))
+        self.assertIs(field.get_field_pointer(ExampleModel()), field)
+
+        widget = ThorSingleUploadWidget(fq=field.field_query, is_image=False)
+        with self.settings(THOR_DISABLE_FQ_ENCRYPT=True):
+            self.assertEquals(widget.get_fq(), 'FQ:upthor.ExampleModel.content')
+
+        self.assertEquals(widget.get_file_upload_icon_func('path'), '<i class="fa fa-file"></i>')
+        self.assertEquals(widget.get_file_upload_url_func('url'), 'url')
+
+
+class TestWidgetRender(TestCase):
+
+    def test_constants_are_computed_once(self):
+        field = ExampleModel._meta.get_field('content')
+        widgets = [ThorMultiUploadWidget(fq=field.field_query, is_image=False) for x in range(3)]
+
+        with self.settings(THOR_DISABLE_FQ_ENCRYPT=True, THOR_MAX_FILE_SIZE=1234):
+            calls = []
+            get_template_constants = ThorMultiUploadWidget.get_template_constants
+
+            def counting(widget):
+                calls.append(widget)
+                return get_template_constants(widget)
+
+            ThorMultiUploadWidget.get_template_constants = counting
+
+            try:
+                outputs = [widget.render('form-%d-content' % i, None) for i, widget in enumerate(widgets)]
+            finally:
+                ThorMultiUploadWidget.get_template_constants = get_template_constants
+
+        self.assertEquals(len(calls), 1)
+
+        for i, output in enumerate(outputs):
+            self.assertIn('name="form-%d-content"' % i, output)
+            self.assertIn('data-upload-url="%s?fq=FQ%%3Aupthor.ExampleModel.content"' % reverse('thor-file-upload'), output)
+            self.assertIn('data-batch-upload-url="%s?fq=' % reverse('thor-batch-upload'), output)
+            self.assertIn('data-max-size="1234"', output)
+            self.assertIn("value='FQ:upthor.ExampleModel.content'", output)
+
+        # Settings changes clear the cache
+        with self.settings(THOR_DISABLE_FQ_ENCRYPT=True, THOR_MAX_FILE_SIZE=4321):
+            self.assertIn('data-max-size="4321"', widgets[0].render('content', None))
+
+
+class TestUploadResolver(MediaRootMixin, TestCase):
+
+    def test_formset_values_are_resolved_in_bulk(self):
+        instances = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('file.txt', ('%d' % idx).encode()) for idx in range(6)])
+        field_query = (TemporaryFileWrapper, 'file')
+        widget = ThorSingleUploadWidget(fq=field_query, is_image=False)
+
+        data = QueryDict(mutable=True)
+        for idx, instance in enumerate(instances):
+            data['form-%d-file_md5sum' % idx] = instance.md5sum if idx % 2 else 'id:%d' % instance.pk
+            data['form-%d-file_FQ' % idx] = widget.get_fq()
+        data['form-6-file_md5sum'] = 'missing'
+        data['form-6-file_FQ'] = widget.get_fq()
+
+        with CaptureQueriesContext(connection) as queries:
+            values = [widget.value_from_datadict(data, {}, 'form-%d-file' % idx) for idx in range(7)]
+
+        self.assertEquals(len(queries), 2)
+        self.assertEquals([x.name for x in values[:6]], [x.file.name for x in instances])
+        self.assertEquals(values[6], 'missing')
+
+        # Files of the same wrapper are not shared
+        self.assertIsNot(widget.value_from_datadict(data, {}, 'form-1-file'), values[1])
+        self.assertEquals(values[1].temporary_wrapper.pk, instances[1].pk)
+
+    def test_custom_md5sum_field_name(self):
+        class CustomWidget(ThorSingleUploadWidget):
+            @staticmethod
+            def md5sum_field_name(name):
+                return '%s_upload' % name
+
+        instances = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('file.txt', ('%d' % idx).encode()) for idx in range(2)])
+        widget = CustomWidget(fq=(TemporaryFileWrapper, 'file'), is_image=False)
+
+        data = QueryDict(mutable=True)
+        for idx, instance in enumerate(instances):
+            data['form-%d-file_upload' % idx] = instance.md5sum
+            data['form-%d-file_FQ' % idx] = widget.get_fq()
+
+        values = [widget.value_from_datadict(data, {}, 'form-%d-file' % idx) for idx in range(2)]
+        self.assertEquals([x.name for x in values], [x.file.name for x in instances])
+
+    def test_content_type_is_checked_without_queries(self):
+        instance, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('file.txt', b'text', content_type='text/plain')])
+        field_query = (TemporaryFileWrapper, 'file')
+
+        data = QueryDict(mutable=True)
+        data['file_md5sum'] = instance.md5sum
+        data['file_FQ'] = ThorSingleUploadWidget(fq=field_query, is_image=False).get_fq()
+
+        allowed = ThorFormFileField(['text/plain'], field_query, ThorSingleUploadWidget)
+        disallowed = ThorFormFileField(['image/png'], field_query, ThorSingleUploadWidget)
+
+        value = allowed.widget.value_from_datadict(data, {}, 'file')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEquals(allowed.to_python(value), value)
+            self.assertRaises(ValidationError, disallowed.to_python, value)
+
+        self.assertEquals(len(queries), 0)
+
+
+class TestUploadSlots(MediaRootMixin, TestCase):
+    FQ_VAL = 'FQ:upthor.ExampleModel.content'
+
+    def post(self, content):
+        the_file = BytesIO(content)
+        the_file.name = 'file.txt'
+
+        return self.client.post(reverse('thor-file-upload'), {'fq': self.FQ_VAL, 'file': the_file})
+
+    def test_uploads_wait_for_a_free_slot(self):
+        with self.settings(THOR_MAX_CONCURRENT_UPLOADS=1, THOR_UPLOAD_SLOT_TIMEOUT=0, FILE_UPLOAD_MAX_MEMORY_SIZE=1):
+            slots = get_upload_slots()
+            self.assertTrue(slots.acquire())
+
+            try:
+                response = self.post(b'busy')
+            finally:
+                slots.release()
+
+            self.assertEquals(response.status_code, 503)
+            self.assertFalse(json.loads(force_text(response.content))['success'])
+            self.assertEquals(TemporaryFileWrapper.objects.count(), 0)
+
+            # The file written while the body was received was removed
+            self.assertEquals([name for path, dirs, names in os.walk(self.media_root) for name in names], [])
+
+            response = self.post(b'free')
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(slots.used, 0)
+
+    def test_resizing_keeps_slots_in_use(self):
+        with self.settings(THOR_MAX_CONCURRENT_UPLOADS=2):
+            slots = get_upload_slots()
+            self.assertTrue(slots.acquire())
+
+        with self.settings(THOR_MAX_CONCURRENT_UPLOADS=1):
+            self.assertIs(get_upload_slots(), slots)
+
+            # The upload in flight still holds the only slot
+            self.assertFalse(slots.acquire(0))
+            slots.release()
+
+            self.assertTrue(slots.acquire(0))
+            slots.release()
+            self.assertEquals(slots.used, 0)
+
+
+@override_settings(THOR_PREVIEW_WORKERS=0, THOR_PREVIEW_SIZES=((20, 20), ))
+class TestPreviews(MediaRootMixin, TestCase):
+    FQ_VAL = 'FQ:upthor.ExampleImageModel.image'
+
+    def create_image(self, name='image.png'):
+        from PIL import Image
+
+        content = BytesIO()
+        Image.new('RGB', (100, 50), (255, 0, 0)).save(content, 'PNG')
+        content.seek(0)
+        content.name = name
+
+        return content
+
+    def test_previews_are_generated_after_upload(self):
+        response = self.client.post(reverse('thor-file-upload'), {'fq': self.FQ_VAL, 'file': self.create_image()})
+        result = json.loads(force_text(response.content))['file']
+
+        instance = TemporaryFileWrapper.objects.get(pk=result['id'])
+        name = preview_name(instance.file.name, (20, 20))
+
+        self.assertEquals(result['preview_url'], instance.file.storage.url(name))
+
+        from PIL import Image
+        with instance.file.storage.open(name, 'rb') as preview:
+            self.assertEquals(Image.open(preview).size, (20, 10))
+
+        # The preview is removed together with the file
+        instance.delete()
+        self.assertFalse(instance.file.storage.exists(name))
+
+    def test_previews_are_promoted(self):
+        uploaded = self.create_image()
+        temporary, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('image.png', uploaded.read(), content_type='image/png')])
+
+        from upthor.previews import schedule_previews
+        schedule_previews(temporary.file.storage, temporary.file.name)
+
+        temporary.file.temporary_wrapper = temporary
+        instance = ExampleImageModel(image=temporary.file)
+        promoted = ExampleImageModel._meta.get_field('image').pre_save(instance, True)
+
+        self.assertTrue(promoted.storage.exists(preview_name(promoted.name, (20, 20))))
+
+        widget = ThorSingleUploadWidget(fq=ExampleImageModel._meta.get_field('image').field_query, is_image=True)
+        self.assertEquals(widget.get_image_url(promoted), promoted.storage.url(preview_name(promoted.name, (20, 20))))
+
+        # Rendering again doesn't ask the storage
+        calls = []
+        promoted.storage.exists = lambda name: calls.append(name)
+        try:
+            self.assertEquals(widget.get_image_url(promoted), promoted.storage.url(preview_name(promoted.name, (20, 20))))
+        finally:
+            del promoted.storage.exists
+
+        self.assertEquals(calls, [])
+
+    def test_uploads_named_like_previews_are_not_replaced(self):
+        storage = get_temporary_storage()
+        other = storage.save('example-images/preview-20x20-image.png', ContentFile(b'other upload'))
+
+        uploaded = self.create_image()
+        temporary, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('image.png', uploaded.read(), content_type='image/png')])
+        temporary.file.temporary_wrapper = temporary
+
+        promoted = ExampleImageModel._meta.get_field('image').pre_save(ExampleImageModel(image=temporary.file), True)
+
+        self.assertEquals(preview_name(promoted.name, (20, 20)), 'example-images/.previews/20x20/image.png')
+        self.assertEquals(preview_source(preview_name(promoted.name, (20, 20))), promoted.name)
+        self.assertEquals(preview_source(other), None)
+
+        with storage.open(other, 'rb') as stored:
+            self.assertEquals(stored.read(), b'other upload')
+
+    def test_missing_previews_are_remembered(self):
+        storage = get_temporary_storage()
+        name = storage.save('temp-files/abc/def/other-process.png', self.create_image())
+        the_file = FieldFile(None, TemporaryFileWrapper._meta.get_field('file'), name)
+
+        calls = []
+        storage.exists = lambda name: calls.append(name) or False
+        try:
+            self.assertEquals(get_preview_url(the_file), the_file.url)
+            self.assertEquals(get_preview_url(the_file), the_file.url)
+        finally:
+            del storage.exists
+
+        self.assertEquals(len(calls), 1)
+
+
+class TestDeferredPromotion(MediaRootMixin, TestCase):
+
+    def save_example(self, content):
+        temporary = TemporaryFileWrapper()
+        temporary.file.save('deferred.txt', ContentFile(content))
+        temporary.file.temporary_wrapper = temporary
+
+        instance = ExampleModel(content=temporary.file)
+        promoted = ExampleModel._meta.get_field('content').pre_save(instance, True)
+
+        return temporary, promoted
+
+    def read(self, the_file):
+        with the_file.storage.open(the_file.name, 'rb') as stored:
+            return stored.read()
+
+    @override_settings(THOR_DEFERRED_PROMOTION=True, THOR_PROMOTION_EXECUTOR='upthor.deferred.SyncExecutor')
+    def test_sync_executor(self):
+        temporary, promoted = self.save_example(b'sync')
+
+        self.assertTrue(promoted.name.startswith('example-files/'))
+        self.assertEquals(self.read(promoted), b'sync')
+        self.assertTrue(is_promoted(promoted))
+        self.assertEquals(PromotionTask.objects.get().state, PromotionTask.DONE)
+
+    @override_settings(THOR_DEFERRED_PROMOTION=True, THOR_PROMOTION_EXECUTOR='upthor.deferred.DatabaseExecutor',
+                       THOR_LINKED_EXPIRE_TIME=0)
+    def test_database_queue(self):
+        temporary, promoted = self.save_example(b'queued')
+
+        # The name is reserved until the copy is done
+        self.assertEquals(self.read(promoted), b'')
+        self.assertFalse(is_promoted(promoted))
+
+        # Queued files are not cleaned up
+        self.assertFalse(get_stale_files().exists())
+
+        call_command('process_promotions', stdout=StringIO())
+
+        self.assertEquals(self.read(promoted), b'queued')
+        self.assertTrue(is_promoted(promoted))
+        self.assertTrue(get_stale_files().exists())
+
+    @override_settings(THOR_DEFERRED_PROMOTION=True, THOR_PROMOTION_EXECUTOR='upthor.deferred.DatabaseExecutor')
+    def test_stale_running_tasks_are_reclaimed(self):
+        temporary, promoted = self.save_example(b'crashed')
+
+        # A worker claimed the task and crashed
+        PromotionTask.objects.update(state=PromotionTask.RUNNING, modified=timezone.now() - datetime.timedelta(hours=1))
+
+        call_command('process_promotions', stdout=StringIO())
+
+        task = PromotionTask.objects.get()
+        self.assertEquals(task.state, PromotionTask.DONE)
+        self.assertEquals(task.attempts, 2)
+        self.assertEquals(self.read(promoted), b'crashed')
+
+
+class TestThreadPoolPromotion(MediaRootMixin, TransactionTestCase):
+
+    def defer(self, content):
+        temporary = TemporaryFileWrapper()
+        temporary.file.save('deferred.txt', ContentFile(content))
+        temporary.file.temporary_wrapper = temporary
+
+        return ExampleModel._meta.get_field('content').pre_save(ExampleModel(content=temporary.file), True)
+
+    @override_settings(THOR_DEFERRED_PROMOTION=True, THOR_PROMOTION_EXECUTOR='upthor.deferred.DatabaseExecutor')
+    def test_reserved_files_of_rolled_back_saves_are_removed(self):
+        reserved = []
+
+        try:
+            with transaction.atomic():
+                reserved.append(self.defer(b'rolled back'))
+                raise ValueError('The model could not be saved')
+        except ValueError:
+            pass
+
+        with transaction.atomic():
+            committed = self.defer(b'committed')
+
+        storage = committed.storage
+        self.assertTrue(storage.exists(reserved[0].name))
+
+        discard_rolled_back_reservations()
+
+        self.assertFalse(storage.exists(reserved[0].name))
+        self.assertTrue(storage.exists(committed.name))
+        self.assertEquals(list(PromotionTask.objects.values_list('name', flat=True)), [committed.name])
+
+    @override_settings(THOR_DEFERRED_PROMOTION=True, THOR_PROMOTION_EXECUTOR='upthor.deferred.DatabaseExecutor',
+                       THOR_PROMOTION_RETRY_DELAY=0.01)
+    def test_failed_copies_are_retried(self):
+        temporary = TemporaryFileWrapper()
+        temporary.file.save('deferred.txt', ContentFile(b'missing'))
+        temporary.file.temporary_wrapper = temporary
+
+        ExampleModel._meta.get_field('content').pre_save(ExampleModel(content=temporary.file), True)
+
+        # Every copy fails without the source
+        temporary.file.storage.delete(temporary.file.name)
+
+        # Waiting for the signal instead of polling, SQLite's shared cache doesn't wait for locks of other threads
+        failed = threading.Event()
+
+        def on_save(sender, instance, **kwargs):
+            if instance.state == PromotionTask.FAILED:
+                failed.set()
+
+        post_save.connect(on_save, sender=PromotionTask)
+        try:
+            ThreadPoolExecutor().run_async(PromotionTask.objects.get().pk)
+            self.assertTrue(failed.wait(10))
+        finally:
+            post_save.disconnect(on_save, sender=PromotionTask)
+
+        task = PromotionTask.objects.get()
+        self.assertEquals(task.state, PromotionTask.FAILED)
+        self.assertEquals(task.attempts, 3)
+
+
+class TestContentAddressedStorage(MediaRootMixin, TestCase):
+
+    def link(self, temporary, pk, model=ExampleBlobModel):
+        temporary.file.temporary_wrapper = temporary
+
+        instance = model(pk=pk, content=temporary.file)
+        instance.content = model._meta.get_field('content').pre_save(instance, True)
+
+        # The model isn't managed, send the signals of save() and delete() by hand
+        post_save.send(model, instance=instance, created=True)
+        return instance
+
+    def test_objects_share_files(self):
+        temporary, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('logo.png', b'logo')])
+
+        first = self.link(temporary, 1)
+        second = self.link(temporary, 2)
+
+        self.assertEquals(first.content.name, second.content.name)
+        self.assertTrue(first.content.name.startswith('thor-blobs/'))
+        self.assertEquals(StoredBlob.objects.get().references.count(), 2)
+
+        storage = first.content.storage
+        with storage.open(first.content.name, 'rb') as stored:
+            self.assertEquals(stored.read(), b'logo')
+
+        out = StringIO()
+        post_delete.send(ExampleBlobModel, instance=first)
+        call_command('gc_blobs', grace_period=0, stdout=out)
+
+        self.assertIn('Removed 0', out.getvalue())
+        self.assertTrue(storage.exists(second.content.name))
+
+        post_delete.send(ExampleBlobModel, instance=second)
+        call_command('gc_blobs', grace_period=0, stdout=out)
+
+        self.assertIn('Removed 1', out.getvalue())
+        self.assertFalse(storage.exists(second.content.name))
+        self.assertFalse(StoredBlob.objects.exists())
+        self.assertFalse(BlobReference.objects.exists())
+
+    def test_proxy_and_child_models_are_referenced(self):
+        proxy_file, child_file = TemporaryFileWrapper.bulk_save([
+            SimpleUploadedFile('proxy.txt', b'proxy'), SimpleUploadedFile('child.txt', b'child'),
+        ])
+
+        proxy = self.link(proxy_file, 1, model=ExampleBlobProxy)
+        child = self.link(child_file, 2, model=ExampleBlobChild)
+
+        # Both are stored under the model that has the column
+        self.assertEquals(set(BlobReference.objects.values_list('model', 'object_id')), {
+            ('upthor.exampleblobmodel', '1'), ('upthor.exampleblobmodel', '2'),
+        })
+
+        removed, failed = collect_blobs(grace_period=0)
+        self.assertEquals(removed, [])
+        self.assertTrue(proxy.content.storage.exists(proxy.content.name))
+        self.assertTrue(child.content.storage.exists(child.content.name))
+
+        # Deleting the child also deletes its parent row
+        post_delete.send(ExampleBlobChild, instance=child)
+        post_delete.send(ExampleBlobModel, instance=ExampleBlobModel(pk=2))
+
+        removed, failed = collect_blobs(grace_period=0)
+        self.assertEquals([x.name for x in removed], [child.content.name])
+        self.assertEquals(BlobReference.objects.count(), 1)
+
+
+class TestHashAlgorithm(MediaRootMixin, TestCase):
+
+    @override_settings(THOR_HASH_ALGORITHM='sha256')
+    def test_configured_algorithm_is_used(self):
+        temporary, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('data.txt', b'data')])
+
+        self.assertEquals(temporary.md5sum, hashlib.sha256(b'data').hexdigest())
+        self.assertEquals(temporary.hash_algorithm, 'sha256')
+
+    @override_settings(THOR_HASH_ALGORITHM='nope')
+    def test_unknown_algorithm(self):
+        self.assertRaises(ImproperlyConfigured, new_hash)
+
+    @override_settings(THOR_HASH_BUFFER_SIZE=1024)
+    def test_local_files_are_hashed_in_big_slices(self):
+        expected = hashlib.md5(b'x' * 5000).hexdigest()
+
+        # Memory mapped, read into the buffer and streamed from a storage without paths
+        for content in [b'x' * 5000, b'x' * 500]:
+            temporary = TemporaryFileWrapper()
+            temporary.file.save('hashed.txt', ContentFile(content), save=False)
+
+            self.assertEquals(hash_file(temporary.file), hashlib.md5(content).hexdigest())
+
+        storage = MemoryStorage()
+        name = storage.save('hashed.txt', ContentFile(b'x' * 5000))
+
+        self.assertEquals(hash_file(storage.open(name)), expected)
+
+    def test_rehash_files(self):
+        first, second = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('a.txt', b'a'), SimpleUploadedFile('b.txt', b'b')])
+
+        with override_settings(THOR_HASH_ALGORITHM='sha1'):
+            # Uploaded again after the algorithm was changed
+            TemporaryFileWrapper.bulk_save([SimpleUploadedFile('b.txt', b'b')])
+
+            out = StringIO()
+            call_command('rehash_files', stdout=out)
+
+        self.assertIn('Rehashed 1 TemporaryFileWrapper objects, removed 1 duplicates', out.getvalue())
+        self.assertEquals(TemporaryFileWrapper.objects.get(pk=first.pk).md5sum, hashlib.sha1(b'a').hexdigest())
+        self.assertFalse(TemporaryFileWrapper.objects.filter(pk=second.pk).exists())
+        self.assertEquals(set(TemporaryFileWrapper.objects.values_list('hash_algorithm', flat=True)), {'sha1'})
+
+
+@override_settings(THOR_METRICS='upthor.metrics.MemoryMetrics')
+class TestMetrics(MediaRootMixin, TestCase):
+    FQ_VAL = 'FQ:upthor.ExampleModel.content'
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+
+        self.metrics = get_metrics()
+        self.metrics.reset()
+
+    def upload(self, content):
+        the_file = BytesIO(content)
+        the_file.name = 'measured.txt'
+
+        return self.client.post(reverse('thor-file-upload'), {'fq': self.FQ_VAL, 'file': the_file})
+
+    def test_upload_phases_are_measured(self):
+        self.assertEquals(self.upload(b'measured').status_code, 200)
+        self.assertEquals(self.upload(b'measured').status_code, 200)
+
+        for name in ['request', 'receive', 'validate', 'save']:
+            self.assertEquals(len(self.metrics.timings['upthor.upload.%s' % name]), 2)
+
+        self.assertEquals(self.metrics.counters['upthor.upload.bytes'], 16)
+        self.assertEquals(self.metrics.counters['upthor.upload.accepted'], 2)
+        self.assertEquals(self.metrics.counters['upthor.dedupe.miss'], 1)
+        self.assertEquals(self.metrics.counters['upthor.dedupe.hit'], 1)
+
+    def test_cleanup_is_measured(self):
+        TemporaryFileWrapper.bulk_save([SimpleUploadedFile('old.txt', b'old')])
+
+        with self.settings(THOR_EXPIRE_TIME=0):
+            TemporaryFileCleaner().run()
+
+        self.assertEquals(self.metrics.counters['upthor.cleanup.deleted'], 1)
+        self.assertEquals(len(self.metrics.timings['upthor.cleanup.run']), 1)
+
+
+class FakeSession(object):
+
+    def __init__(self, session_key):
+        self.session_key = session_key
+
+
+class TestUsage(MediaRootMixin, TestCase):
+
+    def upload(self, content, session_key):
+        the_file = BytesIO(content)
+        the_file.name = 'owned.txt'
+
+        request = RequestFactory().post('/', {'fq': 'FQ:upthor.ExampleModel.content', 'file': the_file})
+        request.session = FakeSession(session_key)
+
+        return FileUploadView.as_view()(request)
+
+    def test_size_and_owner_are_recorded(self):
+        self.assertEquals(self.upload(b'12345', 'a').status_code, 200)
+        linked, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('b.txt', b'123')], owner='session:b')
+        linked.mark_linked()
+
+        self.assertEquals(get_storage_stats(), {
+            'files': 2, 'bytes': 8,
+            'linked_files': 1, 'linked_bytes': 3,
+            'unlinked_files': 1, 'unlinked_bytes': 5,
+            'unknown_size': 0,
+        })
+        self.assertEquals(get_owner_stats(), [('session:a', 1, 5)])
+
+        out = StringIO()
+        call_command('temporary_file_stats', stdout=out)
+        self.assertIn('Owner session:a: 1 files, 5 bytes', out.getvalue())
+
+    @override_settings(THOR_OWNER_MAX_FILES=1)
+    def test_file_quota(self):
+        self.assertEquals(self.upload(b'first', 'a').status_code, 200)
+        self.assertEquals(self.upload(b'second', 'a').status_code, 403)
+        self.assertEquals(self.upload(b'second', 'b').status_code, 200)
+
+        # Linked files don't count
+        TemporaryFileWrapper.objects.update(linked=True)
+        self.assertEquals(self.upload(b'third', 'a').status_code, 200)
+
+    @override_settings(THOR_OWNER_MAX_BYTES=1000)
+    def test_byte_quota(self):
+        self.assertEquals(self.upload(b'x' * 600, 'a').status_code, 200)
+
+        response = self.upload(b'y' * 600, 'a')
+        self.assertEquals(response.status_code, 403)
+        self.assertIn('in total', json.loads(force_text(response.content))['errors'])
+
+    @override_settings(THOR_OWNER_MAX_FILES=2)
+    def test_batch_quota(self):
+        self.assertEquals(self.upload(b'first', 'a').status_code, 200)
+
+        files = []
+        for idx in range(3):
+            the_file = BytesIO(('batch-%d' % idx).encode())
+            the_file.name = 'batch-%d.txt' % idx
+            files.append(the_file)
+
+        request = RequestFactory().post('/', {'fq': 'FQ:upthor.ExampleModel.content', 'file': files})
+        request.session = FakeSession('a')
+        response = BatchFileUploadView.as_view()(request)
+
+        # Every file counts, not only the request
+        results = json.loads(force_text(response.content))['files']
+        self.assertEquals([x['success'] for x in results], [True, False, False])
+        self.assertEquals(TemporaryFileWrapper.objects.filter(owner='session:a').count(), 2)
+
+
+class TestReconcile(MediaRootMixin, TestCase):
+
+    def store(self, name, content=b'orphan', age=0):
+        storage = get_temporary_storage()
+        name = storage.save(name, ContentFile(content))
+
+        if age:
+            mtime = time.time() - age
+            os.utime(storage.path(name), (mtime, mtime))
+            os.utime(os.path.dirname(storage.path(name)), (mtime, mtime))
+
+        return name
+
+    def test_orphans_are_removed(self):
+        kept, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('kept.png', b'kept')])
+        kept_preview = self.store(preview_name(kept.file.name, (20, 20)), age=100)
+        orphan = self.store('temp-files/abc/0123456789abcdef0123456789a/orphan.txt', age=100)
+        recent = self.store('temp-files/def/0123456789abcdef0123456789a/recent.txt')
+
+        out = StringIO()
+        call_command('reconcile_temporary_files', workers=0, grace_period=50, dry_run=True, verbosity=2, stdout=out)
+        self.assertIn(orphan, out.getvalue())
+        self.assertIn('would remove 1 orphans', out.getvalue())
+
+        storage = get_temporary_storage()
+        call_command('reconcile_temporary_files', workers=0, grace_period=50, stdout=out)
+
+        self.assertFalse(storage.exists(orphan))
+        self.assertTrue(storage.exists(kept.file.name))
+        self.assertTrue(storage.exists(kept_preview))
+        self.assertTrue(storage.exists(recent))
+
+        # The empty uuid directory is removed, the prefix directory stays
+        self.assertFalse(os.path.exists(os.path.dirname(storage.path(orphan))))
+        self.assertTrue(os.path.exists(storage.path('temp-files/abc')))
+
+    def test_uploads_named_like_previews_are_kept(self):
+        uploaded, = TemporaryFileWrapper.bulk_save([SimpleUploadedFile('preview-10x10-cat.png', b'cat')])
+
+        storage = get_temporary_storage()
+        mtime = time.time() - 100
+        os.utime(storage.path(uploaded.file.name), (mtime, mtime))
+
+        reconciler = OrphanReconciler(workers=0, grace_period=50).run()
+
+        self.assertEquals(reconciler.orphans, [])
+        self.assertTrue(storage.exists(uploaded.file.name))
+
+    def test_checkpoint(self):
+        orphans = [self.store('temp-files/%s/0123456789abcdef0123456789a/orphan.txt' % prefix, age=100)
+                   for prefix in ['aaa', 'bbb']]
+        checkpoint = os.path.join(self.media_root, 'checkpoint.json')
+        storage = get_temporary_storage()
+
+        # Out of time before the first prefix
+        reconciler = OrphanReconciler(workers=0, grace_period=50, checkpoint=checkpoint, max_runtime=-1).run()
+        self.assertFalse(reconciler.finished)
+        self.assertTrue(all(storage.exists(name) for name in orphans))
+
+        # A previous run handled the first prefix
+        Checkpoint(checkpoint).add('temp-files/aaa')
+
+        reconciler = OrphanReconciler(workers=2, grace_period=50, checkpoint=checkpoint).run()
+
+        self.assertTrue(reconciler.finished)
+        self.assertEquals(reconciler.orphans, [orphans[1]])
+        self.assertTrue(storage.exists(orphans[0]))
+        self.assertFalse(storage.exists(orphans[1]))
+        self.assertFalse(os.path.exists(checkpoint))
@@ -0,0 +1,241 @@
+import errno
+import os
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from upthor.forms import allowed_type
+from upthor.hashing import new_hash
+from upthor.metrics import increment
+from upthor.models import TemporaryFileWrapper, check_content_magic, get_max_file_size, thor_upload_file_name
+from upthor.storage import get_temporary_storage
+
+
+# Signatures of common file types, used to check the declared content type (see THOR_CHECK_CONTENT_MAGIC)
+MAGIC_TYPES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'Rar!\x1a\x07', 'application/x-rar-compressed'),
+    (b'PK\x03\x04', 'application/zip'),
+)
+
+
+def guess_content_type(data):
+    """ Returns the content type of data by its first bytes, or None if it isn't known.
+    """
+    for magic, content_type in MAGIC_TYPES:
+        if data.startswith(magic):
+            return content_type
+
+    return None
+
+
+def discard_uploaded_files(files):
+    """ Removes uploaded bytes that were stored before they were validated.
+    """
+    for name in files:
+        for uploaded_file in files.getlist(name) if hasattr(files, 'getlist') else [files[name]]:
+            if isinstance(uploaded_file, ThorUploadedFile):
+                uploaded_file.discard()
+
+
+class ThorUploadedFile(UploadedFile):
+    """ An uploaded file that was hashed while it was received.
+
+        `storage_name` is set when the bytes were already written to their final
+        location in the temporary file storage, `duplicate` is set when an existing
+        TemporaryFileWrapper holds the same content (and nothing was written).
+    """
+
+    def __init__(self, file, name, content_type, size, charset, md5sum, storage=None, storage_name=None,
+                 duplicate=None, content_type_extra=None, rejected=False):
+        super(ThorUploadedFile, self).__init__(file, name, content_type, size, charset, content_type_extra)
+
+        self.md5sum = md5sum
+        self.storage = storage
+        self.storage_name = storage_name
+        self.duplicate = duplicate
+
+        # The upload broke the limits while it was received, its content was not kept
+        self.rejected = rejected
+
+    def discard(self):
+        """ Removes the bytes written to the temporary storage (e.g. when validation fails).
+        """
+        self.close()
+
+        if self.storage_name is not None:
+            self.storage.delete(self.storage_name)
+            self.storage_name = None
+
+
+class ThorUploadHandler(FileUploadHandler):
+    """ Hashes uploads (with THOR_HASH_ALGORITHM) while they are streamed and writes them straight to THOR_UPLOAD_TO.
+
+        Files that fit into FILE_UPLOAD_MAX_MEMORY_SIZE are kept in memory until the hash
+        is known, so duplicates of those never touch the storage. Bigger files are written
+        directly to their final location and removed again if they turn out to be duplicates.
+
+        Files that are bigger than THOR_MAX_FILE_SIZE or of a type that isn't in allowed_types
+        are rejected as soon as that is known: nothing more is hashed or stored and the bytes
+        written so far are removed. The form validation then reports the usual error.
+
+        Only usable with storages that have a local path (e.g. FileSystemStorage).
+
+        :param find_duplicates: If False the duplicates aren't looked up, e.g. when this is done in bulk later.
+        :param allowed_types: Allowed content types of the field, if known before the body is read.
+        :param check_magic: Detect the content type from the first bytes, defaults to THOR_CHECK_CONTENT_MAGIC.
+    """
+
+    def __init__(self, request=None, storage=None, find_duplicates=True, allowed_types=None, check_magic=None):
+        super(ThorUploadHandler, self).__init__(request)
+
+        self.storage = storage or get_temporary_storage()
+        self.find_duplicates = find_duplicates
+        self.max_memory_size = settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+        self.max_size = get_max_file_size()
+        self.allowed_types = allowed_types
+        self.check_magic = check_content_magic() if check_magic is None else check_magic
+
+        self.hash = None
+        self.buffer = None
+        self.storage_name = None
+        self.destination = None
+        self.rejected = False
+
+    def new_file(self, *args, **kwargs):
+        super(ThorUploadHandler, self).new_file(*args, **kwargs)
+
+        self.hash = new_hash()
+        self.buffer = BytesIO()
+        self.storage_name = None
+        self.destination = None
+        self.rejected = False
+
+        if not self.check_magic and not self.is_allowed_type():
+            self.reject()
+
+        # The file (also a rejected one) is handled here, later handlers would only create unused temporary files
+        raise StopFutureHandlers()
+
+    def is_allowed_type(self):
+        return self.allowed_types is None or allowed_type(self.content_type or '', self.allowed_types)
+
+    def reject(self):
+        """ Stops keeping the current file, the bytes written so far are removed.
+        """
+        if self.destination is not None:
+            self.destination.close()
+            self.storage.delete(self.storage_name)
+
+        self.rejected = True
+        self.hash = None
+        self.buffer = None
+        self.storage_name = None
+        self.destination = None
+
+    def open_destination(self):
+        name = self.storage.get_available_name(thor_upload_file_name(None, self.file_name))
+        path = self.storage.path(name)
+
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        destination = open(path, 'w+b')
+
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(path, settings.FILE_UPLOAD_PERMISSIONS)
+
+        self.storage_name = name
+        self.destination = destination
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0 and self.check_magic:
+            # The detected type replaces the declared one, the declared one is used if it isn't known
+            self.content_type = guess_content_type(raw_data) or self.content_type
+
+            if not self.is_allowed_type():
+                self.reject()
+
+        if not self.rejected and start + len(raw_data) > self.max_size:
+            self.reject()
+
+        if self.rejected:
+            # Keep reading the body, but drop the data
+            return None
+
+        self.hash.update(raw_data)
+
+        if self.destination is None and start + len(raw_data) > self.max_memory_size:
+            # Too big to keep in memory, move what we have to the final location
+            self.open_destination()
+            self.destination.write(self.buffer.getvalue())
+            self.buffer = None
+
+        if self.destination is not None:
+            self.destination.write(raw_data)
+        else:
+            self.buffer.write(raw_data)
+
+        # Stop other handlers from receiving the data
+        return None
+
+    def file_complete(self, file_size):
+        increment('upload.bytes', file_size)
+
+        if self.rejected:
+            return ThorUploadedFile(
+                file=BytesIO(),
+                name=self.file_name,
+                content_type=self.content_type,
+                size=file_size,
+                charset=self.charset,
+                md5sum=None,
+                content_type_extra=self.content_type_extra,
+                rejected=True,
+            )
+
+        md5sum = self.hash.hexdigest()
+        duplicate = None
+
+        if self.find_duplicates:
+            duplicate = TemporaryFileWrapper.objects.filter(md5sum=md5sum).first()
+
+            if duplicate is not None:
+                increment('dedupe.hit')
+
+        if self.destination is not None:
+            the_file = self.destination
+
+            if duplicate is not None:
+                # Same content is already stored, drop the bytes we wrote
+                the_file.close()
+                self.storage.delete(self.storage_name)
+
+                self.storage_name = None
+                the_file = BytesIO()
+        else:
+            the_file = self.buffer
+
+        the_file.seek(0)
+
+        return ThorUploadedFile(
+            file=the_file,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            md5sum=md5sum,
+            storage=self.storage,
+            storage_name=self.storage_name,
+            duplicate=duplicate,
+            content_type_extra=self.content_type_extra,
+        )
@@ -1,13 +1,13 @@
-from upthor.views import FileUploadView
+from upthor.views import BatchFileUploadView, ChunkedFileUploadView, FileUploadView
 
 try:  # pre 1.6
-    from django.conf.urls.defaults import url, patterns
+    from django.conf.urls.defaults import url
 except ImportError:
-    from django.conf.urls import url, patterns
-
-urlpatterns = patterns(
-    '',
+    from django.conf.urls import url
 
+urlpatterns = [
     # for Testing
+    url('^thor-upload/batch/', BatchFileUploadView.as_view(), name='thor-batch-upload'),
+    url('^thor-upload/chunked/', ChunkedFileUploadView.as_view(), name='thor-chunked-upload'),
     url('^thor-upload/', FileUploadView.as_view(), name='thor-file-upload'),
-)
+]
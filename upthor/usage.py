@@ -0,0 +1,107 @@
+from django.db.models import Count, Sum
+from django.template.defaultfilters import filesizeformat
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext_lazy as _
+
+from upthor.models import TemporaryFileWrapper, get_owner_max_bytes, get_owner_max_files
+
+
+def get_storage_stats():
+    """ Returns how many temporary files there are and how many bytes they take, in total and split by linked.
+
+        Files uploaded before sizes were recorded are counted in `unknown_size` instead of the byte totals.
+    """
+    stats = {
+        'files': 0,
+        'bytes': 0,
+        'linked_files': 0,
+        'linked_bytes': 0,
+        'unlinked_files': 0,
+        'unlinked_bytes': 0,
+        'unknown_size': TemporaryFileWrapper.objects.filter(size__isnull=True).count(),
+    }
+
+    rows = TemporaryFileWrapper.objects.order_by().values('linked').annotate(files=Count('pk'), bytes=Sum('size'))
+
+    for row in rows:
+        prefix = 'linked_' if row['linked'] else 'unlinked_'
+
+        stats[prefix + 'files'] += row['files']
+        stats[prefix + 'bytes'] += row['bytes'] or 0
+        stats['files'] += row['files']
+        stats['bytes'] += row['bytes'] or 0
+
+    return stats
+
+
+def get_owner_stats(limit=None):
+    """ Returns (owner, files, bytes) of the owners with the most bytes of unlinked files, biggest first.
+    """
+    rows = TemporaryFileWrapper.objects.filter(linked=False).exclude(owner='').order_by().values('owner').annotate(
+        files=Count('pk'), bytes=Sum('size'),
+    ).order_by('-bytes', 'owner')
+
+    if limit is not None:
+        rows = rows[:limit]
+
+    return [(row['owner'], row['files'], row['bytes'] or 0) for row in rows]
+
+
+def get_owner_usage(owner):
+    """ Returns (files, bytes) of the unlinked files of owner, linked files don't count towards the quotas.
+    """
+    usage = TemporaryFileWrapper.objects.filter(owner=owner, linked=False).aggregate(files=Count('pk'), bytes=Sum('size'))
+
+    return usage['files'], usage['bytes'] or 0
+
+
+def get_quota_error(used_files, used_bytes, size, files):
+    max_bytes = get_owner_max_bytes()
+    max_files = get_owner_max_files()
+
+    if max_files is not None and used_files + files > max_files:
+        return force_text(_("Too many uploaded files, the limit is %d.") % max_files)
+
+    if max_bytes is not None and used_bytes + size > max_bytes:
+        return force_text(_("Uploaded files too large ( > %s in total )") % filesizeformat(max_bytes))
+
+    return None
+
+
+def has_quota():
+    return get_owner_max_bytes() is not None or get_owner_max_files() is not None
+
+
+def check_quota(owner, size=0, files=1):
+    """ Returns an error message if owner can't upload `files` more files of `size` bytes in total, otherwise None.
+
+        See THOR_OWNER_MAX_BYTES and THOR_OWNER_MAX_FILES, files without an owner are not limited.
+    """
+    if not owner or not has_quota():
+        return None
+
+    used_files, used_bytes = get_owner_usage(owner)
+
+    return get_quota_error(used_files, used_bytes, size, files)
+
+
+def check_batch_quota(owner, sizes):
+    """ Returns an error message or None for each file of a batch with the given sizes, the files are accepted in
+        order while they fit in the quota of owner.
+    """
+    if not owner or not has_quota():
+        return [None] * len(sizes)
+
+    used_files, used_bytes = get_owner_usage(owner)
+    errors = []
+
+    for size in sizes:
+        error = get_quota_error(used_files, used_bytes, size, 1)
+
+        if error is None:
+            used_files += 1
+            used_bytes += size
+
+        errors.append(error)
+
+    return errors
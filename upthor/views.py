@@ -1,15 +1,26 @@
 import json
 import re
 
+from django.core.exceptions import ValidationError
 from django.http.response import HttpResponse
 from django.utils.decorators import method_decorator
 from django.utils.encoding import force_text
 from django.views.decorators.csrf import csrf_exempt
+from django.utils.translation import ugettext as _
 from django.views.generic.base import View
 
-from upthor.models import FqCrypto
+from upthor.chunked import ChunkedUploadError, append_chunk, create_upload, get_uploaded_file
+from upthor.concurrency import get_upload_slots
+from upthor.models import ChunkedUpload, FqCrypto, TemporaryFileWrapper, get_max_file_size, get_size_error, \
+    get_upload_slot_timeout
 from upthor.fields import ThorFileField, ThorImageField
-from upthor.forms import TemporaryFileForm, allowed_type
+from upthor.forms import TemporaryFileForm, allowed_type, validate_upload, validate_uploaded_file
+from upthor.metrics import increment, timer
+from upthor.previews import get_preview_url, is_image_type, schedule_previews
+from upthor.registry import registry
+from upthor.storage import get_temporary_storage, storage_has_path
+from upthor.uploadhandler import ThorUploadHandler, ThorUploadedFile, discard_uploaded_files
+from upthor.usage import check_batch_quota, check_quota
 
 try:
     from django.apps import apps
@@ -33,6 +44,12 @@ except ImportError:
 
 class FileUploadView(View):
     http_method_names = ['post', ]
+    find_duplicates = True
+
+    # Allowance for the multipart boundaries and the other fields when Content-Length is checked
+    check_content_length = True
+    MULTIPART_OVERHEAD = 16 * 1024
+
     FQ_REGEX = re.compile(r'^FQ:([\w\d_]+)\.([\w\d]+)\.([\w\d]+)$')
 
     @staticmethod
@@ -41,9 +58,12 @@ class FileUploadView(View):
 
     @classmethod
     def parse_field_component(cls, component):
+        if not component:
+            return None
 
         if component[:3] != 'FQ:':
-            component = FqCrypto.decode(component)
+            with timer('upload.fq_decode'):
+                component = FqCrypto.decode(component)
 
         mat = cls.FQ_REGEX.match(component)
         if mat:
@@ -55,58 +75,212 @@ class FileUploadView(View):
     def dispatch(self, request, *args, **kwargs):
         return super(FileUploadView, self).dispatch(request, *args, **kwargs)
 
+    def get_early_field(self, request):
+        """ Returns the field of the `fq` query parameter, which is known before the body is read.
+        """
+        try:
+            field_component = self.parse_field_component(request.GET.get('fq', None))
+        except (TypeError, ValueError):
+            return None
+
+        valid, field_value, errors = self.validate_fq(field_component)
+        return field_value if valid else None
+
+    def add_upload_handlers(self, request):
+        storage = get_temporary_storage()
+
+        if storage_has_path(storage):
+            field = self.get_early_field(request)
+
+            # Hash and store the upload while it is being received
+            request.upload_handlers.insert(0, ThorUploadHandler(request, storage=storage,
+                                                                find_duplicates=self.find_duplicates,
+                                                                allowed_types=field.allowed_types if field else None))
+
+    def validate_content_length(self, request):
+        """ Rejects requests that can't hold an allowed file before their body is read.
+        """
+        if not self.check_content_length:
+            return None
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return None
+
+        if content_length > get_max_file_size() + self.MULTIPART_OVERHEAD:
+            return self.error_response([get_size_error()])
+
+        return None
+
+    def get_owner(self, request):
+        """ Identifies who uploads the files, see THOR_OWNER_MAX_BYTES and THOR_OWNER_MAX_FILES.
+
+            Uploads of anonymous users without a session have no owner and are not limited.
+        """
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            return 'user:%s' % user.pk
+
+        session = getattr(request, 'session', None)
+        if session is not None and session.session_key:
+            return 'session:%s' % session.session_key
+
+        return ''
+
+    def validate_quota(self, request):
+        """ Rejects requests of owners that reached their quota before the body is read.
+        """
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            content_length = 0
+
+        error = check_quota(self.get_owner(request), content_length)
+        if error is not None:
+            return self.error_response([error])
+
+        return None
+
     def post(self, request, *args, **kwargs):
+        with timer('upload.request'):
+            response = self.validate_content_length(request) or self.validate_quota(request)
+            if response is not None:
+                return response
+
+            self.add_upload_handlers(request)
+
+            return self.with_upload_slot(request, self.handle_post, request)
+
+    def handle_post(self, request):
+        return self.upload(request)
+
+    def with_upload_slot(self, request, func, *args):
+        """ Calls func once the body is received and one of THOR_MAX_CONCURRENT_UPLOADS is free.
+
+            The body is read before waiting, so slow clients don't hold a slot.
+        """
+        with timer('upload.receive'):
+            request.FILES  # noqa, reads the body
+
+        slots = get_upload_slots()
+        if slots is None:
+            return func(*args)
+
+        with timer('upload.slot_wait'):
+            acquired = slots.acquire(get_upload_slot_timeout())
+
+        if not acquired:
+            discard_uploaded_files(request.FILES)
+            return self.busy_response()
+
+        try:
+            return func(*args)
+        finally:
+            # The slots that were acquired, also if THOR_MAX_CONCURRENT_UPLOADS changed meanwhile
+            slots.release()
+
+    def upload(self, request):
         field_component = self.parse_field_component(request.POST.get('fq', None))
         if not field_component:
+            discard_uploaded_files(request.FILES)
             return
 
         valid, field_value, errors = self.validate_fq(field_component)
         if valid:
-            form = TemporaryFileForm(field_value, request.POST, request.FILES)
-            if form.is_valid():
+            form = TemporaryFileForm(field_value, request.POST, request.FILES, owner=self.get_owner(request))
+            return self.form_response(form, field_value)
+
+        discard_uploaded_files(request.FILES)
+        return self.error_response(errors)
+
+    def form_response(self, form, field_value):
+        with timer('upload.validate'):
+            is_valid = form.is_valid()
+
+        if is_valid:
+            with timer('upload.save'):
                 instance = form.save()
-                is_image_type = allowed_type(instance.content_type, ThorFileField.handle_allowed_types(['type:image']))
-
-                upload_icon = '<i class="fa fa-file"></i>'
-                if field_value.get_upload_image is not None:
-                    if callable(field_value.get_upload_image):
-                        upload_icon = field_value.get_upload_image(instance.file.path)
-                    else:
-                        upload_icon = force_text(field_value.get_upload_image)
-
-                upload_url = instance.file.url
-                if field_value.get_upload_image_url is not None:
-                    if callable(field_value.get_upload_image_url):
-                        upload_icon = field_value.get_upload_image_url(instance.file.url)
-                    else:
-                        upload_icon = force_text(field_value.get_upload_image_url)
-
-                return self.json_response({
-                    'success': True,
-                    'file': {
-                        'id': instance.id,
-                        'md5sum': instance.md5sum,
-                        'url': upload_url,
-                        'file_name': instance.file.name,
-                        'instance_type': 'image' if is_image_type else 'file',
-                        'upload_icon': upload_icon,
-                    },
-                })
-            else:
-                for field, error_val in form.errors.items():
-                    for error_txt in error_val:
-                        errors += [force_text(error_txt)]
+
+            self.create_previews(instance, field_value)
+            increment('upload.accepted')
+
+            return self.json_response({
+                'success': True,
+                'file': self.get_file_data(instance, field_value),
+            })
+
+        form.discard()
+
+        errors = []
+        for field, error_val in form.errors.items():
+            for error_txt in error_val:
+                errors += [force_text(error_txt)]
+
+        return self.error_response(errors)
+
+    @staticmethod
+    def create_previews(instance, field_value):
+        if getattr(field_value, 'has_previews', False) and is_image_type(instance.content_type):
+            schedule_previews(instance.file.storage, instance.file.name)
+
+    def error_response(self, errors):
+        increment('upload.rejected')
 
         return self.json_response({
             'success': False,
             'errors': force_text(errors[0])
         }, status=403)
 
+    def busy_response(self):
+        increment('upload.busy')
+
+        response = self.json_response({
+            'success': False,
+            'errors': force_text(_('Too many uploads at the moment, please try again.')),
+        }, status=503)
+        response['Retry-After'] = '%d' % max(1, get_upload_slot_timeout())
+
+        return response
+
+    @staticmethod
+    def get_file_data(instance, field_value):
+        is_image_type = allowed_type(instance.content_type, ThorFileField.handle_allowed_types(['type:image']))
+
+        upload_icon = '<i class="fa fa-file"></i>'
+        if field_value.get_upload_image is not None:
+            if callable(field_value.get_upload_image):
+                upload_icon = field_value.get_upload_image(instance.file.path)
+            else:
+                upload_icon = force_text(field_value.get_upload_image)
+
+        upload_url = instance.file.url
+        if field_value.get_upload_image_url is not None:
+            if callable(field_value.get_upload_image_url):
+                upload_icon = field_value.get_upload_image_url(instance.file.url)
+            else:
+                upload_icon = force_text(field_value.get_upload_image_url)
+
+        return {
+            'id': instance.id,
+            'md5sum': instance.md5sum,
+            'url': upload_url,
+            'file_name': instance.file.name,
+            'instance_type': 'image' if is_image_type else 'file',
+            'upload_icon': upload_icon,
+            # The previews were only just scheduled, the storage isn't asked whether they are ready
+            'preview_url': get_preview_url(instance.file, probe=False) if getattr(field_value, 'has_previews', False) else upload_url,
+        }
+
     @staticmethod
     def validate_fq(field_component):
         if field_component is None or len(field_component) != 3:
             return False, None, ['FQ protection validation failed.']
 
+        config = registry.get(*field_component)
+        if config is not None:
+            return True, config.field, []
+
         try:
             model = apps.get_model(field_component[0], field_component[1])
         except LookupError as e:
@@ -122,3 +296,232 @@ class FileUploadView(View):
                 return True, field, []
 
         return False, None, ['FQ protection validation failed.']
+
+
+class ChunkedFileUploadView(FileUploadView):
+    """ Receives big files in parts, so that failed uploads can be resumed.
+
+        1. POST `fq`, `file_name`, `size` and `content_type` to open an upload, the response contains `upload_id`.
+        2. POST the parts as `file` together with `upload_id` and a `Content-Range: bytes start-end/size` header.
+        3. GET with `upload_id` returns the persisted `offset` to resume from.
+
+        The response to the last part is the same as the one of FileUploadView. Requests that contain
+        a file but no `upload_id` are handled like regular uploads.
+    """
+    http_method_names = ['get', 'post', ]
+    CONTENT_RANGE_REGEX = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+    def add_upload_handlers(self, request):
+        if 'HTTP_CONTENT_RANGE' not in request.META:
+            super(ChunkedFileUploadView, self).add_upload_handlers(request)
+
+    def validate_quota(self, request):
+        # Parts of opened uploads were checked when the upload was opened
+        if 'HTTP_CONTENT_RANGE' in request.META:
+            return None
+
+        return super(ChunkedFileUploadView, self).validate_quota(request)
+
+    @classmethod
+    def parse_content_range(cls, content_range, size):
+        if not content_range:
+            return 0, size - 1, size
+
+        mat = cls.CONTENT_RANGE_REGEX.match(content_range)
+        if mat:
+            return int(mat.group(1)), int(mat.group(2)), int(mat.group(3))
+
+        return None
+
+    def offset_response(self, upload):
+        response = self.json_response({
+            'success': True,
+            'upload_id': upload.upload_id,
+            'offset': upload.offset,
+        })
+
+        if upload.offset:
+            # Lets jQuery-File-Upload know where to continue from
+            response['Range'] = 'bytes=0-%d' % (upload.offset - 1)
+
+        return response
+
+    def get(self, request, *args, **kwargs):
+        try:
+            upload = ChunkedUpload.objects.get(upload_id=request.GET.get('upload_id', None))
+        except ChunkedUpload.DoesNotExist:
+            return self.error_response(['Upload not found.'])
+
+        return self.offset_response(upload)
+
+    def handle_post(self, request):
+        upload_id = request.POST.get('upload_id', None)
+        if upload_id:
+            return self.receive_chunk(request, upload_id)
+
+        if request.FILES:
+            return self.upload(request)
+
+        return self.open_upload(request)
+
+    def open_upload(self, request):
+        field_component = self.parse_field_component(request.POST.get('fq', None))
+
+        valid, field_value, errors = self.validate_fq(field_component)
+        if not valid:
+            return self.error_response(errors)
+
+        try:
+            size = int(request.POST.get('size', None))
+        except (TypeError, ValueError):
+            return self.error_response([_("Couldn't read uploaded file")])
+
+        content_type = request.POST.get('content_type', None) or 'application/unknown'
+
+        try:
+            validate_upload(size, content_type, field_value.allowed_types)
+        except ValidationError as e:
+            return self.error_response(e.messages)
+
+        error = check_quota(self.get_owner(request), size)
+        if error is not None:
+            return self.error_response([error])
+
+        upload = create_upload('.'.join(field_component), request.POST.get('file_name', None), content_type, size)
+        return self.offset_response(upload)
+
+    def receive_chunk(self, request, upload_id):
+        try:
+            upload = ChunkedUpload.objects.get(upload_id=upload_id)
+        except ChunkedUpload.DoesNotExist:
+            return self.error_response(['Upload not found.'])
+
+        chunk = request.FILES.get('file', None)
+        if chunk is None:
+            return self.error_response([_("Couldn't read uploaded file")])
+
+        content_range = self.parse_content_range(request.META.get('HTTP_CONTENT_RANGE', None), chunk.size)
+        if content_range is None or content_range[2] != upload.size or content_range[1] - content_range[0] + 1 != chunk.size:
+            return self.error_response(['Invalid Content-Range.'])
+
+        if content_range[1] < upload.offset:
+            # This part was already persisted, e.g. the response to it got lost
+            return self.offset_response(upload)
+
+        if content_range[0] != upload.offset:
+            return self.error_response(['Upload should continue from byte %d.' % upload.offset])
+
+        try:
+            append_chunk(upload, chunk)
+        except ChunkedUploadError as e:
+            return self.error_response([force_text(e)])
+
+        if upload.is_complete:
+            return self.finish_upload(upload)
+
+        return self.offset_response(upload)
+
+    def finish_upload(self, upload):
+        valid, field_value, errors = self.validate_fq(upload.field_query.split('.'))
+
+        if valid:
+            uploaded_file = get_uploaded_file(upload)
+
+            form = TemporaryFileForm(field_value, {}, {'file': uploaded_file}, owner=self.get_owner(self.request))
+            response = self.form_response(form, field_value)
+
+            uploaded_file.close()
+        else:
+            response = self.error_response(errors)
+
+        # Also removes the partial file if it wasn't moved to the storage
+        upload.delete()
+
+        return response
+
+
+class BatchFileUploadView(FileUploadView):
+    """ Receives several files for the same field in one request.
+
+        POST `fq` and any number of `file` values. The FQ is validated once and the wrappers are
+        deduplicated and inserted in bulk. The `files` list of the response holds a result for
+        each file (in the same order) that looks like the response of FileUploadView.
+    """
+    # TemporaryFileWrapper.bulk_save looks the duplicates up with a single query
+    find_duplicates = False
+
+    # Each file is limited by ThorUploadHandler instead
+    check_content_length = False
+
+    def upload(self, request):
+        field_component = self.parse_field_component(request.POST.get('fq', None))
+
+        valid, field_value, errors = self.validate_fq(field_component)
+        if not valid:
+            discard_uploaded_files(request.FILES)
+            return self.error_response(errors)
+
+        uploaded_files = request.FILES.getlist('file')
+        if not uploaded_files:
+            return self.error_response([_("Couldn't read uploaded file")])
+
+        results = [None] * len(uploaded_files)
+        valid_files = []
+
+        for idx, uploaded_file in enumerate(uploaded_files):
+            try:
+                validate_uploaded_file(uploaded_file, field_value.allowed_types)
+            except ValidationError as e:
+                if isinstance(uploaded_file, ThorUploadedFile):
+                    uploaded_file.discard()
+
+                increment('upload.rejected')
+
+                results[idx] = {
+                    'success': False,
+                    'errors': force_text(e.messages[0]),
+                }
+            else:
+                valid_files.append((idx, uploaded_file))
+
+        owner = self.get_owner(request)
+
+        # validate_quota only counted the request as one file, the files that don't fit are rejected
+        quota_errors = check_batch_quota(owner, [uploaded_file.size for idx, uploaded_file in valid_files])
+
+        accepted_files = []
+
+        for (idx, uploaded_file), error in zip(valid_files, quota_errors):
+            if error is None:
+                accepted_files.append((idx, uploaded_file))
+                continue
+
+            if isinstance(uploaded_file, ThorUploadedFile):
+                uploaded_file.discard()
+
+            increment('upload.rejected')
+
+            results[idx] = {
+                'success': False,
+                'errors': error,
+            }
+
+        valid_files = accepted_files
+
+        with timer('upload.save'):
+            instances = TemporaryFileWrapper.bulk_save([uploaded_file for idx, uploaded_file in valid_files], owner=owner)
+
+        increment('upload.accepted', len(instances))
+
+        for (idx, uploaded_file), instance in zip(valid_files, instances):
+            self.create_previews(instance, field_value)
+
+            results[idx] = {
+                'success': True,
+                'file': self.get_file_data(instance, field_value),
+            }
+
+        return self.json_response({
+            'success': True,
+            'files': results,
+        })
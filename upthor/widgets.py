@@ -1,14 +1,23 @@
 import os
+import string
 
 import six
 
-from django.core.urlresolvers import reverse
+from django.core.signals import setting_changed
+from django.core.urlresolvers import get_script_prefix, reverse
+from django.dispatch import receiver
 from django.forms import widgets, CheckboxInput
 from django.utils.encoding import force_text
+from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
 from upthor.forms import allowed_type
-from upthor.models import TemporaryFileWrapper, get_max_file_size, get_size_error, FqCrypto, fq_encrypt_disabled
+from upthor.previews import get_preview_url
+from upthor.registry import registry
+from upthor.resolver import get_resolver
+from upthor.models import TemporaryFileWrapper, get_max_chunk_size, get_max_file_size, get_size_error, FqCrypto, \
+    fq_encrypt_disabled
 
 
 DELETE_FIELD_HTML = """
@@ -17,7 +26,9 @@ DELETE_FIELD_HTML = """
 
 HTML = """
     <div class="col-xs-12 col-md-12 well {classes}"
-        data-upload-url="{upload_url}" data-max-size="{max_size}" data-size-error="{size_error}">
+        data-upload-url="{upload_url}" data-max-size="{max_size}" data-size-error="{size_error}"
+        data-chunk-upload-url="{chunk_upload_url}" data-max-chunk-size="{max_chunk_size}"
+        data-batch-upload-url="{batch_upload_url}">
 
         <div class="drag-target-overlay">
             <div>
@@ -55,6 +66,32 @@ HTML = """
 """
 
 
+# (constants, template with the constants filled in), keyed by widget class, field, language and script prefix
+_compiled_templates = {}
+
+
+class TemplateSlots(dict):
+    """ Leaves the placeholders that are not in the dict in place, so they can be filled in later.
+    """
+
+    def __missing__(self, key):
+        return '{%s}' % key
+
+
+def compile_template(template, constants):
+    """ Fills in constants and returns a template that only has the remaining placeholders left.
+    """
+    slots = TemplateSlots((key, force_text(value).replace('{', '{{').replace('}', '}}')) for key, value in constants.items())
+
+    return string.Formatter().vformat(force_text(template), (), slots)
+
+
+@receiver(setting_changed)
+def clear_compiled_templates(**kwargs):
+    # Urls, upload limits and the FQ all depend on settings
+    _compiled_templates.clear()
+
+
 class ThorSingleUploadWidget(widgets.FileInput):
     class Media:
         js = (
@@ -70,6 +107,9 @@ class ThorSingleUploadWidget(widgets.FileInput):
     widget_class = 'single-uploader'
     is_thor_widget = True
 
+    # Send files dropped together in one request
+    batch_upload = False
+
     def __init__(self, fq, is_image, attrs=None):
         self.field_query = fq
         self.is_image = is_image
@@ -92,20 +132,33 @@ class ThorSingleUploadWidget(widgets.FileInput):
     def md5sum_field_name(name):
         return '%s_md5sum' % name
 
+    def get_field_config(self):
+        return registry.get_for_model(self.field_query[0], self.field_query[1])
+
     def get_fq(self):
-        fq = [
-            force_text(self.field_query[0]._meta.app_label),
-            force_text(self.field_query[0]._meta.object_name),
-            self.field_query[1],
-        ]
+        config = self.get_field_config()
 
-        fq_val = 'FQ:%s' % '.'.join(fq)
+        if config is not None:
+            fq_val = config.fq
+        else:
+            fq = [
+                force_text(self.field_query[0]._meta.app_label),
+                force_text(self.field_query[0]._meta.object_name),
+                self.field_query[1],
+            ]
+
+            fq_val = 'FQ:%s' % '.'.join(fq)
 
         if fq_encrypt_disabled():
             return fq_val
         else:
             return FqCrypto.encode(fq_val)
 
+    def get_max_chunk_size(self):
+        """ Files bigger than this are sent in resumable chunks, None disables chunked uploads.
+        """
+        return get_max_chunk_size()
+
     def get_required_state(self):
         return self.is_required
 
@@ -115,7 +168,7 @@ class ThorSingleUploadWidget(widgets.FileInput):
 
         if isinstance(upload, six.string_types) and upload[:3] == 'id:':
             # Pre uploaded linked file.
-            return TemporaryFileWrapper.get_image_from_id(upload[3:], self.field_query)
+            return get_resolver(data).get_image_from_id(upload[3:], self.field_query)
 
         if fq != self.get_fq():
             raise Exception(force_text('For some reason FQ value is wrong...'))
@@ -129,12 +182,10 @@ class ThorSingleUploadWidget(widgets.FileInput):
                 return False
 
         if upload:
-            try:
-                real_file = TemporaryFileWrapper.objects.get(md5sum=upload)
-            except TemporaryFileWrapper.DoesNotExist:
-                pass
-            else:
-                upload = real_file.file
+            real_file = get_resolver(data).get_temporary_file(upload)
+
+            if real_file is not None:
+                upload = real_file
 
         return upload
 
@@ -166,8 +217,51 @@ class ThorSingleUploadWidget(widgets.FileInput):
 
         return False
 
+    def get_image_url(self, the_file):
+        """ Images are shown with their preview (see THOR_PREVIEW_SIZES) once it is ready.
+        """
+        if self.is_image:
+            return get_preview_url(the_file)
+
+        return the_file.url
+
+    def get_template(self):
+        return HTML
+
+    def get_template_constants(self):
+        """ Values that are the same for every widget of this field, these are only computed once.
+        """
+        max_chunk_size = self.get_max_chunk_size()
+        fq = self.get_fq()
+
+        # The FQ is also sent in the query string, so the upload can be checked before its body is read
+        query = '?%s' % urlencode({'fq': fq})
+
+        return {
+            'upload_url': reverse('thor-file-upload') + query,
+            'chunk_upload_url': reverse('thor-chunked-upload') + query if max_chunk_size else '',
+            'max_chunk_size': max_chunk_size or '',
+            'batch_upload_url': reverse('thor-batch-upload') + query if self.batch_upload else '',
+            'FQ': fq,
+            'max_size': get_max_file_size(),
+            'size_error': get_size_error(),
+        }
+
+    def get_compiled_template(self):
+        """ Returns (constants, template with the constants filled in) for this field and the active language.
+        """
+        key = (type(self), self.field_query[0], self.field_query[1], get_language(), get_script_prefix())
+
+        try:
+            return _compiled_templates[key]
+        except KeyError:
+            constants = self.get_template_constants()
+            compiled = _compiled_templates[key] = constants, compile_template(self.get_template(), constants)
+
+            return compiled
+
     def render_template(self, **kwargs):
-        return force_text(HTML).format(**kwargs)
+        return self.get_compiled_template()[1].format(**kwargs)
 
     def render(self, name, value, attrs=None):
         element_id = 'id'
@@ -179,11 +273,11 @@ class ThorSingleUploadWidget(widgets.FileInput):
             if hasattr(value, 'instance') and isinstance(value.instance, TemporaryFileWrapper):
                 # Case 1: Pre existing temporary-file in form.
                 md5sum_field_value = value.instance.md5sum
-                file_url = force_text(value.instance.file.url)
+                file_url = force_text(self.get_image_url(value.instance.file))
                 file_path = force_text(value.instance.file.path)
             elif hasattr(value, "url") and value.name != 'False':
                 # Case 2: Pre existing linked-file in form.
-                file_url = force_text(value.url)
+                file_url = force_text(self.get_image_url(value))
                 file_path = force_text(value.path)
                 md5sum_field_value = 'id:%s' % value.instance.id
 
@@ -192,35 +286,36 @@ class ThorSingleUploadWidget(widgets.FileInput):
         if file_url and not self.get_is_image(value):
             classes.append('is-file')
 
-        upload_url = reverse('thor-file-upload')
         delete_val = '' if file_url else 'checked="checked"'
 
         file_name = os.path.split(value.name)[-1] if value and hasattr(value, "name") else 'Uploaded.pdf'
 
         delete_field = self.render_delete_field(name, delete_val)
 
+        constants = self.get_compiled_template()[0]
+
         output = self.render_template(
             name=name,
             file_url=self.get_file_upload_url_func(file_url),
             element_id=element_id,
             classes=' '.join(classes),
-            upload_url=upload_url,
-            FQ=self.get_fq(),
             md5sum_field_name=self.md5sum_field_name(name),
             fq_field_name=self.fq_field_name(name),
             md5sum_field_value=md5sum_field_value,
             delete_field=delete_field,
             file_name=file_name,
-            max_size=get_max_file_size(),
-            size_error=get_size_error(),
             value=value,
             file_path=file_path,
             file_upload_icon=self.get_file_upload_icon_func(file_path),
+            **constants
         )
 
         return mark_safe(force_text(output))
 
     def get_file_upload_icon_func(self, file_path):
+        config = self.get_field_config()
+        if config is not None:
+            return config.get_upload_icon(file_path)
 
         for field in self.field_query[0]._meta.fields:
             if field.name == self.field_query[1]:
@@ -234,6 +329,9 @@ class ThorSingleUploadWidget(widgets.FileInput):
         return '<i class="fa fa-file"></i>'
 
     def get_file_upload_url_func(self, file_url):
+        config = self.get_field_config()
+        if config is not None:
+            return config.get_upload_url(file_url)
 
         for field in self.field_query[0]._meta.fields:
             if field.name == self.field_query[1]:
@@ -249,6 +347,7 @@ class ThorSingleUploadWidget(widgets.FileInput):
 
 class ThorMultiUploadWidget(ThorSingleUploadWidget):
     widget_class = 'multi-uploader'
+    batch_upload = True
 
     def render_delete_field(self, name, delete_val):
         if self.force_delete_field: